@@ -0,0 +1,163 @@
+#!/usr/bin/env python3.8
+'''
+client.py
+
+Trading client for bots running in the server process
+
+A Client stands in for the websocket of its player. Its commands are
+put on the lobby and room queues as the same messages a websocket
+client sends, so they are sequenced, journaled and processed exactly
+like everyone else's. What the room sends the player is handed to its
+callbacks as typed events, without ever being encoded as JSON.
+
+    class Quoter(client.Client):
+        def on_fill(self, fill):
+            self.new_order(fill.instrument, fill.price + 1, fill.size, 'ask')
+
+    bot = Quoter(engine, 'bot1', 'room1')
+    bot.connect()
+
+The callbacks are called on the event loop as the messages are sent,
+in the order a websocket client would receive them, so they should be
+quick. Commands sent from a callback are queued behind the message
+being processed.
+'''
+
+import json
+from collections import namedtuple
+
+# Commands
+NewOrder = namedtuple('NewOrder', ['instrument', 'price', 'size', 'direction'])
+CancelOrder = namedtuple('CancelOrder', ['instrument', 'order_id'])
+AmendOrder = namedtuple('AmendOrder', ['instrument', 'order_id', 'price', 'size'], defaults=(None, None))
+MassCancel = namedtuple('MassCancel', ['instrument', 'direction'], defaults=(None, None))
+
+# Events
+OrderUpdate = namedtuple(
+    'OrderUpdate',
+    ['instrument', 'order_id', 'size', 'remaining_size', 'price', 'direction', 'status']
+)
+Fill = namedtuple('Fill', ['instrument', 'order_id', 'price', 'size', 'direction'])
+Trade = namedtuple('Trade', ['seq', 'price', 'size', 'direction', 'instrument', 'timestamp'])
+Level = namedtuple('Level', ['price', 'size', 'type'])
+Book = namedtuple('Book', ['instrument', 'seq', 'levels'])      # A full snapshot or a delta
+
+class Client:
+    relays_frames = True    # Sent the Frames themselves, nothing is encoded
+    subprotocol = None
+
+    def __init__(self, engine, player_name, room_name, password=''):
+        self.player_name = player_name
+        self.room_name = room_name
+        self.closed = False
+
+        self._engine = engine
+        self._password = password
+        self._handlers = {
+            'OrderUpdate' : lambda m: self.on_order(OrderUpdate(**m['data'])),
+            'Fill' : lambda m: self.on_fill(Fill(**m['data'])),
+            'TradeUpdate' : lambda m: self.on_trade(Trade(**m['data'])),
+            'OrderbookUpdate' : lambda m: self.on_book(self.as_book(m)),
+            'OrderbookDelta' : lambda m: self.on_book_delta(self.as_book(m)),
+            'PositionUpdate' : lambda m: self.on_positions(m['data']),
+            'PositionDelta' : lambda m: self.on_positions(m['data']),
+            'PnLUpdate' : lambda m: self.on_pnl(m['data']['pnl']),
+        }
+
+    def send_command(self, msg_type, **data):
+        data['room'] = self.room_name
+        data['player'] = self.player_name
+        self._engine.route({'type' : msg_type, 'data' : data}, self)
+
+    def connect(self):
+        '''
+        Logs in (or creates the player) and joins the room
+        '''
+        self._engine.route({
+            'type' : 'NewPlayer',
+            'data' : {
+                'name' : self.player_name,
+                'password' : self._password
+            }
+        }, self)
+        self.send_command('JoinRoom')
+
+    def submit(self, command):
+        self.send_command(type(command).__name__, **command._asdict())
+
+    def new_order(self, instrument, price, size, direction):
+        self.submit(NewOrder(instrument, price, size, direction))
+
+    def cancel_order(self, instrument, order_id):
+        self.submit(CancelOrder(instrument, order_id))
+
+    def amend_order(self, instrument, order_id, price=None, size=None):
+        self.submit(AmendOrder(instrument, order_id, price, size))
+
+    def new_orders(self, orders):
+        '''
+        Sends a list of NewOrders to be processed and published together
+        '''
+        self.send_command('NewOrders', orders=[o._asdict() for o in orders])
+
+    def mass_cancel(self, instrument=None, direction=None):
+        self.submit(MassCancel(instrument, direction))
+
+    def start_game(self):
+        self.send_command('StartGame')
+
+    def reveal_card(self, card):
+        self.send_command('RevealCard', card=card)
+
+    def as_book(self, msg):
+        return Book(msg['symbol'], msg['seq'], [Level(**l) for l in msg['data']])
+
+    async def send(self, payload):
+        if self.closed:
+            return
+        msg = json.loads(payload) if isinstance(payload, str) else payload.msg
+        room_name = msg.get('room')
+        if room_name is None and isinstance(msg.get('data'), dict):
+            room_name = msg['data'].get('room')
+        if room_name is not None and room_name != self.room_name:
+            return      # About another room that the player is in
+        handler = self._handlers.get(msg.get('type'))
+        if handler is None:
+            self.on_message(msg)
+        else:
+            handler(msg)
+
+    async def close(self, code=1000, reason=''):
+        self.closed = True
+
+    # Callbacks, overridden by bots
+
+    def on_order(self, order: OrderUpdate):
+        pass
+
+    def on_fill(self, fill: Fill):
+        pass
+
+    def on_trade(self, trade: Trade):
+        pass
+
+    def on_book(self, book: Book):
+        pass
+
+    def on_book_delta(self, book: Book):
+        pass
+
+    def on_positions(self, positions: dict):
+        '''
+        All the positions of the player, or the ones that have changed
+        '''
+        pass
+
+    def on_pnl(self, pnl: float):
+        pass
+
+    def on_message(self, msg: dict):
+        '''
+        Any other message, as it would have been sent as JSON
+        '''
+        pass
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3.8
+'''
+fairvalue.py
+
+Fair values of the instruments listed in a room
+
+The settlement value of A (or B) is the sum of the cards of A that a
+player knows and of the ones they do not, which are drawn without
+replacement from the cards they have not seen. The exact distribution
+of that sum is counted over the ranks of the unseen cards, giving for
+each point of view the probabilities of every possible value of A and
+of B, and their covariance in closed form. From these:
+
+    A, B, the spreads   mean and variance of a linear combination
+    options             payoffs over every possible value of the
+                        underlying at once, weighted by their
+                        probabilities, for all the options on it
+
+Each player has their own fair values, given their cards and the ones
+revealed, and there is a public set given only the revealed cards.
+Players with the same view share the values. They are worked out again
+only for the views changed by a revealed card, and listing an option
+only adds its values to each view. Players are pushed a
+FairValueUpdate when their values change, and GetFairValues returns
+the cached values.
+
+NumPy is optional, without it no fair values are worked out.
+'''
+
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import backend.risk as risk
+
+def get_sum_distribution(pool, k):
+    '''
+    Probabilities of each total, from 0 to 13k, of k cards drawn
+    without replacement from the pool
+    '''
+    counts = np.bincount(pool, minlength=risk.RANKS + 1) if pool else np.zeros(risk.RANKS + 1, dtype=int)
+    max_sum = risk.RANKS * k
+    ways = np.zeros((k + 1, max_sum + 1))     # Cards drawn, total -> number of ways
+    ways[0, 0] = 1
+    for rank in range(1, risk.RANKS + 1):
+        count = int(counts[rank])
+        if count == 0:
+            continue
+        drawn = ways.copy()
+        for t in range(1, min(count, k) + 1):
+            drawn[t:, t * rank:] += math.comb(count, t) * ways[:k + 1 - t, :max_sum + 1 - t * rank]
+        ways = drawn
+    return ways[k] / ways[k].sum()
+
+def get_distribution(cards):
+    '''
+    The possible settlement values of A and B with their probabilities,
+    and the covariance of A and B
+    '''
+    known_a, known_b, unknown_a, unknown_b, pool = cards
+    probabilities_a = get_sum_distribution(pool, unknown_a)
+    probabilities_b = get_sum_distribution(pool, unknown_b)
+    # Distinct draws from the same cards are negatively correlated
+    m = len(pool)
+    covariance = -unknown_a * unknown_b * np.var(pool) / (m - 1) if m > 1 else 0.0
+    return {
+        'A' : (known_a + np.arange(len(probabilities_a)), probabilities_a),
+        'B' : (known_b + np.arange(len(probabilities_b)), probabilities_b),
+        'covariance' : float(covariance),
+    }
+
+def get_moments(values, probabilities):
+    mean = probabilities @ values
+    return mean, np.maximum(probabilities @ (values * values) - mean * mean, 0)
+
+def evaluate(distribution, instruments):
+    '''
+    {instrument: (mean, variance)} of the settlement values of the
+    instruments
+    '''
+    terms = risk.get_terms(s for s in instruments if s != 'CASH')
+    mean_a, variance_a = get_moments(*distribution['A'])
+    mean_b, variance_b = get_moments(*distribution['B'])
+    covariance = distribution['covariance']
+    results = {}
+    options = {'A' : [], 'B' : []}
+    for s, (a, b, constant, strike, kind) in terms.items():
+        if kind == 0:
+            results[s] = (
+                float(a * mean_a + b * mean_b + constant),
+                float(a * a * variance_a + b * b * variance_b + 2 * a * b * covariance),
+            )
+        else:
+            options['A' if a else 'B'].append(s)
+    for underlying, names in options.items():
+        if not names:
+            continue
+        values, probabilities = distribution[underlying]
+        strikes = np.array([terms[s][3] for s in names], dtype=float)
+        kinds = np.array([terms[s][4] for s in names], dtype=float)
+        payoffs = np.maximum(kinds * (values[:, None] - strikes), 0)     # Values x options
+        means, variances = get_moments(payoffs, probabilities)
+        for s, mean, variance in zip(names, means, variances):
+            results[s] = (float(mean), float(variance))
+    return results
+
+class FairValues:
+    def __init__(self, room):
+        self._room = room
+        self._views = {}            # Player, None for the public -> cards they know
+        self._distributions = {}    # Cards -> distribution of A and B
+        self._values = {}           # Cards -> {instrument: (mean, variance)}
+
+    @property
+    def enabled(self):
+        return np is not None
+
+    async def update(self):
+        '''
+        Called when the cards known by the players may have changed,
+        e.g. a card has been revealed
+        '''
+        if not self.enabled or self._room._status != 'started':
+            return
+        room = self._room
+        changed = []
+        for player_name in [None, *room._player_cards]:
+            cards = risk.get_cards(room, player_name)
+            if self._views.get(player_name) == cards:
+                continue
+            self._views[player_name] = cards
+            changed.append(player_name)
+            if cards not in self._values:
+                distribution = self._distributions[cards] = get_distribution(cards)
+                self._values[cards] = evaluate(distribution, room._instruments)
+        used = set(self._views.values())
+        for cards in [c for c in self._values if c not in used]:
+            del self._values[cards]
+            del self._distributions[cards]
+        await self.send(changed)
+
+    async def add_instrument(self, instrument_name):
+        if not self.enabled or not self._values:
+            return
+        for cards, values in self._values.items():
+            values.update(evaluate(self._distributions[cards], [instrument_name]))
+        await self.send(self._room._player_cards)
+
+    def get(self, player_name=None):
+        '''
+        {instrument: {'mean', 'variance'}} given what a player knows,
+        or only the revealed cards
+        '''
+        cards = self._views.get(player_name)
+        if cards is None:
+            return {}
+        return {
+            name : {
+                'mean' : mean,
+                'variance' : variance,
+            } for name, (mean, variance) in self._values[cards].items()
+        }
+
+    def as_update(self, player_name):
+        return {
+            'type' : 'FairValueUpdate',
+            'data' : {
+                'room' : self._room._name,
+                'values' : self.get(player_name)
+            }
+        }
+
+    async def send(self, player_names):
+        players = self._room._players
+        for player_name in player_names:
+            if player_name in players:
+                await players[player_name].send_message(self.as_update(player_name))
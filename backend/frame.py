@@ -0,0 +1,122 @@
+#!/usr/bin/env python3.8
+'''
+frame.py
+
+A Frame wraps an outbound message so that it is serialised at most
+once per protocol, however many sockets it is sent to. Fan-out then
+only costs the socket writes, which are made concurrently.
+
+Connections that negotiated the binary protocol (see wire.py) are sent
+the binary encoding of a Frame when its message has one, and the JSON
+text otherwise. The instrument id that the binary records carry is set
+on the Frame by the Room that builds it.
+
+A Frame sent to another process (e.g. from a room worker to the
+gateway) is encoded by the sender. It carries its JSON text, binary
+record and header, which is enough to send it on and to conflate it,
+and its message is only decoded from the text if it is asked for.
+'''
+
+import asyncio
+import json
+import struct
+
+import backend.wire as wire
+import util.log as log
+
+class Frame:
+    __slots__ = ('_msg', 'instrument_id', '_text', '_binary', '_header')
+
+    def __init__(self, msg, instrument_id=None):
+        self._msg = msg                     # The message as a dict
+        self.instrument_id = instrument_id  # Id of the instrument in its room, for binary records
+        self._text = None
+        self._binary = None
+        self._header = None
+
+    @property
+    def msg(self):
+        if self._msg is None:
+            self._msg = json.loads(self._text)     # Received from another process
+        return self._msg
+
+    @classmethod
+    def of(cls, msg):
+        return msg if isinstance(msg, cls) else cls(msg)
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = json.dumps(self.msg)
+        return self._text
+
+    @property
+    def binary(self):
+        '''
+        The binary record for the message, or None if it does not have
+        one or can not be encoded, in which case the JSON text is sent
+        '''
+        if self._binary is None:
+            try:
+                self._binary = wire.encode(self.msg, self.instrument_id) or b''
+            except (struct.error, KeyError, TypeError, ValueError) as e:
+                log.warning(f'Could not encode {self.get_type()} as a binary record: {e!r}')
+                self._binary = b''
+        return self._binary or None
+
+    def get_header(self):
+        '''
+        The type of the message and what it is about (e.g. its room and
+        symbol), without decoding a Frame received from another process
+        '''
+        if self._msg is None:
+            return self._header
+        return self._msg
+
+    def get_type(self):
+        return self.get_header().get('type')
+
+    def __getstate__(self):
+        msg = self.msg
+        header = {k : v for k, v in msg.items() if k != 'data'}
+        data = msg.get('data')
+        if isinstance(data, dict) and 'room' in data:
+            header['data'] = {'room' : data['room']}
+        self.binary     # Encodes the binary record into _binary, if it has one
+        return (header, self.instrument_id, self.text, self._binary)
+
+    def __setstate__(self, state):
+        self._header, self.instrument_id, self._text, self._binary = state
+        self._msg = None
+
+def encode(msg, ws=None):
+    '''
+    What to send to a websocket for a str, dict or Frame. Sockets that
+    relay Frames (e.g. a player in a room worker) are given the Frame.
+    '''
+    if isinstance(msg, str):
+        return msg
+    elif getattr(ws, 'relays_frames', False):
+        return Frame.of(msg)
+    elif wire.is_binary(ws):
+        f = Frame.of(msg)
+        return f.binary or f.text
+    elif isinstance(msg, Frame):
+        return msg.text
+    else:
+        return json.dumps(msg)
+
+async def send(msg, ws):
+    # Encoded within the coroutine so that an error is only that socket's
+    await ws.send(encode(msg, ws))
+
+async def fan_out(msg, sockets):
+    '''
+    Sends a message to many sockets concurrently.
+    Returns the sockets that could not be sent to.
+    '''
+    sockets = list(sockets)
+    if not isinstance(msg, str):
+        msg = Frame.of(msg)
+    results = await asyncio.gather(*(send(msg, ws) for ws in sockets), return_exceptions=True)
+    return [ws for ws, r in zip(sockets, results) if isinstance(r, Exception)]
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3.8
+'''
+journal.py
+
+Write-ahead journal of the commands accepted by the server
+
+The lobby and every room have their own append-only file of JSON lines
+in the journal directory:
+
+    lobby.jsonl             NewRoom, DeleteRoom, NewPlayer, DeletePlayer
+    rooms/<room>.jsonl      Commands for the room and the cards dealt in it
+
+Each line is either {"msg": <inbound message>} or {"draw": [number, suit]}.
+Commands are journaled as they are taken off their queue, before they
+are processed, so the state of a room can be rebuilt by processing them
+again in order with the same cards dealt.
+
+Records are encoded on the caller's thread and written by a daemon
+thread with group commit: the files are written and fsynced every
+`interval` seconds, or sooner once `batch` records are waiting. The
+matching path never waits on the disk, at the cost of losing the
+records of the last interval if the machine goes down.
+'''
+
+import atexit
+import collections
+import json
+import os
+import threading
+import urllib.parse
+
+LOBBY = 'lobby'
+
+class ReplaySocket:
+    '''
+    Stands in for the websocket of the players rebuilt from a journal
+    until they log in again. Also marks messages being replayed so that
+    they are not journaled a second time.
+    '''
+
+    relays_frames = True    # Nothing is sent, so nothing needs encoding
+
+    async def send(self, payload):
+        pass
+
+    async def close(self, code=1000, reason=''):
+        pass
+
+REPLAY = ReplaySocket()
+
+def room_key(room_name):
+    return 'rooms/' + urllib.parse.quote(room_name, safe='')
+
+class Journal:
+    def __init__(self, directory, interval=0.01, batch=256):
+        self.directory = directory
+        self.interval = interval        # Seconds between group commits
+        self.batch = batch              # Records that trigger a commit before the interval
+        self.records = 0                # Records journaled
+        self.commits = 0                # Group commits made
+
+        os.makedirs(os.path.join(directory, 'rooms'), exist_ok=True)
+        self._pending = collections.deque()     # (key, line), or (key, None) to remove the file
+        self._files = {}                        # key -> open file, used under _lock
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='journal-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key + '.jsonl')
+
+    def append(self, key, record):
+        self._pending.append((key, json.dumps(record)))
+        if len(self._pending) >= self.batch:
+            self._wake.set()
+
+    def remove(self, key):
+        '''
+        Deletes a journal once the records before this call are written
+        '''
+        self._pending.append((key, None))
+        self._wake.set()
+
+    def exists(self, key):
+        return os.path.exists(self.get_path(key))
+
+    def read(self, key):
+        '''
+        Iterates over the records of a journal. A torn last line, from
+        a crash part way through a write, is ignored.
+        '''
+        if not self.exists(key):
+            return
+        with open(self.get_path(key)) as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    return
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.commit()
+
+    def commit(self):
+        with self._lock:
+            pending = self._pending
+            dirty = {}
+            while pending:
+                key, line = pending.popleft()
+                if line is None:
+                    f = self._files.pop(key, None)
+                    dirty.pop(key, None)
+                    if f is not None:
+                        f.close()
+                    if self.exists(key):
+                        os.remove(self.get_path(key))
+                    continue
+                f = self._files.get(key)
+                if f is None:
+                    f = self._files[key] = open(self.get_path(key), 'a')
+                f.write(line)
+                f.write('\n')
+                dirty[key] = f
+                self.records += 1
+            for f in dirty.values():
+                f.flush()
+                os.fsync(f.fileno())
+            if dirty:
+                self.commits += 1
+
+    def flush(self):
+        '''
+        Writes and fsyncs everything appended so far
+        '''
+        self.commit()
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3.8
+'''
+metrics.py
+
+Counters, gauges and histograms exported in the Prometheus text format
+
+Metrics are registered once, at import, on the REGISTRY of the process
+and each set of label values gets a child the first time it is used.
+Recording is then a dict lookup and an increment:
+
+    ORDERS = metrics.REGISTRY.counter(
+        'mocktrading_orders_total', 'Orders received', ['room', 'instrument']
+    )
+    ORDERS.labels(room_name, instrument_name).inc()
+
+A histogram child holds a preallocated count for each of its buckets,
+found with a bisect, and only makes them cumulative when it is
+collected. A metric stops adding children after max_children, and
+further label values are counted under 'other', so that whatever the
+clients send can not grow it without bound.
+
+Gauges of state that is cheap to read, like queue depths, are set just
+before collecting rather than on every change.
+
+collect() returns plain tuples so that the worker processes can send
+theirs to the gateway, which merges them with a worker label and
+serves them all on one endpoint:
+
+    curl localhost:9100/metrics
+'''
+
+import abc
+import asyncio
+import bisect
+
+import util.helpers as util
+
+# Seconds, for the time taken to handle a message
+LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0
+)
+
+class CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+class GaugeChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+class HistogramChild:
+    __slots__ = ('_bounds', '_counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self._bounds = bounds
+        self._counts = [0] * (len(bounds) + 1)     # The last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get_buckets(self):
+        '''
+        Cumulative counts of the observations at or below each bound
+        '''
+        total = 0
+        buckets = []
+        for bound, count in zip(self._bounds + (float('inf'),), self._counts):
+            total += count
+            buckets.append((bound, total))
+        return buckets
+
+class Metric(abc.ABC):
+    kind = None
+
+    def __init__(self, name, description, label_names=(), max_children=1000):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.max_children = max_children
+
+        self._children = {}     # Label values -> child
+        self._overflow = ('other',) * len(self.label_names)
+
+    @abc.abstractmethod
+    def new_child(self):
+        pass
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            if len(self._children) >= self.max_children:
+                values = self._overflow
+                child = self._children.get(values)
+            if child is None:
+                child = self._children[values] = self.new_child()
+        return child
+
+    def remove(self, *values):
+        '''
+        Forgets the children whose label values start with values,
+        e.g. those of a deleted room
+        '''
+        n = len(values)
+        for key in [k for k in self._children if k[:n] == values]:
+            del self._children[key]
+
+    def clear(self):
+        self._children = {}
+
+    def get_samples(self):
+        return [
+            ('', dict(zip(self.label_names, values)), child.value)
+            for values, child in self._children.items()
+        ]
+
+    def collect(self):
+        return (self.name, self.kind, self.description, self.get_samples())
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def new_child(self):
+        return CounterChild()
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def new_child(self):
+        return GaugeChild()
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, label_names=(), buckets=LATENCY_BUCKETS, **kwargs):
+        super().__init__(name, description, label_names, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+
+    def new_child(self):
+        return HistogramChild(self.buckets)
+
+    def get_samples(self):
+        samples = []
+        for values, child in self._children.items():
+            labels = dict(zip(self.label_names, values))
+            for bound, count in child.get_buckets():
+                samples.append(('_bucket', {**labels, 'le' : format_value(bound)}, count))
+            samples.append(('_sum', labels, child.sum))
+            samples.append(('_count', labels, child.count))
+        return samples
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}      # Name -> Metric
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f'Metric {metric.name} is already registered')
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, description, label_names=(), **kwargs):
+        return self.register(Counter(name, description, label_names, **kwargs))
+
+    def gauge(self, name, description, label_names=(), **kwargs):
+        return self.register(Gauge(name, description, label_names, **kwargs))
+
+    def histogram(self, name, description, label_names=(), **kwargs):
+        return self.register(Histogram(name, description, label_names, **kwargs))
+
+    def collect(self):
+        '''
+        [(name, kind, description, [(suffix, labels, value)])] for every
+        metric, which can be pickled
+        '''
+        return [m.collect() for m in self._metrics.values()]
+
+REGISTRY = Registry()
+
+def merge(families, labels):
+    '''
+    Adds the collected families to others, e.g. those of a worker
+    process, with extra labels on each of their samples
+    '''
+    merged = {name : (kind, description, list(samples)) for name, kind, description, samples in families[0]}
+    for other, extra in zip(families[1:], labels):
+        for name, kind, description, samples in other:
+            if name not in merged:
+                merged[name] = (kind, description, [])
+            merged[name][2].extend((suffix, {**extra, **l}, v) for suffix, l, v in samples)
+    return [(name, kind, description, samples) for name, (kind, description, samples) in merged.items()]
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def render(families):
+    '''
+    The text exposition format of the collected families
+    '''
+    lines = []
+    for name, kind, description, samples in families:
+        lines.append(f'# HELP {name} {escape(description)}')
+        lines.append(f'# TYPE {name} {kind}')
+        for suffix, labels, value in samples:
+            if labels:
+                label_str = ','.join(f'{k}="{escape(v)}"' for k, v in labels.items())
+                lines.append(f'{name}{suffix}{{{label_str}}} {format_value(value)}')
+            else:
+                lines.append(f'{name}{suffix} {format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+async def serve(collect, host='localhost', port=9100):
+    '''
+    Serves GET /metrics over HTTP/1.0, collect is a coroutine function
+    returning the families to render
+    '''
+    async def handle(reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass        # Headers
+            parts = request.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status = '200 OK'
+                body = render(await collect()).encode()
+            else:
+                status = '404 Not Found'
+                body = b'Not found\n'
+            writer.write((
+                f'HTTP/1.0 {status}\r\n'
+                f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                f'Content-Length: {len(body)}\r\n\r\n'
+            ).encode() + body)
+            await writer.drain()
+        except Exception as e:
+            util.print_core(f'Could not serve metrics: {e!r}')
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    util.print_core(f'Serving metrics on http://{host}:{port}/metrics')
+    return server
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3.8
+'''
+outbox.py
+
+Every websocket connection gets an Outbox: a bounded queue of outbound
+messages drained by its own writer task. Sending to a player or to a
+room only puts the message on the queues, so the matching path never
+waits on a slow client.
+
+Snapshot messages (e.g. OrderbookUpdate) are conflated: a newer copy
+for the same room (and symbol) replaces any copy still waiting in the
+queue and goes to its back. Every other message is an event and is
+kept in order.
+
+When the queue holds more than `capacity` messages the connection is a
+slow consumer and is handled according to `policy`:
+
+    'drop'          Drop the new event
+    'resync'        Drop the waiting events and any new ones until the
+                    queue has drained, then call `on_resync` so that
+                    fresh snapshots can be sent
+    'disconnect'    Close the connection
+
+Messages that are not sent, because a write failed or because of the
+policy, are counted by mocktrading_send_failures_total under the source
+'outbox' or the name of the policy.
+'''
+
+import asyncio
+import collections
+
+import backend.frame as frame
+import backend.metrics as metrics
+import util.helpers as util
+import util.log as log
+
+POLICIES = ('drop', 'resync', 'disconnect')
+
+SEND_FAILURES = metrics.REGISTRY.counter(
+    'mocktrading_send_failures_total', 'Messages that could not be sent to a client', ['source']
+)
+
+# Snapshot messages, only the latest copy of each is worth sending
+CONFLATED = ('OrderbookUpdate', 'PositionUpdate', 'PnLUpdate', 'RiskUpdate', 'RoomPlayersUpdate')
+
+def conflation_key(msg):
+    '''
+    The key that a snapshot is conflated on, None for events
+    '''
+    if isinstance(msg, str):
+        return None
+    header = msg.get_header()
+    msg_type = header.get('type')
+    if msg_type not in CONFLATED:
+        return None
+    elif msg_type == 'OrderbookUpdate':
+        return (msg_type, header.get('room'), header.get('symbol'))
+    elif msg_type == 'PositionUpdate':
+        # The data is keyed by instrument, so the room is beside it
+        return (msg_type, header.get('room'))
+    return (msg_type, header.get('data', {}).get('room'))
+
+class SlowConsumer(Exception):
+    pass
+
+class Outbox:
+    relays_frames = True    # Frames are encoded by the writer for the connection
+
+    def __init__(self, ws, capacity=1024, policy='resync', on_resync=None):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown slow consumer policy: {policy}')
+        self.ws = ws
+        self.capacity = capacity            # Most messages that can wait in the queue
+        self.policy = policy                # What to do with a slow consumer
+        self.on_resync = on_resync          # Called once a resyncing queue has drained
+        self.dropped = 0
+
+        self._queue = collections.deque()   # Slots holding [message], None once conflated or dropped
+        self._latest = {}                   # Conflation key -> slot of the waiting snapshot
+        self._size = 0                      # Number of messages waiting
+        self._resyncing = False
+        self._closed = False
+        self._ready = asyncio.Event()
+        self._writer = asyncio.create_task(self.write())
+
+    @property
+    def subprotocol(self):
+        return getattr(self.ws, 'subprotocol', None)
+
+    def qsize(self):
+        return self._size
+
+    async def send(self, msg):
+        '''
+        Puts a str or Frame on the queue without waiting for it to be sent
+        '''
+        self.put(msg)
+
+    def put(self, msg):
+        if self._closed:
+            raise SlowConsumer('Connection is closed')
+        if not isinstance(msg, str):
+            msg = frame.Frame.of(msg)
+        key = conflation_key(msg)
+        if key is not None:
+            slot = self._latest.get(key)
+            if slot is not None:
+                slot[0] = None
+                self._size -= 1
+        elif self._resyncing:
+            self.dropped += 1
+            SEND_FAILURES.labels('resync').inc()
+            return
+        elif self._size >= self.capacity:
+            self.overflow()
+            return
+
+        slot = [msg]
+        self._queue.append(slot)
+        self._size += 1
+        if key is not None:
+            self._latest[key] = slot
+        self._ready.set()
+
+    def overflow(self):
+        dropped = self.dropped
+        self.dropped += 1
+        if self.policy == 'drop':
+            if log.DEBUG_ON:
+                log.debug(f'Dropped a message for a slow consumer ({self._size} waiting)')
+        elif self.policy == 'resync':
+            util.print_core(f'Slow consumer, resyncing after {self._size} waiting messages')
+            self._resyncing = True
+            for slot in self._queue:
+                if slot[0] is not None and conflation_key(slot[0]) is None:
+                    slot[0] = None
+                    self._size -= 1
+                    self.dropped += 1
+        else:
+            util.print_core(f'Slow consumer, disconnecting after {self._size} waiting messages')
+            self.dropped += self._size
+            self.close(1008, 'Slow consumer')
+        SEND_FAILURES.labels(self.policy).inc(self.dropped - dropped)
+
+    def close(self, code=1000, reason=''):
+        '''
+        Stops the writer and closes the connection, anything waiting is discarded
+        '''
+        if not self._closed:
+            self._closed = True
+            self._queue.clear()
+            self._latest.clear()
+            self._size = 0
+            asyncio.ensure_future(self.shutdown(code, reason))
+            if self._writer is not asyncio.current_task():
+                self._writer.cancel()
+
+    async def shutdown(self, code, reason):
+        try:
+            await self.ws.close(code, reason)
+        except Exception:
+            # The connection is already gone
+            pass
+
+    async def write(self):
+        ws = self.ws
+        while True:
+            await self._ready.wait()
+            while self._queue:
+                slot = self._queue.popleft()
+                msg = slot[0]
+                if msg is None:
+                    continue
+                self._size -= 1
+                key = conflation_key(msg)
+                if key is not None and self._latest.get(key) is slot:
+                    del self._latest[key]
+                try:
+                    payload = frame.encode(msg, ws)
+                except Exception as e:
+                    # Only this message is lost, the connection is fine
+                    SEND_FAILURES.labels('encode').inc()
+                    log.warning(f'Could not encode a message: {e!r}')
+                    continue
+                try:
+                    await ws.send(payload)
+                except Exception as e:
+                    SEND_FAILURES.labels('outbox').inc()
+                    log.warning(f'Could not send, closing the connection: {e!r}')
+                    self.close()
+                    return
+            self._ready.clear()
+            if self._resyncing:
+                self._resyncing = False
+                if self.on_resync is not None:
+                    self.on_resync(self)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3.8
+'''
+profiler.py
+
+Sampling profiler and event loop watchdog
+
+The SamplingProfiler runs in a thread and every `interval` seconds
+takes the stack of the thread running the event loop from
+sys._current_frames(), counting how often each stack is seen. The
+loop itself does no extra work, so it can be started on a live server.
+stop() writes the counts as collapsed stacks, one line per stack:
+
+    module:function;module:function;... count
+
+which can be turned into a flame graph with flamegraph.pl or loaded
+into speedscope. The server starts and stops it on SIGUSR1:
+
+    kill -USR1 <pid>
+
+The LoopWatchdog has the loop set a heartbeat every threshold / 2
+seconds and a thread check on it. When the loop has not come back for
+longer than threshold, a single callback is blocking it, and the
+watchdog logs what it is doing (e.g. the msg_type and room being
+processed by the current task, given by get_context) with the stack of
+the loop thread, then how long the loop was blocked for once it is
+running again.
+'''
+
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+
+import util.helpers as util
+import util.log as log
+
+_frame_names = {}   # Code object -> module:function
+
+def get_frame_name(code):
+    name = _frame_names.get(code)
+    if name is None:
+        module = os.path.splitext(os.path.basename(code.co_filename))[0]
+        name = _frame_names[code] = f'{module}:{code.co_name}'
+    return name
+
+class SamplingProfiler:
+    def __init__(self, directory='.', interval=0.005):
+        self.directory = directory      # Where the profiles are written
+        self.interval = interval        # Seconds between samples
+
+        self._stacks = {}               # Tuple of code objects, outermost first -> samples
+        self._thread = None
+        self._stop = threading.Event()
+        self._thread_id = None
+        self._started = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        '''
+        Starts sampling the calling thread, i.e. the event loop
+        '''
+        if self.running:
+            return
+        self._stacks = {}
+        self._stop.clear()
+        self._thread_id = threading.get_ident()
+        self._started = time.time()
+        self._thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+        self._thread.start()
+
+    def run(self):
+        stacks = self._stacks
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            codes = []
+            while frame is not None:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            key = tuple(reversed(codes))
+            stacks[key] = stacks.get(key, 0) + 1
+
+    def stop(self):
+        '''
+        Stops sampling and writes the collapsed stacks, returns the path
+        of the profile
+        '''
+        if not self.running:
+            return None
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(
+            self.directory,
+            f'profile-{os.getpid()}-{time.strftime("%Y%m%d-%H%M%S", time.localtime(self._started))}.txt'
+        )
+        with open(path, 'w') as f:
+            for codes, count in sorted(self._stacks.items(), key=lambda s: -s[1]):
+                f.write(f'{";".join(get_frame_name(c) for c in codes)} {count}\n')
+        return path
+
+    def toggle(self):
+        if self.running:
+            path = self.stop()
+            util.print_core(f'Wrote {sum(self._stacks.values())} samples to {path}')
+        else:
+            self.start()
+            util.print_core(f'Profiling every {self.interval * 1000:g}ms')
+
+class LoopWatchdog:
+    def __init__(self, threshold=0.1, get_context=None, on_stall=None):
+        self.threshold = threshold      # Seconds a callback may block the loop for
+        self.get_context = get_context  # Called from the thread with the task running on the loop
+        self.on_stall = on_stall        # Called with the duration and context of each stall
+
+        self._interval = threshold / 2
+        self._beat = None
+        self._loop = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self, loop=None):
+        self._loop = loop or asyncio.get_event_loop()
+        self._beat = time.monotonic()
+        self._loop.call_soon(self.beat)
+        self._thread = threading.Thread(
+            target=self.run, args=(threading.get_ident(),), name='watchdog', daemon=True
+        )
+        self._thread.start()
+
+    def beat(self):
+        if not self._stop.is_set():
+            self._beat = time.monotonic()
+            self._loop.call_later(self._interval, self.beat)
+
+    def describe(self, context):
+        if context is None:
+            return 'outside of any message'
+        msg_type, room_name = context
+        return f'handling {msg_type}' + (f' in {room_name}' if room_name is not None else '')
+
+    def run(self, thread_id):
+        stalled = None      # Heartbeat the loop is stuck after
+        context = None
+        while not self._stop.wait(self._interval / 2):
+            beat = self._beat
+            if stalled is None:
+                if time.monotonic() - beat - self._interval > self.threshold:
+                    stalled = beat
+                    try:
+                        task = asyncio.current_task(self._loop)
+                        context = self.get_context(task) if self.get_context is not None else None
+                    except Exception:
+                        context = None
+                    frame = sys._current_frames().get(thread_id)
+                    stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+                    log.warning(
+                        f'The event loop has been blocked for more than {self.threshold:g}s '
+                        f'{self.describe(context)}:\n{stack}'
+                    )
+            elif beat != stalled:
+                duration = beat - stalled - self._interval
+                log.warning(f'The event loop was blocked for {duration:.3f}s {self.describe(context)}')
+                if self.on_stall is not None:
+                    self.on_stall(duration, context)
+                stalled = None
+
+    def stop(self):
+        self._stop.set()
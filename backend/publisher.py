@@ -0,0 +1,159 @@
+#!/usr/bin/env python3.8
+'''
+publisher.py
+
+Publishes the changes to the books of a room as OrderbookDeltas, and
+the changes to the positions of its players as PositionDeltas and
+PnLUpdates.
+
+The levels touched by each order are marked dirty on their instrument
+and only the latest size of each level is kept. The dirty books are
+flushed at most once per `interval` seconds, so a burst of orders on an
+instrument (e.g. everyone requoting after a card is revealed) becomes a
+single delta. With `flush_on_top` set, a change to the best bid or ask
+of any book is flushed straight away. An interval of 0 flushes after
+every order. A flush that is due is put on the queue of the room rather
+than run from the timer, so that it is ordered with the messages of the
+room and with whatever they send.
+
+Snapshots sent while changes are waiting already include them, and
+deltas carry absolute level sizes, so a client that applies a delta
+over such a snapshot ends up with the same book.
+
+Positions are throttled in the same way: the fills in an interval
+become one PositionDelta per player, holding the latest size and
+average price of each position they changed, followed by a PnLUpdate
+for each player whose PnL has moved, either from their fills or from
+a new mark of an instrument they hold.
+'''
+
+import asyncio
+
+def get_top(book):
+    '''
+    Best bid and ask of a book with their sizes
+    '''
+    bid = book.bids.best()
+    ask = book.asks.best()
+    return (
+        (bid.price, bid.size) if bid is not None else None,
+        (ask.price, ask.size) if ask is not None else None,
+    )
+
+class BookPublisher:
+    def __init__(self, room, interval=0.02, flush_on_top=True):
+        self.interval = interval            # Seconds between flushes of the dirty books
+        self.flush_on_top = flush_on_top    # Flush straight away when the top of a book changes
+
+        self._room = room
+        self._dirty = {}                    # Instrument -> {(direction, price) -> LevelChange}
+        self._tops = {}                     # Instrument -> top of its book when last published
+        self._timer = None                  # Handle of the next scheduled flush
+
+    def mark(self, level_change):
+        self._dirty.setdefault(level_change.symbol, {})[
+            (level_change.direction, level_change.price)
+        ] = level_change
+
+    def top_changed(self):
+        books = self._room._books
+        for instrument_name in self._dirty:
+            if get_top(books[instrument_name]) != self._tops.get(instrument_name):
+                return True
+        return False
+
+    async def publish(self):
+        '''
+        Called once the changes of an order have been marked, flushes
+        them now or makes sure that a flush has been scheduled
+        '''
+        if not self._dirty:
+            return
+        if self.interval <= 0 or (self.flush_on_top and self.top_changed()):
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(
+                self.interval, self._room.queue_flush, 'book'
+            )
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        dirty, self._dirty = self._dirty, {}
+        books = self._room._books
+        for instrument_name, changes in dirty.items():
+            book = books[instrument_name]
+            self._tops[instrument_name] = get_top(book)
+            delta = book.delta(changes.values())
+            delta['room'] = self._room._name
+            await self._room.tell_room(self._room.as_frame(delta, instrument_name))
+
+    def cancel(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._dirty = {}
+
+class PositionPublisher:
+    def __init__(self, room, interval=0.1):
+        self.interval = interval            # Seconds between flushes of the changed positions
+
+        self._room = room
+        self._pnl = {}                      # Player -> PnL when last published
+        self._timer = None                  # Handle of the next scheduled flush
+
+    async def publish(self):
+        '''
+        Called once the fills and marks of an order have been applied to
+        the ledger, flushes them now or makes sure that a flush has been
+        scheduled
+        '''
+        if not self._room._ledger.has_changes():
+            return
+        if self.interval <= 0:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(
+                self.interval, self._room.queue_flush, 'position'
+            )
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        ledger = self._room._ledger
+        positions, moved = ledger.changes()
+        batches = {}
+        for player_name, changes in positions.items():
+            batches[player_name] = [{
+                'type' : 'PositionDelta',
+                'room' : self._room._name,
+                'data' : changes
+            }]
+        for player_name in moved:
+            pnl = ledger.pnl(player_name)
+            if pnl == self._pnl.get(player_name):
+                continue
+            self._pnl[player_name] = pnl
+            batches.setdefault(player_name, []).append(self.as_update(player_name, pnl))
+        players = self._room._players
+        for player_name, messages in batches.items():
+            if player_name in players:
+                await players[player_name].send_message(messages)
+
+    def as_update(self, player_name, pnl=None):
+        if pnl is None:
+            pnl = self._room._ledger.pnl(player_name)
+        return {
+            'type' : 'PnLUpdate',
+            'data' : {
+                'room' : self._room._name,
+                'pnl' : pnl
+            }
+        }
+
+    def cancel(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3.8
+'''
+replay.py
+
+Offline replay of recorded order flow
+
+Feeds a recording through the MatchingEngine, Rooms and OrderBooks with
+no websocket server, as fast as it can, then reports the final books,
+the trades and positions in each room and the throughput.
+
+The recording is JSON lines (optionally gzipped) of inbound messages,
+either bare or as journal records ({"msg": ...} and {"draw": ...}), so
+the journal of a room can be replayed as it is. It is streamed, once to
+find the players and the journaled cards and once to replay it, so it
+never has to fit in memory.
+
+Recordings that only hold NewOrders and CancelOrders are set up as they
+would have been: rooms are made and their players joined before the
+game is started by the first order, and options are listed the first
+time they are traded. Their cards are dealt at random, so pass a seed
+to compare runs.
+
+Everything sent to the players goes to a Sink that counts the messages
+by type, and with `encode` also serialises them as JSON.
+
+    python manage.py replay <file> [-e] [-s 1] [-o report.json]
+'''
+
+import asyncio
+import getopt
+import gzip
+import json
+import random
+import time
+
+import backend.server as server
+import util.log as log
+
+ORDER_MESSAGES = ('NewOrder', 'CancelOrder', 'AmendOrder', 'NewOrders', 'MassCancel')
+
+class Sink:
+    '''
+    Stands in for the websockets of all the players
+    '''
+
+    relays_frames = True
+
+    def __init__(self, encode=False):
+        self.encode = encode
+        self.counts = {}        # Message type -> number sent
+        self.bytes = 0
+
+    async def send(self, payload):
+        if isinstance(payload, str):
+            msg_type = 'text'
+            if self.encode:
+                self.bytes += len(payload)
+        else:
+            msg_type = payload.get_type()
+            if self.encode:
+                self.bytes += len(payload.text)
+        self.counts[msg_type] = self.counts.get(msg_type, 0) + 1
+
+    async def close(self, code=1000, reason=''):
+        pass
+
+def read_records(path):
+    '''
+    Streams the records of a recording as (message, draw) pairs
+    '''
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if 'draw' in record:
+                yield None, tuple(record['draw'])
+            elif 'msg' in record:
+                yield record['msg'], None
+            else:
+                yield record, None
+
+def get_room_name(msg):
+    data = msg.get('data')
+    if not isinstance(data, dict):
+        return None
+    return data.get('room', data.get('name') if msg.get('type') in ('NewRoom', 'DeleteRoom') else None)
+
+def scan(path):
+    '''
+    First pass: the players trading in each room, which of them join
+    it explicitly, and the cards dealt in each room
+    '''
+    players = {}        # room -> [player names in order of appearance]
+    joined = set()      # (room, player) with a JoinRoom in the recording
+    draws = {}          # room -> [cards]
+    room_name = None
+    for msg, draw in read_records(path):
+        if draw is not None:
+            # Journaled cards follow the command that dealt them
+            draws.setdefault(room_name, []).append(draw)
+            continue
+        room_name = get_room_name(msg)
+        player_name = msg['data'].get('player') if isinstance(msg.get('data'), dict) else None
+        if room_name is None or player_name is None:
+            continue
+        if msg['type'] == 'JoinRoom':
+            joined.add((room_name, player_name))
+        room_players = players.setdefault(room_name, [])
+        if player_name not in room_players:
+            room_players.append(player_name)
+    return players, joined, draws
+
+class Replayer:
+    def __init__(self, path, encode=False):
+        self.path = path
+        self.sink = Sink(encode)
+        self.engine = server.MatchingEngine(room_options={
+            'publish_interval' : 0,
+            'position_interval' : 0,
+            'risk_interval' : None,
+        })
+        self.messages = 0
+        self.skipped = 0
+
+    def get_player(self, player_name):
+        players = self.engine._lobby._players
+        if player_name not in players:
+            players[player_name] = server.Player(player_name, '', self.sink)
+        return players[player_name]
+
+    async def setup_room(self, room_name, players, joined, draws):
+        lobby = self.engine._lobby
+        if room_name not in lobby._rooms:
+            await self.engine.new_room(room_name)
+        room = lobby.get_room(room_name)
+        room._cards.replay(draws.get(room_name, ()))
+        for player_name in players.get(room_name, ()):
+            player = self.get_player(player_name)
+            if (room_name, player_name) not in joined:
+                await room.join(player)
+                player._rooms.add(room_name)
+        return room
+
+    async def prepare_order(self, room, msg):
+        '''
+        Starts the game and lists the instrument of an order if the
+        recording did not. Returns False if the order can not be replayed.
+        '''
+        if room._status == 'waiting':
+            await room.start_game()
+        data = msg['data']
+        if 'orders' in data:
+            instruments = [o.get('instrument') for o in data['orders']]
+        else:
+            instruments = [data.get('instrument')]
+        for instrument in instruments:
+            if instrument is not None and instrument not in room._books:
+                parts = instrument.split('-')
+                if len(parts) == 3 and parts[2] in ('CALL', 'PUT'):
+                    await room.new_option(instrument, parts[2].lower(), int(parts[1]))
+                else:
+                    return False
+        return True
+
+    async def run(self):
+        players, joined, draws = scan(self.path)
+        rooms = {}
+        for room_name in players:
+            rooms[room_name] = await self.setup_room(room_name, players, joined, draws)
+
+        engine = self.engine
+        start = time.perf_counter()
+        for msg, draw in read_records(self.path):
+            if draw is not None:
+                continue
+            self.messages += 1
+            room_name = get_room_name(msg)
+            player_name = msg['data'].get('player') if isinstance(msg.get('data'), dict) else None
+            if player_name is not None:
+                self.get_player(player_name)
+            if msg.get('type') in ORDER_MESSAGES:
+                room = rooms.get(room_name)
+                if room is None:
+                    room = rooms[room_name] = await self.setup_room(room_name, players, joined, draws)
+                if not await self.prepare_order(room, msg):
+                    self.skipped += 1
+                    continue
+            try:
+                await engine.update_and_send_response(msg, self.sink)
+            except Exception as e:
+                log.warning(f'Could not replay {msg}: {e!r}')
+                self.skipped += 1
+        elapsed = time.perf_counter() - start
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        rooms = {}
+        for room_name, room in self.engine._lobby._rooms.items():
+            trades = {}
+            for t in room._trades:
+                summary = trades.setdefault(t['instrument'], {'trades' : 0, 'volume' : 0})
+                summary['trades'] += 1
+                summary['volume'] += t['size']
+            rooms[room_name] = {
+                'status' : room._status,
+                'books' : {
+                    name : {
+                        'seq' : b.seq,
+                        'top' : b.top_n(5)['data'],
+                        'live_orders' : len(b._live_orders),
+                    } for name, b in room._books.items()
+                },
+                'trades' : trades,
+                'positions' : {
+                    player_name : room._ledger.positions(player_name)
+                    for player_name in room._players if player_name in room._ledger
+                },
+                'pnl' : {
+                    player_name : room._ledger.pnl(player_name)
+                    for player_name in room._players if player_name in room._ledger
+                },
+            }
+        return {
+            'file' : self.path,
+            'messages' : self.messages,
+            'skipped' : self.skipped,
+            'seconds' : round(elapsed, 3),
+            'messages_per_sec' : round(self.messages / elapsed) if elapsed else None,
+            'sent' : dict(sorted(self.sink.counts.items())),
+            'sent_bytes' : self.sink.bytes if self.sink.encode else None,
+            'rooms' : rooms,
+        }
+
+def main(argv):
+    help_string = '''manage.py replay <file>
+        -e [--encode] <serialise what is sent as JSON>
+        -s [--seed] <random seed for cards not in the recording (none)>
+        -o [--output] <file to write the JSON report to (stdout)>'''
+    try:
+        opts, args = getopt.gnu_getopt(argv, 'hes:o:', ['encode', 'seed=', 'output='])
+    except getopt.GetoptError:
+        print(help_string)
+        return 1
+    if len(args) != 1:
+        print(help_string)
+        return 1
+
+    encode = False
+    output = None
+    for opt, arg in opts:
+        if opt == '-h':
+            print(help_string)
+            return 0
+        elif opt in ('-e', '--encode'):
+            encode = True
+        elif opt in ('-s', '--seed'):
+            random.seed(int(arg))
+        elif opt in ('-o', '--output'):
+            output = arg
+
+    log.set_level(log.WARNING)
+    report = asyncio.run(Replayer(args[0], encode).run())
+    if output is None:
+        print(json.dumps(report, indent=4))
+    else:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=4)
+        print(
+            f'Replayed {report["messages"]} messages in {report["seconds"]}s '
+            f'({report["messages_per_sec"]} messages/s)'
+        )
+    return 0
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3.8
+'''
+risk.py
+
+Scenario risk of the portfolios of the players in a room
+
+Each player knows their own cards and the cards revealed by the others.
+The rest of the cards in the game are drawn from what is left of the
+deck, from their point of view, in `scenarios` Monte Carlo samples (or
+a single scenario once every card is known), giving the settlement
+values of A and B in each scenario. The settlement value of every
+instrument in every scenario is then worked out at once as arrays:
+
+    X = S @ coefficients + constants        (scenarios x instruments)
+    value = X for A, B, the spreads and CASH
+            max(0, X - strike) for calls, max(0, strike - X) for puts
+
+and the PnL of the portfolio in each scenario is value @ sizes. A
+RiskUpdate sends each player the mean, standard deviation and 95% VaR
+of their PnL, and the deltas of each of their positions to A and B.
+
+The samples of a player are cached until the cards they know change,
+so a change of positions only redoes the matrix products. The work is
+done in a thread so the event loop is never blocked, for the players
+whose positions or known cards have changed, at most once per
+`interval` seconds.
+
+NumPy is optional, without it no RiskUpdates are sent.
+'''
+
+import asyncio
+import concurrent.futures
+import functools
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import util.helpers as util
+import util.log as log
+
+RANKS = 13          # Cards are numbered 1 to 13
+SUITS = 4
+MAX_CACHED = 256    # Samples kept for this many sets of known cards
+
+_executor = None
+_unknown = set()    # Symbols that have been reported as unknown
+
+def get_executor():
+    '''
+    A single thread shared by the rooms of the process, so the cache
+    is only ever used from one thread
+    '''
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='risk')
+    return _executor
+
+@functools.lru_cache(maxsize=None)
+def parse_instrument(symbol):
+    '''
+    The settlement value of an instrument as
+    (coefficient of A, coefficient of B, constant, strike, kind) where
+    kind is 0 for a linear instrument, 1 for a call and -1 for a put.
+    Options are named <A or B>-<strike>-<CALL or PUT>, and their strikes
+    may be decimals. Raises ValueError for any other symbol.
+    '''
+    if symbol == 'CASH':
+        return (0, 0, 1, 0, 0)
+    elif symbol == 'A':
+        return (1, 0, 0, 0, 0)
+    elif symbol == 'B':
+        return (0, 1, 0, 0, 0)
+    elif symbol == 'A - B':
+        return (1, -1, 0, 0, 0)
+    elif symbol == 'B - A':
+        return (-1, 1, 0, 0, 0)
+    underlying, strike, option_type = symbol.split('-')
+    strike = float(strike)
+    if underlying not in ('A', 'B') or option_type not in ('CALL', 'PUT') or not math.isfinite(strike):
+        raise ValueError(f'Unknown instrument: {symbol}')
+    kind = 1 if option_type == 'CALL' else -1
+    if underlying == 'A':
+        return (1, 0, 0, strike, kind)
+    return (0, 1, 0, strike, kind)
+
+def get_terms(symbols):
+    '''
+    {symbol: parse_instrument(symbol)} for the symbols that can be
+    parsed, the others are left out and reported once
+    '''
+    terms = {}
+    for s in symbols:
+        try:
+            terms[s] = parse_instrument(s)
+        except ValueError:
+            if s not in _unknown:
+                _unknown.add(s)
+                log.warning(f'Leaving out {s}, its settlement value can not be worked out')
+    return terms
+
+def get_known_cards(room, player_name=None):
+    '''
+    The cards of A and B that a player has seen: their own and the ones
+    revealed by the other players. With no player, only the revealed cards.
+    '''
+    known = {'A' : [], 'B' : []}
+    if player_name is not None:
+        own = room._player_cards[player_name]
+        known['A'].extend(own['A'])
+        known['B'].extend(own['B'])
+    for other, cards in room._revealed_cards.items():
+        if other != player_name:
+            known['A'].extend(cards['A'])
+            known['B'].extend(cards['B'])
+    return known
+
+def get_cards(room, player_name=None):
+    '''
+    What a player knows of the cards in the game as
+    (sum of known A, sum of known B, unknown A, unknown B, pool) where
+    the pool is the numbers of the cards they have not seen
+    '''
+    known = get_known_cards(room, player_name)
+    n_dealt = len(room._player_cards) * room._n_cards
+    counts = [SUITS] * (RANKS + 1)
+    for n, _ in known['A'] + known['B']:
+        counts[n] -= 1
+    return (
+        sum(n for n, _ in known['A']),
+        sum(n for n, _ in known['B']),
+        n_dealt - len(known['A']),
+        n_dealt - len(known['B']),
+        tuple(n for n in range(1, RANKS + 1) for _ in range(counts[n])),
+    )
+
+def get_view(room, player_name):
+    '''
+    Everything needed to work out the risk of a player, copied so that
+    it can be used off the event loop
+    '''
+    positions = room._ledger.positions(player_name)
+    instruments = tuple(get_terms(positions))
+    return {
+        'player' : player_name,
+        'cards' : get_cards(room, player_name),
+        'instruments' : instruments,
+        'sizes' : tuple(positions[s]['size'] for s in instruments),
+    }
+
+def sample(cards, n_scenarios, rng):
+    '''
+    Settlement values of A and B in each scenario, each of the unknown
+    cards being drawn from the pool without replacement
+    '''
+    known_a, known_b, unknown_a, unknown_b, pool = cards
+    if unknown_a + unknown_b == 0:
+        return np.array([[known_a, known_b]], dtype=float)
+    pool = np.array(pool, dtype=float)
+    order = rng.random((n_scenarios, len(pool))).argsort(axis=1)
+    drawn = pool[order[:, :unknown_a + unknown_b]]
+    return np.stack((
+        known_a + drawn[:, :unknown_a].sum(axis=1),
+        known_b + drawn[:, unknown_a:].sum(axis=1),
+    ), axis=1)
+
+def get_values(settlements, instruments):
+    '''
+    Settlement values of the instruments in each scenario and their
+    mean deltas to A and B
+    '''
+    terms = np.array([parse_instrument(s) for s in instruments], dtype=float).reshape(-1, 5)
+    coefficients, constants, strikes, kinds = terms[:, :2].T, terms[:, 2], terms[:, 3], terms[:, 4]
+    x = settlements @ coefficients + constants
+    payoffs = np.maximum(kinds * (x - strikes), 0)
+    values = np.where(kinds == 0, x, payoffs)
+    slopes = np.where(kinds == 0, 1.0, kinds * (payoffs > 0))
+    deltas = coefficients * slopes.mean(axis=0)
+    return values, deltas
+
+class RiskEngine:
+    def __init__(self, room, interval=0.5, scenarios=4096):
+        self.interval = interval            # Seconds between updates, None to turn them off
+        self.scenarios = scenarios          # Monte Carlo samples of the unknown cards
+
+        self._room = room
+        self._dirty = set()                 # Players whose risk has to be worked out again
+        self._latest = {}                   # Player -> last RiskUpdate
+        self._samples = {}                  # Known cards -> settlements, only used on the executor
+        self._timer = None
+        self._running = False
+        self._rng = np.random.default_rng() if np is not None else None
+
+    @property
+    def enabled(self):
+        return np is not None and self.interval is not None
+
+    def mark(self, player_names):
+        if self.enabled:
+            self._dirty.update(player_names)
+
+    async def publish(self):
+        if not self._dirty or self._timer is not None or self._running:
+            return
+        self._timer = asyncio.get_event_loop().call_later(
+            max(self.interval, 0), lambda: asyncio.ensure_future(self.flush())
+        )
+
+    async def flush(self):
+        self._timer = None
+        room = self._room
+        if room._status != 'started':
+            self._dirty = set()
+            return
+        views = [get_view(room, p) for p in self._dirty if p in room._ledger]
+        self._dirty = set()
+        self._running = True
+        try:
+            results = await asyncio.get_event_loop().run_in_executor(
+                get_executor(), self.compute, views
+            )
+        except Exception as e:
+            util.print_core(f'Could not work out the risk in {room._name}: {e!r}')
+            results = []
+        finally:
+            self._running = False
+        if room._status != 'started':
+            return
+        for player_name, data in results:
+            update = self._latest[player_name] = {
+                'type' : 'RiskUpdate',
+                'data' : data
+            }
+            if player_name in room._players:
+                await room._players[player_name].send_message(update)
+        await self.publish()
+
+    def compute(self, views):
+        return [(view['player'], self.evaluate(view)) for view in views]
+
+    def evaluate(self, view):
+        settlements = self._samples.get(view['cards'])
+        if settlements is None:
+            if len(self._samples) >= MAX_CACHED:
+                self._samples.clear()
+            settlements = self._samples[view['cards']] = sample(view['cards'], self.scenarios, self._rng)
+        values, deltas = get_values(settlements, view['instruments'])
+        sizes = np.array(view['sizes'], dtype=float)
+        pnl = values @ sizes
+        mean = float(pnl.mean())
+        position_deltas = deltas * sizes + 0.0      # No -0.0 for short positions
+        return {
+            'room' : self._room._name,
+            'scenarios' : len(pnl),
+            'mean' : mean,
+            'stdev' : float(pnl.std()),
+            'var_95' : mean - float(np.percentile(pnl, 5)),
+            'delta' : {
+                'A' : float(position_deltas[0].sum()),
+                'B' : float(position_deltas[1].sum()),
+            },
+            'deltas' : {
+                name : {
+                    'A' : float(position_deltas[0][i]),
+                    'B' : float(position_deltas[1][i]),
+                } for i, name in enumerate(view['instruments']) if view['sizes'][i] and name != 'CASH'
+            },
+        }
+
+    def get_update(self, player_name):
+        return self._latest.get(player_name)
+
+    def cancel(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._dirty = set()
@@ -1,21 +1,105 @@
 #!/usr/bin/env python3.8
 
 import asyncio
+import collections
+import hmac
 import json
 import random
+import signal
 import time
 import traceback
 import websockets
 
+import backend.fairvalue as fairvalue
+import backend.frame as frame
+import backend.journal as journal
+import backend.metrics as metrics
+import backend.outbox as outbox
+import backend.profiler as profiler
+import backend.publisher as publisher
+import backend.risk as risk
+import backend.wire as wire
 import structures.book as book
+import structures.ledger as ledger
+import structures.tape as tape
 import util.helpers as util
+import util.log as log
+
+# Metrics of the process, served by run() when given a metrics_port
+LATENCY = metrics.REGISTRY.histogram(
+    'mocktrading_message_seconds', 'Time taken to handle a message', ['msg_type'], max_children=64
+)
+QUEUE_DEPTH = metrics.REGISTRY.gauge(
+    'mocktrading_queue_depth', 'Messages waiting on the lobby queue and each room queue', ['queue']
+)
+CONNECTED = metrics.REGISTRY.gauge('mocktrading_connected_sockets', 'Connected websocket clients')
+ORDERS = metrics.REGISTRY.counter(
+    'mocktrading_orders_total', 'New orders sent to a book', ['room', 'instrument']
+)
+FILLS = metrics.REGISTRY.counter(
+    'mocktrading_fills_total', 'Fills, of both the resting and the aggressing order', ['room', 'instrument']
+)
+CANCELS = metrics.REGISTRY.counter(
+    'mocktrading_cancels_total', 'Orders cancelled', ['room', 'instrument']
+)
+BOOK_LEVELS = metrics.REGISTRY.gauge(
+    'mocktrading_book_levels', 'Price levels on each side of a book', ['room', 'instrument', 'side']
+)
+BOOK_SIZE = metrics.REGISTRY.gauge(
+    'mocktrading_book_size', 'Size resting on each side of a book', ['room', 'instrument', 'side']
+)
+BOOK_ORDERS = metrics.REGISTRY.gauge(
+    'mocktrading_book_orders', 'Live orders in a book', ['room', 'instrument']
+)
+LOOP_STALLS = metrics.REGISTRY.counter(
+    'mocktrading_loop_stalls_total', 'Callbacks that blocked the event loop for too long', ['msg_type'],
+    max_children=64
+)
+ROOM_METRICS = (ORDERS, FILLS, CANCELS)
+
+def is_size(value):
+    return isinstance(value, int) and not isinstance(value, bool) and 0 <= value <= wire.MAX_SIZE
+
+def is_price(value):
+    # Prices of zero or less are accepted, and cancelled by the book
+    return (
+        isinstance(value, (int, float)) and not isinstance(value, bool) and
+        abs(value) <= wire.MAX_PRICE
+    )
 
 class MatchingEngine:
-    def __init__(self):
+    # Messages that only touch the lobby, everything else is sequenced
+    # on the queue of the room named in its data
+    LOBBY_MESSAGES = ('NewRoom', 'DeleteRoom', 'NewPlayer', 'DeletePlayer')
+    # Room messages that change its state, and so are journaled
+    JOURNALED_MESSAGES = (
+        'JoinRoom', 'LeaveRoom', 'StartGame', 'RevealCard',
+        'NewInstrument', 'NewOrder', 'CancelOrder', 'AmendOrder', 'NewOrders', 'MassCancel',
+        'SettleGame'
+    )
+
+    def __init__(
+        self, slow_consumers='resync', outbox_capacity=1024, room_options=None, journal_dir=None,
+        stall_threshold=None, profile_dir='.'
+    ):
         util.print_core('Initialising...')
-        self._connected_users = set()       # A set of all the connected websocket clients
-        self._lobby = Lobby()               # Lobby of the rooms
-        self._q = asyncio.Queue()
+        self._connected_users = set()       # A set of the Outboxes of all the connected websocket clients
+        self._slow_consumers = slow_consumers   # What to do with a client that can not keep up
+        self._outbox_capacity = outbox_capacity # Messages that can wait to be sent to a client
+        self._room_options = room_options or {} # Keyword arguments for every new Room
+        self._lobby = Lobby(self._room_options) # Lobby of the rooms
+        self._q = asyncio.Queue()           # Queue of lobby messages
+        self._room_queues = {}              # Queue of messages for each room
+        self._room_consumers = {}           # Task consuming the queue of each room
+        self._lobby_pending = {}            # Last unprocessed lobby message from each client
+        self._binary_rooms = {}             # Room that each binary protocol client last joined
+        self._journal = journal.Journal(journal_dir) if journal_dir else None
+        self._processing = {}               # Consumer task -> (msg_type, room) it is processing
+        self._profiler = profiler.SamplingProfiler(profile_dir)
+        self._watchdog = (                  # Reports callbacks blocking the loop for stall_threshold seconds
+            profiler.LoopWatchdog(stall_threshold, self.get_context, self.on_stall)
+            if stall_threshold else None
+        )
 
 
     async def send_rooms(self, ws):
@@ -31,41 +115,321 @@ class MatchingEngine:
         }))
 
     async def client_handler(self, websocket, path):
-        self._connected_users.add(websocket)
+        ws = outbox.Outbox(
+            websocket,
+            capacity=self._outbox_capacity,
+            policy=self._slow_consumers,
+            on_resync=self.resync
+        )
+        self._connected_users.add(ws)
         print('-' * 60)
         util.print_core('A client has connected!')
-        await self.send_rooms(websocket)
-        await self.send_players(websocket)
+        await self.send_rooms(ws)
+        await self.send_players(ws)
         print('-' * 60)
+        message = None
         try:
-            async for _ in websocket:
-                message = await websocket.recv()
-                d = json.loads(message)
-                await self._q.put((d, websocket))
+            if wire.is_binary(websocket):
+                # Binary clients do not send an empty frame before each message
+                async for message in websocket:
+                    if isinstance(message, bytes):
+                        room_name = self._binary_rooms.get(ws)
+                        if room_name is None:
+                            util.print_core('Binary order before joining a room')
+                            continue
+                        msg = wire.decode(message, room_name)
+                        if msg is not None:
+                            self.route(msg, ws)
+                    else:
+                        self.route(json.loads(message), ws)
+            else:
+                async for _ in websocket:
+                    message = await websocket.recv()
+                    d = json.loads(message)
+                    self.route(d, ws)
                 
         except Exception:
             traceback.print_exc()
             print(message)
             util.print_core('Client unexpectedly disconnected!')
-            self._connected_users.remove(websocket)
+        finally:
+            ws.close()
+            self._connected_users.discard(ws)
+            self._lobby_pending.pop(ws, None)
+            self._binary_rooms.pop(ws, None)
+
+    def resync(self, ws):
+        '''
+        Called when the outbox of a slow client has dropped messages and
+        drained, sends the players on it fresh snapshots of their rooms
+        '''
+        for player_name, player in self._lobby._players.items():
+            if player._ws is ws:
+                for room_name in player._rooms:
+                    self.route({
+                        'type' : 'Resync',
+                        'data' : {
+                            'room' : room_name,
+                            'player' : player_name
+                        }
+                    }, ws)
+
+    def route(self, msg, ws):
+        '''
+        Puts a message on the lobby queue or on the queue of its room.
+        Messages are kept in order within each queue so rooms progress
+        independently of each other. A room message waits for any lobby
+        message sent before it by the same client (e.g. NewPlayer then
+        JoinRoom) to have been processed.
+        '''
+        if isinstance(msg, list):
+            for m in msg:
+                self.route(m, ws)
+            return
+        elif not isinstance(msg, dict):
+            util.print_core('Unknown message datatype')
+            return
 
-    async def consume(self, q: asyncio.Queue):
-        while True:
-            msg, ws = await self._q.get()
-            if isinstance(msg, dict):
-                await self.update_and_send_response(msg, ws)
+        data = msg.get('data')
+        room_name = data.get('room') if isinstance(data, dict) else None
+        if msg.get('type') == 'JoinRoom' and wire.is_binary(ws):
+            self._binary_rooms[ws] = room_name
+        if msg.get('type') in self.LOBBY_MESSAGES or room_name is None:
+            done = asyncio.get_event_loop().create_future()
+            self._lobby_pending[ws] = done
+            self._q.put_nowait((msg, ws, done))
+        else:
+            after = self._lobby_pending.get(ws)
+            if after is not None and after.done():
+                after = None
+                del self._lobby_pending[ws]
+            self.get_room_queue(room_name).put_nowait((msg, ws, after))
+
+    def get_room_queue(self, room_name):
+        if room_name not in self._room_queues:
+            q = asyncio.Queue()
+            self._room_queues[room_name] = q
+            self._room_consumers[room_name] = asyncio.create_task(
+                self.consume(q, room_name=room_name)
+            )
+        return self._room_queues[room_name]
+
+    def close_room_queue(self, room_name):
+        self._room_queues.pop(room_name, None)
+        consumer = self._room_consumers.pop(room_name, None)
+        if consumer is not None and consumer is not asyncio.current_task():
+            consumer.cancel()
+
+    def get_queue_depths(self):
+        '''
+        Number of messages waiting on the lobby queue and each room queue
+        '''
+        depths = {room_name : q.qsize() for room_name, q in self._room_queues.items()}
+        depths['lobby'] = self._q.qsize()
+        return depths
+
+    async def consume(self, q: asyncio.Queue, room_name=None):
+        task = asyncio.current_task()
+        try:
+            while True:
+                msg, ws, after = await q.get()
+                if after is not None and room_name is not None:
+                    # Shielded, as cancelling this consumer (e.g. on DeleteRoom)
+                    # must not cancel the lobby message it is waiting for
+                    await asyncio.shield(after)
+                msg_type = msg.get('type')
+                self._processing[task] = (msg_type, room_name)
+                try:
+                    if self._journal is not None and ws is not journal.REPLAY:
+                        self.write_journal(msg)
+                    start = time.perf_counter()
+                    await self.update_and_send_response(msg, ws)
+                    if isinstance(msg_type, str):
+                        LATENCY.labels(msg_type).observe(time.perf_counter() - start)
+                except Exception:
+                    traceback.print_exc()
+                    util.print_core(f'Failed to process message: {msg}')
+                finally:
+                    self._processing[task] = None
+                    if room_name is None:
+                        after.set_result(None)
+
+                if room_name is not None and q.empty() and room_name not in self._lobby._rooms:
+                    # The room does not exist (or has been deleted)
+                    self.close_room_queue(room_name)
+                    return
+        finally:
+            self._processing.pop(task, None)
+
+    def get_context(self, task):
+        '''
+        The msg_type and room being processed by a task, if it is a
+        consumer. Called by the watchdog from its thread.
+        '''
+        return self._processing.get(task)
+
+    def on_stall(self, duration, context):
+        msg_type = context[0] if context is not None else None
+        LOOP_STALLS.labels(msg_type if isinstance(msg_type, str) else 'none').inc()
+
+    def toggle_profiler(self):
+        '''
+        Starts the sampling profiler, or stops it and writes the profile
+        '''
+        self._profiler.toggle()
+
+    def start_watchdog(self):
+        if self._watchdog is not None:
+            self._watchdog.start()
+
+    async def new_room(self, name, replaying=False):
+        if self._lobby.new_room(name):
+            self.open_room(name, replaying)
+            return 1
+        return 0
 
-            elif isinstance(msg, list):
-                for m in msg:
-                    await self.update_and_send_response(m, ws)
-            
-            else:
-                util.print_core('Unknown message datatype')
+    async def delete_room(self, name, replaying=False):
+        if self._lobby.delete_room(name):
+            self.close_room_queue(name)
+            self.close_room(name, replaying)
+            return 1
+        return 0
+
+    def open_room(self, name, replaying=False):
+        '''
+        Called once a room has been made, journals the cards dealt in it
+        and has its publishers flush from its queue. A room made again
+        under the name of a deleted one starts a new journal, unless the
+        lobby journal is being replayed, in which case the journal of the
+        room is that of its last incarnation.
+        '''
+        self._lobby.get_room(name).post = lambda msg: self.route(msg, journal.REPLAY)
+        if self._journal is not None:
+            key = journal.room_key(name)
+            if not replaying:
+                self.remove_journal(name)
+            self._lobby.get_room(name)._cards.on_deal = (
+                lambda card: self._journal.append(key, {'draw' : card})
+            )
+
+    def close_room(self, name, replaying=False):
+        # Replaying the deletion of an earlier incarnation of a room must
+        # not remove the journal of the room made after it
+        if not replaying:
+            self.remove_journal(name)
+        for m in ROOM_METRICS:
+            m.remove(name)
+
+    def collect_metrics(self):
+        '''
+        Sets the gauges from the state of the engine and collects all
+        the metrics of the process
+        '''
+        QUEUE_DEPTH.clear()
+        for queue, depth in self.get_queue_depths().items():
+            QUEUE_DEPTH.labels(queue).set(depth)
+        CONNECTED.labels().set(len(self._connected_users))
+        for m in (BOOK_LEVELS, BOOK_SIZE, BOOK_ORDERS):
+            m.clear()
+        for room_name, room in self._lobby._rooms.items():
+            for instrument_name, b in room._books.items():
+                for side, ladder in (('bid', b.bids), ('ask', b.asks)):
+                    BOOK_LEVELS.labels(room_name, instrument_name, side).set(len(ladder))
+                    BOOK_SIZE.labels(room_name, instrument_name, side).set(
+                        sum(pp.get_size() for pp in ladder)
+                    )
+                BOOK_ORDERS.labels(room_name, instrument_name).set(len(b._live_orders))
+        return metrics.REGISTRY.collect()
+
+    async def get_metrics(self):
+        return self.collect_metrics()
+
+    def remove_journal(self, room_name):
+        if self._journal is not None:
+            self._journal.remove(journal.room_key(room_name))
+
+    def write_journal(self, msg):
+        '''
+        Journals a message that changes the lobby or a room. Messages that
+        can not change anything (e.g. for a room that does not exist, or
+        logins) are left out, and passwords are only journaled hashed.
+        '''
+        msg_type = msg.get('type')
+        data = msg.get('data')
+        if not isinstance(data, dict):
+            return
+        if msg_type in self.LOBBY_MESSAGES:
+            name = data.get('name')
+            if msg_type == 'NewRoom' and name in self._lobby._rooms:
+                return
+            elif msg_type == 'DeleteRoom' and name not in self._lobby._rooms:
+                return
+            elif msg_type == 'NewPlayer':
+                # A login only changes the player's socket
+                if name in self._lobby._players or 'password' not in data:
+                    return
+                msg = {
+                    'type' : msg_type,
+                    'data' : {
+                        'name' : name,
+                        'password_hash' : util.hash_password(name, data.get('password'))
+                    }
+                }
+            elif msg_type == 'DeletePlayer' and name not in self._lobby._players:
+                return
+            self._journal.append(journal.LOBBY, {'msg' : msg})
+        elif msg_type in self.JOURNALED_MESSAGES:
+            room_name = data.get('room')
+            if isinstance(room_name, str) and room_name in self._lobby._rooms:
+                self._journal.append(journal.room_key(room_name), {'msg' : msg})
+
+    async def recover(self):
+        '''
+        Rebuilds the lobby and then every room from the journal, before
+        any client has connected
+        '''
+        if self._journal is None:
+            return
+        start = time.perf_counter()
+        n = 0
+        for record in self._journal.read(journal.LOBBY):
+            self.route(record['msg'], journal.REPLAY)
+            n += 1
+        done = self._lobby_pending.get(journal.REPLAY)
+        if done is not None:
+            await done
+        for room_name in self._lobby.get_rooms():
+            n += await self.recover_room(room_name)
+        util.print_core(
+            f'Recovered {len(self._lobby._rooms)} rooms from {n} journal records '
+            f'in {time.perf_counter() - start:.3f}s'
+        )
+
+    async def recover_room(self, room_name):
+        '''
+        Processes the journaled commands of a room again, dealing the
+        journaled cards. Returns the number of records.
+        '''
+        start = time.perf_counter()
+        records = list(self._journal.read(journal.room_key(room_name)))
+        room = self._lobby.get_room(room_name)
+        room._cards.replay(tuple(r['draw']) for r in records if 'draw' in r)
+        for r in records:
+            if 'msg' in r:
+                try:
+                    await self.update_and_send_response(r['msg'], journal.REPLAY)
+                except Exception:
+                    traceback.print_exc()
+                    util.print_core(f'Failed to replay message: {r["msg"]}')
+        util.print_core(
+            f'Recovered {room_name} from {len(records)} journal records '
+            f'in {time.perf_counter() - start:.3f}s'
+        )
+        return len(records)
 
     async def update_and_send_response(self, msg, ws):
         if isinstance(msg, dict):
             msg_json = msg
-            msg = json.dumps(msg)
         elif isinstance(msg, str):
             msg_json = json.loads(msg)
 
@@ -77,7 +441,7 @@ class MatchingEngine:
 
         response  = []
         if msg_type == 'NewRoom':
-            if self._lobby.new_room(msg_json['data']['name']):
+            if await self.new_room(msg_json['data']['name'], ws is journal.REPLAY):
                 response = [
                     {
                         'type' : 'Info',
@@ -94,7 +458,7 @@ class MatchingEngine:
                     'status' : 'Failed to create new room - duplicate name'
                 }
         elif msg_type == 'DeleteRoom':
-            if self._lobby.delete_room(msg_json['data']['name']):
+            if await self.delete_room(msg_json['data']['name'], ws is journal.REPLAY):
                 response = [
                     {
                         'type' : 'Info',
@@ -112,8 +476,11 @@ class MatchingEngine:
                 }
         elif msg_type == 'NewPlayer':
             name = msg_json['data']['name']
-            password = msg_json['data']['password']
-            c = await self._lobby.new_player(name, password, ws)
+            if ws is journal.REPLAY and 'password_hash' in msg_json['data']:
+                password_hash = msg_json['data']['password_hash']
+            else:
+                password_hash = util.hash_password(name, msg_json['data']['password'])
+            c = await self._lobby.new_player(name, password_hash, ws)
             if c:
                 response = [
                     {
@@ -204,6 +571,8 @@ class MatchingEngine:
 
         elif msg_type == 'NewOrder':
             room = self._lobby.get_room(msg_json['data']['room'])
+            if not room.resolve_ids(msg_json['data']):
+                return
             player_name = msg_json['data']['player']
             instrument = msg_json['data']['instrument']
             price = msg_json['data']['price']
@@ -212,11 +581,64 @@ class MatchingEngine:
             await room.new_order(instrument, player_name, price, size, direction)
         elif msg_type == 'CancelOrder':
             room = self._lobby.get_room(msg_json['data']['room'])
+            if not room.resolve_ids(msg_json['data']):
+                return
             player_name = msg_json['data']['player']
             instrument = msg_json['data']['instrument']
-            direction = msg_json['data']['direction']
-            price = msg_json['data']['price']
-            await room.cancel_order(instrument, player_name, int(price), direction)
+            if msg_json['data'].get('order_id') is not None:
+                await room.cancel_order(
+                    instrument, player_name, order_id=msg_json['data']['order_id']
+                )
+            else:
+                direction = msg_json['data']['direction']
+                price = msg_json['data']['price']
+                await room.cancel_order(instrument, player_name, int(price), direction)
+        elif msg_type == 'AmendOrder':
+            room = self._lobby.get_room(msg_json['data']['room'])
+            if not room.resolve_ids(msg_json['data']):
+                return
+            await room.amend_order(
+                msg_json['data']['instrument'],
+                msg_json['data']['player'],
+                msg_json['data']['order_id'],
+                msg_json['data'].get('price'),
+                msg_json['data'].get('size')
+            )
+        elif msg_type == 'NewOrders':
+            room = self._lobby.get_room(msg_json['data']['room'])
+            await room.new_orders(msg_json['data']['player'], msg_json['data']['orders'])
+        elif msg_type == 'MassCancel':
+            room = self._lobby.get_room(msg_json['data']['room'])
+            await room.mass_cancel(
+                msg_json['data']['player'],
+                msg_json['data'].get('instrument'),
+                msg_json['data'].get('direction')
+            )
+        elif msg_type == 'GetBook':
+            room = self._lobby.get_room(msg_json['data']['room'])
+            player_name = msg_json['data']['player']
+            instrument = msg_json['data'].get('instrument')
+            if instrument is None:
+                await room.send_books(specific_player=player_name)
+            else:
+                await room.send_book(instrument, specific_player=player_name)
+        elif msg_type == 'GetTrades':
+            room = self._lobby.get_room(msg_json['data']['room'])
+            player_name = msg_json['data']['player']
+            from_seq = msg_json['data'].get('from_seq', 1)
+            limit = msg_json['data'].get('limit', tape.TradeTape.MAX_PAGE)
+            await room.send_trades(player_name, from_seq, limit)
+        elif msg_type == 'GetFairValues':
+            room = self._lobby.get_room(msg_json['data']['room'])
+            await room.send_fair_values(msg_json['data']['player'])
+        elif msg_type == 'Resync':
+            room = self._lobby.get_room(msg_json['data']['room'])
+            await room.resync(msg_json['data']['player'])
+        elif msg_type == 'Recover' and ws is journal.REPLAY:
+            await self.recover_room(msg_json['data']['room'])
+        elif msg_type == 'Flush' and ws is journal.REPLAY:
+            room = self._lobby.get_room(msg_json['data']['room'])
+            await room.flush(msg_json['data']['publisher'])
         elif msg_type == 'SettleGame':
             room = self._lobby.get_room(msg_json['data']['room'])
             await room.settle_game()
@@ -231,34 +653,39 @@ class MatchingEngine:
         if isinstance(msg, list):
             for m in msg:
                 await self.broadcast(m)
-        elif isinstance(msg, str):
-            await self.broadcast(msg)
-        elif isinstance(msg, dict):
-            for ws in self._connected_users.copy():
-                try:
-                    await ws.send(json.dumps(msg))
-                except:
-                    if ws in self._connected_users:
-                        self._connected_users.discard(ws)
-                        # util.print_core('Could not send, removing ws')
-                    else:
-                        pass
-
-    async def run(self, port='8887', host='localhost'):
-        util.print_core(f'Starting server on port {port}')
-        await websockets.server.serve(self.client_handler, host, port)
+        elif isinstance(msg, (str, dict, frame.Frame)):
+            for ws in await frame.fan_out(msg, self._connected_users.copy()):
+                outbox.SEND_FAILURES.labels('broadcast').inc()
+                self._connected_users.discard(ws)
 
+    async def run(self, port='8887', host='localhost', metrics_port=None):
         consumer = asyncio.create_task(self.consume(self._q))
+        self.start_watchdog()
+        if hasattr(signal, 'SIGUSR1'):
+            asyncio.get_event_loop().add_signal_handler(signal.SIGUSR1, self.toggle_profiler)
+        await self.recover()
+        if metrics_port is not None:
+            await metrics.serve(self.get_metrics, 'localhost', metrics_port)
+
+        util.print_core(f'Starting server on port {port}')
+        await websockets.server.serve(
+            self.client_handler, host, port, subprotocols=[wire.SUBPROTOCOL]
+        )
         await asyncio.gather(consumer)
 
-async def main(port='8887', host='localhost'):
-    server = MatchingEngine()
-    await server.run(port=port, host=host)
+async def main(port='8887', host='localhost', workers=0, metrics_port=None, **kwargs):
+    if workers > 0:
+        from backend.workers import Gateway
+        server = Gateway(workers, **kwargs)
+    else:
+        server = MatchingEngine(**kwargs)
+    await server.run(port=port, host=host, metrics_port=metrics_port)
 
 class Lobby:
-    def __init__(self):
+    def __init__(self, room_options=None):
         self._rooms = {}
         self._players = {}
+        self._room_options = room_options or {}
 
     def new_room(self, name):
         if name in self._rooms.keys():
@@ -266,20 +693,23 @@ class Lobby:
             return 0
         else:
             util.print_core('Making a new room')
-            self._rooms[name] = Room(name)
+            self._rooms[name] = Room(name, **self._room_options)
             return 1
 
     def delete_room(self, name):
         if name in self._rooms.keys() and self._rooms[name]._status == 'waiting':
+            self._rooms[name]._publisher.cancel()
+            self._rooms[name]._position_publisher.cancel()
+            self._rooms[name]._risk.cancel()
             del self._rooms[name]
             return 1
         else:
             return 0
 
-    async def new_player(self, player_name, password, ws):
+    async def new_player(self, player_name, password_hash, ws):
         if player_name in self._players.keys():
             util.print_core('Player already exists - attempting login')
-            if self._players[player_name]._password == password:
+            if hmac.compare_digest(self._players[player_name]._password_hash, password_hash):
                 self._players[player_name].update_ws(ws)
                 await self._players[player_name].send_message({
                     'type' : 'PlayerDetails',
@@ -291,7 +721,7 @@ class Lobby:
                 return 0
         else:
             util.print_core(f'Creating player: {player_name}')
-            self._players[player_name] = Player(player_name, password, ws)
+            self._players[player_name] = Player(player_name, password_hash, ws)
             await self._players[player_name].send_message(
                 {
                     'type' : 'PlayerDetails',
@@ -325,9 +755,9 @@ class Lobby:
             return self._players[key]
 
 class Player:
-    def __init__(self, name, password, ws):
+    def __init__(self, name, password_hash, ws):
         self._player_name = name
-        self._password = password
+        self._password_hash = password_hash
         self._ws = ws
         self._player_id = util.hash_string(name)
         self._rooms = set()
@@ -358,16 +788,18 @@ class Player:
         return 0
 
     async def send_message(self, msg):
+        '''
+        Sends a str, dict or Frame (or a list of them) to the player
+        '''
         try:
-            if isinstance(msg, str):
-                await self._ws.send(msg)
-            elif isinstance(msg, list):
+            if isinstance(msg, list):
                 for m in msg:
-                    await self._ws.send(m)
+                    await self._ws.send(frame.encode(m, self._ws))
             else:
-                await self._ws.send(json.dumps(msg))
-        except:
-            util.print_core('Could not send!')
+                await self._ws.send(frame.encode(msg, self._ws))
+        except Exception as e:
+            outbox.SEND_FAILURES.labels('send_message').inc()
+            log.warning(f'Could not send to {self._player_name}: {e!r}')
 
 class CardDeck:
     def __init__(self):
@@ -376,21 +808,42 @@ class CardDeck:
         for i in range(1, 14):
             for suit in ['S', 'H', 'C', 'D']:
                 self._remaining_cards.append((i, suit))
+        self._replay = collections.deque()  # Journaled cards to deal again, in order
+        self.on_deal = None                 # Called with each card dealt at random
     
+    def replay(self, cards):
+        self._replay.extend(cards)
+
     def deal(self):
+        if self._replay:
+            card = self._replay.popleft()
+            self._remaining_cards.remove(card)
+            return card
         random.shuffle(self._remaining_cards)
-        return self._remaining_cards.pop()
+        card = self._remaining_cards.pop()
+        if self.on_deal is not None:
+            self.on_deal(card)
+        return card
 
 class Room:
-    def __init__(self, name):
+    def __init__(
+        self, name, publish_interval=0.02, publish_on_top=True, position_interval=0.1,
+        risk_interval=0.5, risk_scenarios=4096
+    ):
         self._name = name                   # Name of the room
         self._status = 'waiting'
         self._players = {}                  # Members of the room
 
         self._instruments = []              # Instruments
+        self._instrument_ids = {}           # Instrument -> its index in _instruments
         self._books = {}                    # A book of open orders for each instrument
-        self._trades = []                   # A list of trades for each user
-        self._positions = {}
+        self._trades = tape.TradeTape()     # Sequenced tape of the trades in the room
+        self._publisher = publisher.BookPublisher(self, publish_interval, publish_on_top)
+        self._ledger = ledger.PositionLedger()  # Positions and PnL of the players
+        self._position_publisher = publisher.PositionPublisher(self, position_interval)
+        self._risk = risk.RiskEngine(self, risk_interval, risk_scenarios)
+        self._fair_values = fairvalue.FairValues(self)
+        self.post = None                    # Puts a message on the queue of the room, set by the engine
         
         self._cards = CardDeck()
         self._player_cards = {}
@@ -400,12 +853,60 @@ class Room:
         self._settlement_value = {}
     
     async def tell_room(self, msg):
-        for _, player in self._players.items():
-            try:
-                await player.send_message(json.dumps(msg))
-            except:
-                util.print_core('Could not send!')
-            
+        '''
+        Sends the same message to every player in the room,
+        it is only serialised once
+        '''
+        f = frame.Frame.of(msg)
+        await asyncio.gather(*(player.send_message(f) for player in self._players.values()))
+
+    def queue_flush(self, publisher_name):
+        '''
+        Called when the timer of a publisher fires, flushes it from the
+        queue of the room so that it is ordered with the room's messages
+        '''
+        if self.post is None:
+            asyncio.ensure_future(self.flush(publisher_name))
+        else:
+            self.post({
+                'type' : 'Flush',
+                'data' : {
+                    'room' : self._name,
+                    'publisher' : publisher_name
+                }
+            })
+
+    async def flush(self, publisher_name):
+        if publisher_name == 'book':
+            await self._publisher.flush()
+        elif publisher_name == 'position':
+            await self._position_publisher.flush()
+
+    def as_frame(self, msg, instrument_name):
+        '''
+        Wraps a message about an instrument in a Frame that
+        carries the instrument id for the binary protocol
+        '''
+        return frame.Frame(msg, self._instrument_ids.get(instrument_name))
+
+    def resolve_ids(self, data):
+        '''
+        Fills in the player and instrument names of a message
+        decoded from the binary protocol from their ids, returns
+        False if an id is not one of this room's
+        '''
+        try:
+            if 'player' not in data and 'player_id' in data:
+                data['player'] = list(self._players)[data['player_id']]
+            if 'instrument' not in data and 'instrument_id' in data:
+                data['instrument'] = self._instruments[data['instrument_id']]
+        except IndexError:
+            util.print_core(
+                f'Unknown player {data.get("player_id")} or instrument '
+                f'{data.get("instrument_id")} in {self._name}'
+            )
+            return False
+        return True
 
     async def join(self, player: Player):
         person_name = player._player_name
@@ -423,10 +924,10 @@ class Room:
             })
             await self.send_cards()
             await self.send_revealed_cards()
-            await self.send_books()
+            await self.send_books(specific_player=person_name)
             await self.send_instruments()
             await self.send_positions()
-            await self.send_trades()
+            await self.send_trades(person_name)
             await self.send_orders(person_name)
             return 1
         else:
@@ -441,6 +942,51 @@ class Room:
             })
             return 1
 
+    async def resync(self, player_name):
+        '''
+        Sends a player everything they need to rebuild their view of the
+        room, after their connection has dropped messages
+        '''
+        if player_name not in self._players:
+            return
+        player = self._players[player_name]
+        await player.send_message({
+            'type' : 'RoomPlayersUpdate',
+            'data' : {
+                'room' : self._name,
+                'players' : list(self._players.keys())
+            }
+        })
+        if self._status == 'waiting':
+            return
+        await player.send_message([
+            {
+                'type' : 'GameStart',
+                'room' : self._name,
+                'data' : {
+                    'cards' : self._player_cards[player_name]
+                }
+            },
+            {
+                'type' : 'RevealedCards',
+                'room' : self._name,
+                'data' : self._revealed_cards,
+            },
+            {
+                'type' : 'InstrumentsUpdate',
+                'room' : self._name,
+                'data' : self._instruments
+            },
+        ])
+        await self.send_books(specific_player=player_name)
+        await self.send_positions(specific_player=player_name)
+        risk_update = self._risk.get_update(player_name)
+        if risk_update is not None:
+            await player.send_message(risk_update)
+        await self.send_fair_values(player_name)
+        await self.send_trades(player_name)
+        await self.send_orders(player_name)
+
     async def leave(self, person_name):
         if self._status == 'waiting' and person_name in self._players.keys():
             del self._players[person_name]
@@ -459,38 +1005,82 @@ class Room:
         else:
             return 0
 
-    async def update_positions(self, player_name, instrument_name, price, size, ask_bid):
-        util.print_core(f'Updating positions for {player_name}')
-        prev_size = self._positions[player_name][instrument_name]['size']
-        prev_average = self._positions[player_name][instrument_name]['average_price']
-        if ask_bid == 'bid':
-            self._positions[player_name]['CASH']['size'] -= price * size
-            self._positions[player_name][instrument_name]['size'] += size
-            if size + prev_size == 0:
-                self._positions[player_name][instrument_name]['average_price'] = 0
-            else:
-                self._positions[player_name][instrument_name]['average_price'] = ((prev_size * prev_average) + (size * price)) / (size + prev_size)
-        elif ask_bid == 'ask':
-            self._positions[player_name]['CASH']['size'] += price * size
-            self._positions[player_name][instrument_name]['size'] -= size
-            if prev_size - size == 0:
-                self._positions[player_name][instrument_name]['average_price'] = 0
+    def new_trade(self, instrument_name, price, size, direction):
+        trade = self._trades.append(instrument_name, price, size, direction)
+        return {
+            'type' : 'TradeUpdate',
+            'room' : self._name,
+            'data' : trade
+        }
+
+    async def dispatch(self, events):
+        '''
+        Applies the events returned by an OrderBook to the ledger and the
+        trade tape, then publishes the results. Each player is sent one
+        batch holding the latest state of each of their touched orders
+        and their fills. Level changes go to the publisher, which
+        conflates them into OrderbookDeltas, and the touched books are
+        marked at their mid prices for the PnL of the players.
+        '''
+        orders = {}         # (instrument, order_id) -> Order
+        fills = {}          # player_name -> [Fill messages]
+        trades = []
+        touched = set()     # Instruments with changed levels
+        for e in events:
+            if isinstance(e, book.Fill):
+                order = e.order
+                player_name = order.get_player_name()
+                instrument_name = order.get_instrument()
+                orders[(instrument_name, order.get_order_id())] = order
+                FILLS.labels(self._name, instrument_name).inc()
+                self._ledger.fill(
+                    player_name, instrument_name, e.price, e.size, order.get_direction()
+                )
+                fills.setdefault(player_name, []).append(self.as_frame({
+                    'type' : 'Fill',
+                    'room' : self._name,
+                    'data' : {
+                        'instrument' : instrument_name,
+                        'order_id' : order.get_order_id(),
+                        'price' : e.price,
+                        'size' : e.size,
+                        'direction' : 'buy' if order.get_direction() == 'bid' else 'sell'
+                    }
+                }, instrument_name))
+                if e.aggressor:
+                    trades.append(self.as_frame(self.new_trade(
+                        instrument_name, e.price, e.size, order.get_direction()
+                    ), instrument_name))
+            elif isinstance(e, book.OrderState):
+                orders[(e.order.get_instrument(), e.order.get_order_id())] = e.order
+                if e.order.get_status() == 'cancelled':
+                    CANCELS.labels(self._name, e.order.get_instrument()).inc()
+            elif isinstance(e, book.LevelChange):
+                self._publisher.mark(e)
+                touched.add(e.symbol)
             else:
-                self._positions[player_name][instrument_name]['average_price'] = ((prev_size * prev_average) - (size * price)) / (prev_size - size)
-        else:
-            util.print_core('Something bad happened!')
-
-        await self.send_positions(specific_player=player_name)
+                util.print_core(f'Unknown event: {e}')
 
-    async def new_trade(self, instrument_name, price, size, direction):
-        self._trades.append({
-            'price' : price,
-            'size' : size,
-            'direction' : direction,
-            'instrument' : instrument_name,
-            'timestamp' : time.time()
-        })
-        await self.send_trades()
+        batches = {}
+        for order in orders.values():
+            batches.setdefault(order.get_player_name(), []).append(
+                self.as_frame(self.get_order_update(order), order.get_instrument())
+            )
+        for player_name, messages in fills.items():
+            batches.setdefault(player_name, []).extend(messages)
+        for instrument_name in touched:
+            bid, ask = self._books[instrument_name].get_quote()
+            if bid is not None:
+                self._ledger.mark(instrument_name, (bid.price + ask.price) / 2)
+
+        for player_name, messages in batches.items():
+            await self._players[player_name].send_message(messages)
+        await self._publisher.publish()
+        for trade in trades:
+            await self.tell_room(trade)
+        await self._position_publisher.publish()
+        self._risk.mark(fills)
+        await self._risk.publish()
 
     async def start_game(self):
         if self._status == 'started':
@@ -516,11 +1106,7 @@ class Room:
                     self._player_cards[player_name][s].append(card)
                     self._settlement_value[s] += card[0]
 
-            self._positions[player_name] = {}
-            self._positions[player_name]['CASH'] = {
-                'size' : 0,
-                'average_price' : 1
-            }
+            self._ledger.add_player(player_name)
         
         await self.send_cards()
 
@@ -542,26 +1128,46 @@ class Room:
         else:
             underlying, strike, option_type = symbol.split('-')
             if option_type == 'CALL':
-                v = max(0, self._settlement_value[underlying] - int(strike))
+                v = max(0, self._settlement_value[underlying] - float(strike))
                 util.print_core(f'SUM:{self._settlement_value[underlying]} {underlying}-{strike}-CALL: {v}')
                 return v
             elif option_type == 'PUT':
-                return max(0, int(strike) - self._settlement_value[underlying])
+                return max(0, float(strike) - self._settlement_value[underlying])
             else:
                 util.print_core(f'Unknown symbol: {symbol}')
 
+    def get_bounds(self, symbol):
+        '''
+        The range that the settlement value of an instrument can take.
+        Used to preallocate the price ladders of the books.
+        '''
+        n = len(self._players) * self._n_cards
+        if symbol in ('A', 'B'):
+            return (n * 1, n * 13)
+        elif symbol in ('A - B', 'B - A'):
+            return (0, n * 12)
+        else:
+            underlying, strike, option_type = symbol.split('-')
+            low, high = self.get_bounds(underlying)
+            if option_type == 'CALL':
+                return (0, max(0, high - float(strike)))
+            else:
+                return (0, max(0, float(strike) - low))
+
     async def settle_game(self):
         pnl = {}
         for player_name in self._players.keys():
             pnl[player_name] = 0
-            for symbol, details in self._positions[player_name].items():
+            for symbol, details in self._ledger.positions(player_name).items():
                 pnl[player_name] += details['size'] * self.get_value(symbol)
         values = {i:self.get_value(i) for i in self._instruments}
         util.print_core(f'The game settled with values: {values}')
         util.print_core(f'The pnl is: {pnl}')
         self._status = 'settled'
+        self._risk.cancel()
         await self.tell_room({
             'type' : 'Settlement',
+            'room' : self._name,
             'data' : pnl
         })
 
@@ -582,9 +1188,13 @@ class Room:
                 self._revealed_cards[player_name]['B'].append(card)
         await self.tell_room({
             'type' : 'RevealedCards',
+            'room' : self._name,
             'data' : self._revealed_cards,
         })
         util.print_core(f'Revealing cards {self._revealed_cards}')
+        self._risk.mark(self._players)
+        await self._risk.publish()
+        await self._fair_values.update()
 
     async def init_underlying(self):
         if self._settlement_value['A'] >= self._settlement_value['B']:
@@ -594,30 +1204,41 @@ class Room:
         for s in ('A', 'B', spread):
             name = s
             util.print_core(f'The instrument, {name} has been initialised!')
+            self._instrument_ids[name] = len(self._instruments)
             self._instruments.append(name)
-            self._books[name] = book.OrderBook(name, 1)
+            self._books[name] = book.OrderBook(name, 1, *self.get_bounds(name))
+            self._ledger.add_instrument(name)
             await self.send_instruments()
-            for player_name in self._players.keys():
-                self._positions[player_name][name] = {
-                    'size' : 0,
-                    'average_price' : 0,
-                }
+            await self.tell_room(self.get_book_update(name))
         await self.send_positions()
+        await self._fair_values.update()
+
+    def is_valid_option(self, name, option_type, strike):
+        '''
+        Whether the name of an option is one that its value can be
+        worked out from, with the same strike and type
+        '''
+        try:
+            terms = risk.parse_instrument(name)
+        except (ValueError, AttributeError):
+            return False
+        return (
+            is_price(strike) and strike > 0 and terms[3] == strike and
+            isinstance(option_type, str) and terms[4] == {'CALL' : 1, 'PUT' : -1}.get(option_type.upper())
+        )
 
     async def new_option(self, name, option_type, strike):
-        if strike is not None and strike > 0:
+        if self.is_valid_option(name, option_type, strike):
             if name not in self._instruments:
                 util.print_core(f'The option, {name} has been initialised!')
+                self._instrument_ids[name] = len(self._instruments)
                 self._instruments.append(name)
-                self._books[name] = book.OrderBook(name, 1)
+                self._books[name] = book.OrderBook(name, 1, *self.get_bounds(name))
+                self._ledger.add_instrument(name)
                 await self.send_instruments()
-                for player_name in self._players.keys():
-                    self._positions[player_name][name] = {
-                        'size' : 0,
-                        'average_price' : 0,
-                    }
-
+                await self.tell_room(self.get_book_update(name))
                 await self.send_positions()
+                await self._fair_values.add_instrument(name)
             else:
                 util.print_core(f'Could not initialise option (already exists)!')
                 await self.tell_room({
@@ -626,37 +1247,104 @@ class Room:
                 })
 
         else:
-            util.print_core(f'Could not initialise option (likely None type)!')
+            util.print_core(f'Could not initialise option {name!r} with strike {strike!r}!')
             await self.tell_room({
                 'type' : 'Info',
                 'status' : 'Unable to create option'
             })
 
+    def is_valid_order(self, instrument_name, price, size, direction):
+        '''
+        Whether an order has a listed instrument, a side, a whole
+        positive size and a numeric price, that fit in a binary record
+        '''
+        return (
+            instrument_name in self._books and
+            direction in ('bid', 'ask') and
+            is_size(size) and size > 0 and
+            is_price(price)
+        )
+
     async def new_order(self, instrument_name, player_name, price, size, direction):
-        if price is None or size is None or direction is None:
+        if not self.is_valid_order(instrument_name, price, size, direction):
             await self.tell_room({'type': 'Info', 'status' : 'Invalid order params'})
             return
-        util.print_core(f'Sending new order to the book for {instrument_name}')
-        book = self._books[instrument_name]
-        await book.new_order({
-            'room' : self,
-            'player' : self._players[player_name],
+        if log.DEBUG_ON:
+            log.debug(f'Sending new order to the book for {instrument_name}')
+        ORDERS.labels(self._name, instrument_name).inc()
+        events = self._books[instrument_name].new_order(
+            self.as_order(instrument_name, player_name, price, size, direction)
+        )
+        await self.dispatch(events)
+
+    async def amend_order(self, instrument_name, player_name, order_id, price=None, size=None):
+        # A size of zero cancels the order
+        if (
+            instrument_name not in self._books or not is_size(order_id) or
+            (price is not None and not is_price(price)) or
+            (size is not None and not (is_size(size) and size >= 0))
+        ):
+            await self.tell_room({'type': 'Info', 'status' : 'Invalid order params'})
+            return
+        events = self._books[instrument_name].amend_order(order_id, price, size, player_name)
+        await self.dispatch(events)
+
+    def as_order(self, instrument_name, player_name, price, size, direction):
+        return {
+            'player' : self._players[player_name]._player_name,
             'price' : price,
             'size' : size,
             'direction' : direction,
             'instrument' : instrument_name
-        })
-        await self.send_books()
-        
-    async def cancel_order(self, instrument_name, player_name, price, direction):
+        }
+
+    async def new_orders(self, player_name, orders):
+        '''
+        Sends a batch of orders to their books one after the other and
+        publishes the results once. The batch is rejected as a whole if
+        any of its orders is invalid.
+        '''
+        for o in orders:
+            if not isinstance(o, dict) or not self.is_valid_order(
+                o.get('instrument'), o.get('price'), o.get('size'), o.get('direction')
+            ):
+                await self.tell_room({'type': 'Info', 'status' : 'Invalid order params'})
+                return
+        events = []
+        for o in orders:
+            ORDERS.labels(self._name, o['instrument']).inc()
+            events += self._books[o['instrument']].new_order(self.as_order(
+                o['instrument'], player_name, o['price'], o['size'], o['direction']
+            ))
+        await self.dispatch(events)
+
+    async def mass_cancel(self, player_name, instrument_name=None, direction=None):
+        '''
+        Cancels all of the orders of a player in every book, or only in
+        one of them, optionally only on one side
+        '''
+        if instrument_name is None:
+            books = self._books.values()
+        else:
+            books = [self._books[instrument_name]]
+        events = []
+        for book in books:
+            events += book.cancel_player_orders(player_name, direction)
+        await self.dispatch(events)
+
+    async def cancel_order(self, instrument_name, player_name, price=None, direction=None, order_id=None):
         book = self._books[instrument_name]
-        await book.cancel_order(player_name, price, direction)
-        await self.send_books()
+        if order_id is not None:
+            events = book.cancel_order_id(int(order_id), player_name)
+        else:
+            events = book.cancel_order(player_name, price, direction)
+        await self.dispatch(events)
 
     async def send_cards(self):
         for player_name, player in self._players.items():
             await player.send_message({
                 'type' : 'GameStart',
+                'room' : self._name,
                 'data' : {
                     'cards' : self._player_cards[player_name]
                 }
@@ -665,42 +1353,95 @@ class Room:
     async def send_revealed_cards(self):
         await self.tell_room({
             'type' : 'RevealedCards',
+            'room' : self._name,
             'data' : self._revealed_cards,
         })
 
     async def send_instruments(self):
         await self.tell_room({
             'type' : 'InstrumentsUpdate',
+            'room' : self._name,
             'data' : self._instruments
         })
 
     async def send_positions(self, specific_player=None):
+        '''
+        Sends full snapshots of the positions and the PnL, either to each
+        player in the room or to a single player
+        '''
         if specific_player is None:
             for player_name, player in self._players.items():
-                await player.send_message({
-                    'type' : 'PositionUpdate',
-                    'data' : self._positions[player_name]
-                })
+                await player.send_message(self.get_positions_update(player_name))
         else:
             player = self._players[specific_player]
-            await player.send_message({
-                'type' : 'PositionUpdate',
-                'data' : self._positions[specific_player]
-            })
+            await player.send_message(self.get_positions_update(specific_player))
 
-    async def send_books(self):
+    def get_positions_update(self, player_name):
+        return [
+            {
+                'type' : 'PositionUpdate',
+                'room' : self._name,
+                'data' : self._ledger.positions(player_name)
+            },
+            self._position_publisher.as_update(player_name),
+        ]
+
+    async def send_fair_values(self, player_name):
+        if self._fair_values.enabled:
+            await self._players[player_name].send_message(self._fair_values.as_update(player_name))
+
+    async def send_books(self, specific_player=None):
+        '''
+        Sends full snapshots of the books, either to the whole room
+        or to a player that has just joined or has missed a delta
+        '''
         for _, book in self._books.items():
-            await self.tell_room(book.as_update())
+            await self.send_book(book.get_name(), specific_player)
+
+    async def send_book(self, instrument_name, specific_player=None):
+        if specific_player is None:
+            await self.tell_room(self.get_book_update(instrument_name))
+        else:
+            await self._players[specific_player].send_message(self.get_book_update(instrument_name))
+
+    def get_book_update(self, instrument_name):
+        '''
+        A full snapshot of a book, carrying the room so that it is not
+        conflated with the snapshot of a book of the same name in
+        another room
+        '''
+        update = self._books[instrument_name].as_update()
+        update['room'] = self._name
+        return update
+
 
 
     async def send_orders(self, player_name):
+        player = self._players[player_name]
         for _, book in self._books.items():
-            await book.send_orders(player_name)
+            for order in book.get_player_orders(player_name):
+                await player.send_message(
+                    self.as_frame(self.get_order_update(order), order.get_instrument())
+                )
 
-    async def send_trades(self):
-        await self.tell_room({
-            'type' : 'Trade',
-            'data' : self._trades
+    def get_order_update(self, order):
+        update = order.as_update()
+        update['room'] = self._name
+        return update
+
+    async def send_trades(self, player_name, from_seq=1, limit=tape.TradeTape.MAX_PAGE):
+        '''
+        Sends a page of the trade tape to a single player
+        '''
+        trades = self._trades.page(from_seq, limit)
+        await self._players[player_name].send_message({
+            'type' : 'Trades',
+            'room' : self._name,
+            'data' : {
+                'from_seq' : from_seq,
+                'last_seq' : self._trades.last_seq(),
+                'trades' : trades
+            }
         })
 
     def __hash__(self):
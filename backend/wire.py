@@ -0,0 +1,171 @@
+#!/usr/bin/env python3.8
+'''
+wire.py
+
+Compact binary protocol for orders and market data
+
+A client selects it by asking for the SUBPROTOCOL websocket subprotocol
+when it connects, otherwise the connection speaks JSON as before. On a
+binary connection the hot messages are sent as fixed layout struct
+records (little endian) in binary frames, every other message is still
+sent as JSON in a text frame. The client may send JSON text frames too
+(e.g. NewPlayer, JoinRoom), and does not need to send the empty frame
+before each message that JSON clients send.
+
+Instruments and players are referred to by small integer ids assigned
+per room: an instrument's id is its position in InstrumentsUpdate and
+a player's id is their position in RoomPlayersUpdate. Binary orders are
+for the room that the connection last sent a JoinRoom for.
+
+Client -> server
+    NEW_ORDER       kind, side, instrument, player, price, size
+    CANCEL_ORDER    kind, instrument, player, order_id
+    AMEND_ORDER     kind, instrument, player, order_id, price, size
+                    (a price or size of 0 leaves it unchanged)
+
+Server -> client
+    ORDER_UPDATE    kind, side, status, instrument, order_id, price, size, remaining_size
+    FILL            kind, side, instrument, order_id, price, size
+    TRADE_UPDATE    kind, side, instrument, seq, price, size
+    ORDERBOOK_DELTA kind, instrument, seq, n, then n x LEVEL
+    LEVEL           side, price, size
+'''
+
+import struct
+
+import util.helpers as util
+
+SUBPROTOCOL = 'mocktrading.binary'
+
+NEW_ORDER = 1
+CANCEL_ORDER = 2
+AMEND_ORDER = 3
+ORDER_UPDATE = 16
+FILL = 17
+TRADE_UPDATE = 18
+ORDERBOOK_DELTA = 19
+
+NEW_ORDER_RECORD = struct.Struct('<BBHHiI')
+CANCEL_ORDER_RECORD = struct.Struct('<BHHI')
+AMEND_ORDER_RECORD = struct.Struct('<BHHIiI')
+ORDER_UPDATE_RECORD = struct.Struct('<BBBHIiII')
+FILL_RECORD = struct.Struct('<BBHIiI')
+TRADE_UPDATE_RECORD = struct.Struct('<BBHIiI')
+ORDERBOOK_DELTA_RECORD = struct.Struct('<BHIH')
+LEVEL_RECORD = struct.Struct('<BiI')
+
+SIDES = ('bid', 'ask')
+SIDE_IDS = {
+    'bid' : 0, 'ask' : 1,
+    'buy' : 0, 'sell' : 1,
+}
+# Largest price and size that the records can carry
+MAX_PRICE = 2 ** 31 - 1
+MAX_SIZE = 2 ** 32 - 1
+
+STATUSES = ('active', 'filled', 'cancelled')
+STATUS_IDS = {s : i for i, s in enumerate(STATUSES)}
+
+def is_binary(ws):
+    return getattr(ws, 'subprotocol', None) == SUBPROTOCOL
+
+def decode(data: bytes, room_name: str):
+    '''
+    Decodes a record from a client into the same message as its JSON
+    counterpart, with ids in place of the player and instrument names.
+    Returns None for a record that is truncated, malformed or of an
+    unknown kind, which is logged and ignored.
+    '''
+    try:
+        return decode_record(data, room_name)
+    except (struct.error, IndexError, ValueError) as e:
+        util.print_core(f'Ignoring a bad binary record of {len(data)} bytes: {e}')
+        return None
+
+def decode_record(data: bytes, room_name: str):
+    kind = data[0]
+    if kind == NEW_ORDER:
+        _, side, instrument_id, player_id, price, size = NEW_ORDER_RECORD.unpack(data)
+        return {
+            'type' : 'NewOrder',
+            'data' : {
+                'room' : room_name,
+                'player_id' : player_id,
+                'instrument_id' : instrument_id,
+                'price' : price,
+                'size' : size,
+                'direction' : SIDES[side],
+            }
+        }
+    elif kind == CANCEL_ORDER:
+        _, instrument_id, player_id, order_id = CANCEL_ORDER_RECORD.unpack(data)
+        return {
+            'type' : 'CancelOrder',
+            'data' : {
+                'room' : room_name,
+                'player_id' : player_id,
+                'instrument_id' : instrument_id,
+                'order_id' : order_id,
+            }
+        }
+    elif kind == AMEND_ORDER:
+        _, instrument_id, player_id, order_id, price, size = AMEND_ORDER_RECORD.unpack(data)
+        return {
+            'type' : 'AmendOrder',
+            'data' : {
+                'room' : room_name,
+                'player_id' : player_id,
+                'instrument_id' : instrument_id,
+                'order_id' : order_id,
+                'price' : price or None,
+                'size' : size or None,
+            }
+        }
+    else:
+        raise ValueError(f'Unknown record kind: {kind}')
+
+def encode(msg: dict, instrument_id: int):
+    '''
+    Encodes a message for a binary connection, returns None if
+    the message has no binary layout
+    '''
+    if instrument_id is None:
+        return None
+    msg_type = msg.get('type')
+    data = msg.get('data')
+    if msg_type == 'OrderUpdate':
+        return ORDER_UPDATE_RECORD.pack(
+            ORDER_UPDATE,
+            SIDE_IDS[data['direction']],
+            STATUS_IDS[data['status']],
+            instrument_id,
+            data['order_id'],
+            int(data['price']),
+            data['size'],
+            data['remaining_size']
+        )
+    elif msg_type == 'Fill':
+        return FILL_RECORD.pack(
+            FILL,
+            SIDE_IDS[data['direction']],
+            instrument_id,
+            data['order_id'],
+            int(data['price']),
+            data['size']
+        )
+    elif msg_type == 'TradeUpdate':
+        return TRADE_UPDATE_RECORD.pack(
+            TRADE_UPDATE,
+            SIDE_IDS[data['direction']],
+            instrument_id,
+            data['seq'],
+            int(data['price']),
+            data['size']
+        )
+    elif msg_type == 'OrderbookDelta':
+        return ORDERBOOK_DELTA_RECORD.pack(
+            ORDERBOOK_DELTA, instrument_id, msg['seq'], len(data)
+        ) + b''.join(
+            LEVEL_RECORD.pack(SIDE_IDS[l['type']], int(l['price']), l['size']) for l in data
+        )
+    return None
@@ -0,0 +1,388 @@
+#!/usr/bin/env python3.8
+'''
+workers.py
+
+Runs the rooms in worker processes so that the server can make use
+of more than one core when there are many concurrent games.
+
+The Gateway owns the websocket connections and the lobby (the players
+and the list of rooms). Every room lives in one RoomWorker, chosen with
+a consistent hash ring over util.hash_string(room_name). The gateway
+forwards the messages for a room to its worker over a multiprocessing
+Pipe and the worker sends back whatever its rooms send to players.
+
+Gateway -> worker:
+    ('open', room_name, replaying)
+    ('recover', room_name)
+    ('close', request_id, room_name, replaying)
+    ('metrics', request_id)
+    ('profile',)
+    ('msg', msg)
+
+Worker -> gateway:
+    ('player', player_name, payload)
+    ('broadcast', payload)
+    ('member', player_name, room_name, joined)
+    ('reply', request_id, result)
+
+The gateway keeps which rooms each player is in from the 'member'
+messages sent after every JoinRoom and LeaveRoom, so that it can send
+the Resyncs of a slow client to the rooms that hold its state.
+
+Neither side waits on a pipe from its event loop. Each end is wrapped
+in a Channel: items are pickled as they are sent, a thread writes
+whatever was queued since its last write in one go, and another reads
+and unpickles them before handing them to the loop. A full pipe then
+only holds up the writer thread. Frames keep the JSON they were encoded
+to, so a room broadcast is encoded once by the worker and only copied
+into the pickle of each player's item.
+'''
+
+import asyncio
+import collections
+import functools
+import itertools
+import multiprocessing
+import pickle
+import threading
+
+import backend.journal as journal
+import backend.metrics as metrics
+import backend.server as server
+import util.helpers as util
+import util.log as log
+
+class Channel:
+    '''
+    One end of a Pipe, sending and receiving on threads so that the
+    event loop never blocks on it
+    '''
+
+    def __init__(self, conn, name='channel'):
+        self.name = name
+        self.closed = False
+
+        self._conn = conn
+        self._pending = collections.deque()     # Pickled items waiting for the writer
+        self._wake = threading.Event()
+        self._writer = threading.Thread(target=self._write, name=f'{name}-writer', daemon=True)
+        self._writer.start()
+
+    def send(self, item):
+        if self.closed:
+            return
+        # Pickled now, as the item may be changed once this returns
+        self._pending.append(pickle.dumps(item, pickle.HIGHEST_PROTOCOL))
+        self._wake.set()
+
+    def _write(self):
+        pending = self._pending
+        while not self.closed:
+            self._wake.wait()
+            self._wake.clear()
+            batch = []
+            while pending:
+                batch.append(pending.popleft())
+            if not batch:
+                continue
+            try:
+                self._conn.send(batch)
+            except (OSError, ValueError) as e:
+                util.print_core(f'Could not write to {self.name}: {e!r}')
+                self.close()
+
+    def close(self):
+        '''
+        Stops the writer, dropping whatever it had not yet written
+        '''
+        self.closed = True
+        self._pending.clear()
+        self._wake.set()
+
+    def start(self, on_receive, on_close):
+        '''
+        Starts reading, calling on_receive with each item received and
+        on_close once the other end is gone, on the running loop
+        '''
+        loop = asyncio.get_event_loop()
+
+        def deliver(batch):
+            for item in batch:
+                on_receive(item)
+
+        def read():
+            while not self.closed:
+                try:
+                    batch = [pickle.loads(data) for data in self._conn.recv()]
+                    callback = functools.partial(deliver, batch)
+                except (EOFError, OSError):
+                    self.close()
+                    callback = on_close
+                try:
+                    loop.call_soon_threadsafe(callback)
+                except RuntimeError:
+                    return      # The loop was closed first
+
+        threading.Thread(target=read, name=f'{self.name}-reader', daemon=True).start()
+
+class PlayerSocket:
+    '''
+    Stands in for the websocket of a player inside a worker,
+    everything sent to it is forwarded to the gateway
+    '''
+
+    relays_frames = True    # Frames are encoded by the gateway for the player's connection
+
+    def __init__(self, player_name, channel):
+        self._player_name = player_name
+        self._channel = channel
+
+    async def send(self, payload):
+        self._channel.send(('player', self._player_name, payload))
+
+class RoomWorker(server.MatchingEngine):
+    '''
+    A MatchingEngine without any websockets, fed by the gateway.
+    Rooms are still sequenced on their own queues within the worker.
+    '''
+
+    def __init__(self, conn, room_options=None, journal_dir=None, stall_threshold=None, profile_dir='.'):
+        super().__init__(
+            room_options=room_options, journal_dir=journal_dir,
+            stall_threshold=stall_threshold, profile_dir=profile_dir
+        )
+        self._channel = Channel(conn, 'gateway')
+        self._closed = None
+
+    def get_player(self, player_name):
+        players = self._lobby._players
+        if player_name not in players:
+            players[player_name] = server.Player(
+                player_name, None, PlayerSocket(player_name, self._channel)
+            )
+        return players[player_name]
+
+    def on_message(self, item):
+        kind, *args = item
+        if kind == 'msg':
+            self.route(args[0], None)
+        elif kind == 'open':
+            room_name, replaying = args
+            if self._lobby.new_room(room_name):
+                self.open_room(room_name, replaying)
+        elif kind == 'recover':
+            # Replayed on the room's queue, ahead of any later messages
+            self.route({
+                'type' : 'Recover',
+                'data' : {'room' : args[0]}
+            }, journal.REPLAY)
+        elif kind == 'close':
+            request_id, room_name, replaying = args
+            ok = self._lobby.delete_room(room_name)
+            if ok:
+                self.close_room_queue(room_name)
+                self.close_room(room_name, replaying)
+            self._channel.send(('reply', request_id, ok))
+        elif kind == 'metrics':
+            self._channel.send(('reply', args[0], self.collect_metrics()))
+        elif kind == 'profile':
+            self.toggle_profiler()
+        else:
+            util.print_core(f'Unknown message from gateway: {kind}')
+
+    def on_close(self):
+        util.print_core('Lost connection to the gateway')
+        if not self._closed.done():
+            self._closed.set_result(None)
+
+    async def update_and_send_response(self, msg, ws):
+        data = msg.get('data')
+        player_name = data.get('player') if isinstance(data, dict) else None
+        if player_name is not None:
+            self.get_player(player_name)
+        await super().update_and_send_response(msg, ws)
+        if msg.get('type') in ('JoinRoom', 'LeaveRoom') and player_name is not None:
+            room_name = data.get('room')
+            self._channel.send((
+                'member', player_name, room_name, room_name in self.get_player(player_name)._rooms
+            ))
+
+    async def broadcast(self, msg):
+        if msg:
+            self._channel.send(('broadcast', msg))
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        self._closed = loop.create_future()
+        self.start_watchdog()
+        self._channel.start(self.on_message, self.on_close)
+        await self._closed
+
+async def serve_worker(conn, room_options=None, journal_dir=None, stall_threshold=None, profile_dir='.'):
+    await RoomWorker(conn, room_options, journal_dir, stall_threshold, profile_dir).run()
+
+def run_worker(
+    conn, level=log.INFO, room_options=None, journal_dir=None, stall_threshold=None, profile_dir='.'
+):
+    log.set_level(level)
+    asyncio.run(serve_worker(conn, room_options, journal_dir, stall_threshold, profile_dir))
+
+class Gateway(server.MatchingEngine):
+    CALL_TIMEOUT = 5.0  # Seconds to wait for a worker to reply to a request
+
+    def __init__(self, n_workers, journal_dir=None, **kwargs):
+        super().__init__(journal_dir=journal_dir, **kwargs)
+        ctx = multiprocessing.get_context('spawn')
+        self._workers = []
+        for i in range(n_workers):
+            conn, worker_conn = ctx.Pipe()
+            process = ctx.Process(
+                target=run_worker,
+                args=(
+                    worker_conn, log.get_level(), self._room_options, journal_dir,
+                    self._watchdog.threshold if self._watchdog is not None else None,
+                    self._profiler.directory
+                ),
+                name=f'room-worker-{i}',
+                daemon=True
+            )
+            process.start()
+            worker_conn.close()
+            self._workers.append(Channel(conn, f'room-worker-{i}'))
+        util.print_core(f'Started {n_workers} room workers')
+
+        self._ring = util.HashRing(range(n_workers))
+        self._requests = {}                 # request_id -> (Channel, Future awaiting its reply)
+        self._request_ids = itertools.count()
+        self._outbox = asyncio.Queue()      # (player_name or None, payload) from the workers
+
+    def get_worker(self, room_name):
+        return self._workers[self._ring.get(room_name)]
+
+    def toggle_profiler(self):
+        # The rooms are run by the workers, which are profiled along with the gateway
+        super().toggle_profiler()
+        for channel in self._workers:
+            channel.send(('profile',))
+
+    async def get_metrics(self, timeout=1.0):
+        '''
+        The metrics of the gateway and of each worker that replies
+        within the timeout, labelled with its index
+        '''
+        families = [self.collect_metrics()]
+        labels = []
+        for i, channel in enumerate(self._workers):
+            try:
+                families.append(await self.call(channel, 'metrics', timeout=timeout))
+                labels.append({'worker' : str(i)})
+            except (asyncio.TimeoutError, ConnectionError):
+                util.print_core(f'Room worker {i} did not send its metrics')
+        return metrics.merge(families, labels)
+
+    async def call(self, channel, kind, *args, timeout=CALL_TIMEOUT):
+        '''
+        Sends a request to a worker and waits for its reply, raising
+        asyncio.TimeoutError if there is none within the timeout and
+        ConnectionError if the worker is gone
+        '''
+        if channel.closed:
+            raise ConnectionError(f'Lost connection to {channel.name}')
+        request_id = next(self._request_ids)
+        reply = asyncio.get_event_loop().create_future()
+        self._requests[request_id] = (channel, reply)
+        try:
+            channel.send((kind, request_id, *args))
+            return await asyncio.wait_for(reply, timeout)
+        finally:
+            self._requests.pop(request_id, None)
+
+    async def new_room(self, name, replaying=False):
+        if self._lobby.new_room(name):
+            self.get_worker(name).send(('open', name, replaying))
+            return 1
+        return 0
+
+    async def delete_room(self, name, replaying=False):
+        if name not in self._lobby._rooms:
+            return 0
+        try:
+            closed = await self.call(self.get_worker(name), 'close', name, replaying)
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            util.print_core(f'Could not close {name} on its worker: {e!r}')
+            return 0
+        if closed:
+            return await super().delete_room(name, replaying)
+        return 0
+
+    def remove_journal(self, room_name):
+        # The journal of a room is kept, and removed, by its worker
+        pass
+
+    def write_journal(self, msg):
+        # Room messages are journaled by the worker
+        if msg.get('type') in self.LOBBY_MESSAGES:
+            super().write_journal(msg)
+
+    async def recover_room(self, room_name):
+        self.get_worker(room_name).send(('recover', room_name))
+        return 0
+
+    async def update_and_send_response(self, msg, ws):
+        data = msg.get('data')
+        room_name = data.get('room') if isinstance(data, dict) else None
+        if msg.get('type') in self.LOBBY_MESSAGES or room_name is None:
+            await super().update_and_send_response(msg, ws)
+        elif 'player' in data and data['player'] not in self._lobby._players:
+            # Workers make a Player for any name, only the gateway knows who has logged in
+            util.print_core(f'Unknown player {data["player"]!r} in a message for {room_name}')
+        else:
+            self.get_worker(room_name).send(('msg', msg))
+
+    def set_member(self, player_name, room_name, joined):
+        player = self._lobby._players.get(player_name)
+        if player is None:
+            return
+        elif joined:
+            player._rooms.add(room_name)
+        else:
+            player._rooms.discard(room_name)
+
+    def on_worker_message(self, item):
+        kind, *args = item
+        if kind == 'player':
+            self._outbox.put_nowait(tuple(args))
+        elif kind == 'broadcast':
+            self._outbox.put_nowait((None, args[0]))
+        elif kind == 'member':
+            self.set_member(*args)
+        elif kind == 'reply':
+            request_id, result = args
+            _, reply = self._requests.pop(request_id, (None, None))
+            if reply is not None and not reply.done():
+                reply.set_result(result)
+        else:
+            util.print_core(f'Unknown message from worker: {kind}')
+
+    def on_worker_close(self, channel):
+        util.print_core(f'Lost connection to {channel.name}!')
+        # Nothing more will come from it, so fail whatever is waiting on a reply
+        for request_id, (c, reply) in list(self._requests.items()):
+            if c is channel:
+                del self._requests[request_id]
+                if not reply.done():
+                    reply.set_exception(ConnectionError(f'Lost connection to {channel.name}'))
+
+    async def deliver(self):
+        while True:
+            player_name, payload = await self._outbox.get()
+            if player_name is None:
+                await self.broadcast(payload)
+            elif player_name in self._lobby._players:
+                await self._lobby.get_player(player_name).send_message(payload)
+
+    async def run(self, port='8887', host='localhost', metrics_port=None):
+        for channel in self._workers:
+            channel.start(self.on_worker_message, functools.partial(self.on_worker_close, channel))
+        asyncio.create_task(self.deliver())
+        await super().run(port=port, host=host, metrics_port=metrics_port)
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3.8
+'''
+book.py
+
+Micro-benchmarks for structures.book
+
+Drives OrderBook.new_order, cancel_order, cancel_order_id, amend_order and delete
+with seeded synthetic order flow, so that nothing but the book is
+measured. Each profile is generated up front
+and then run three times on a fresh book:
+
+- untimed, for the throughput (operations/sec)
+- timing every operation, for the p50/p99/p999 latencies
+- under tracemalloc, for the peak memory
+
+The results are written as JSON so that runs on different commits can
+be compared.
+
+    python -m benchmarks.book [-n 100000] [-s 1] [-p sweep,cancel_churn] [-o results.json]
+'''
+
+import getopt
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import structures.book as book
+import util.log as log
+
+MID = 10000     # Middle of the book for the profiles that trade around a price
+
+PLAYERS = [f'player{i}' for i in range(8)]
+
+def new(rng, price, size, direction):
+    return ('new', {
+        'player' : rng.choice(PLAYERS),
+        'price' : price,
+        'size' : size,
+        'direction' : direction,
+        'instrument' : 'A'
+    })
+
+# Profiles
+# Each returns a list of about n operations. Order ids are handed out by the
+# book in sequence from 1, so the i-th 'new' operation is order i.
+
+def passive_build(rng, n):
+    '''
+    Resting orders within 50 ticks of either side of the spread
+    '''
+    ops = []
+    for _ in range(n):
+        if rng.random() < 0.5:
+            ops.append(new(rng, MID - rng.randint(1, 50), rng.randint(1, 10), 'bid'))
+        else:
+            ops.append(new(rng, MID + rng.randint(1, 50), rng.randint(1, 10), 'ask'))
+    return ops
+
+def deep_gaps(rng, n):
+    '''
+    Resting orders spread thinly over a very wide range of prices,
+    then every level deleted
+    '''
+    ops = []
+    levels = set()
+    n_new = n * 9 // 10
+    for _ in range(n_new):
+        if rng.random() < 0.5:
+            price, direction = rng.randrange(1, 500000, 997), 'bid'
+        else:
+            price, direction = rng.randrange(500001, 1000000, 997), 'ask'
+        levels.add((price, direction))
+        ops.append(new(rng, price, rng.randint(1, 10), direction))
+    levels = sorted(levels)
+    rng.shuffle(levels)
+    for price, direction in levels:
+        ops.append(('delete', price, direction))
+    return ops
+
+def sweep(rng, n):
+    '''
+    Ladders of resting orders, each swept by one aggressive order
+    '''
+    ops = []
+    while len(ops) < n:
+        depth = rng.randint(5, 40)
+        direction = rng.choice(('bid', 'ask'))
+        total = 0
+        for i in range(1, depth + 1):
+            size = rng.randint(1, 5)
+            total += size
+            if direction == 'ask':
+                ops.append(new(rng, MID + i, size, 'ask'))
+            else:
+                ops.append(new(rng, MID - i, size, 'bid'))
+        if direction == 'ask':
+            ops.append(new(rng, MID + depth, total, 'bid'))
+        else:
+            ops.append(new(rng, MID - depth, total, 'ask'))
+    return ops[:n]
+
+def cancel_churn(rng, n):
+    '''
+    Resting orders near the top of the book, most of them cancelled
+    by id soon after and some cancelled by price
+    '''
+    ops = []
+    live = []       # (order_id, player, price, direction)
+    order_id = 0
+    for _ in range(n):
+        r = rng.random()
+        if r < 0.5 or not live:
+            direction = rng.choice(('bid', 'ask'))
+            price = MID - rng.randint(1, 10) if direction == 'bid' else MID + rng.randint(1, 10)
+            op = new(rng, price, rng.randint(1, 10), direction)
+            order_id += 1
+            live.append((order_id, op[1]['player'], price, direction))
+            ops.append(op)
+        else:
+            i = rng.randrange(len(live))
+            live[i], live[-1] = live[-1], live[i]
+            cancelled_id, player_name, price, direction = live.pop()
+            if r < 0.95:
+                ops.append(('cancel_id', cancelled_id, player_name))
+            else:
+                ops.append(('cancel', player_name, price, direction))
+    return ops
+
+def oscillation(rng, n):
+    '''
+    A mid price on a random walk with quotes improving the best price
+    on either side, small aggressive orders and cancels
+    '''
+    ops = []
+    mid = MID
+    order_id = 0
+    recent = []
+    for _ in range(n):
+        mid += rng.choice((-1, 1))
+        r = rng.random()
+        if r < 0.5:
+            direction = rng.choice(('bid', 'ask'))
+            price = mid - 1 if direction == 'bid' else mid + 1
+            ops.append(new(rng, price, rng.randint(1, 5), direction))
+            order_id += 1
+            recent.append(order_id)
+        elif r < 0.8:
+            direction = rng.choice(('bid', 'ask'))
+            price = mid + 2 if direction == 'bid' else mid - 2
+            ops.append(new(rng, price, rng.randint(1, 3), direction))
+            order_id += 1
+        elif recent:
+            ops.append(('cancel_id', recent.pop(rng.randrange(len(recent))), None))
+        recent = recent[-64:]
+    return ops
+
+def requote(rng, n):
+    '''
+    Resting orders near the top of the book, most of them amended soon
+    after: reduced in place, moved to a new price or grown
+    '''
+    ops = []
+    live = []       # [order_id, price, size, direction]
+    order_id = 0
+    for _ in range(n):
+        r = rng.random()
+        if r < 0.3 or not live:
+            direction = rng.choice(('bid', 'ask'))
+            price = MID - rng.randint(1, 10) if direction == 'bid' else MID + rng.randint(1, 10)
+            size = rng.randint(2, 10)
+            ops.append(new(rng, price, size, direction))
+            order_id += 1
+            live.append([order_id, price, size, direction])
+            live = live[-256:]
+            continue
+        o = rng.choice(live)
+        if r < 0.6 and o[2] > 1:
+            o[2] = rng.randint(1, o[2] - 1)
+            ops.append(('amend', o[0], None, o[2]))
+        elif r < 0.9:
+            o[1] = MID - rng.randint(1, 10) if o[3] == 'bid' else MID + rng.randint(1, 10)
+            ops.append(('amend', o[0], o[1], None))
+        else:
+            o[2] += rng.randint(1, 5)
+            ops.append(('amend', o[0], None, o[2]))
+    return ops
+
+PROFILES = {
+    'passive_build' : passive_build,
+    'deep_gaps' : deep_gaps,
+    'sweep' : sweep,
+    'cancel_churn' : cancel_churn,
+    'oscillation' : oscillation,
+    'requote' : requote,
+}
+
+OPERATIONS = {
+    'new' : lambda b, order: b.new_order(order),
+    'cancel_id' : lambda b, order_id, player_name: b.cancel_order_id(order_id, player_name),
+    'cancel' : lambda b, player_name, price, direction: b.cancel_order(player_name, price, direction),
+    'delete' : lambda b, price, direction: b.delete(price, direction),
+    'amend' : lambda b, order_id, price, size: b.amend_order(order_id, price, size),
+}
+
+def new_book():
+    return book.OrderBook('A', 1, MID - 100, MID + 100)
+
+def run_throughput(ops):
+    b = new_book()
+    operations = OPERATIONS
+    start = time.perf_counter()
+    for kind, *args in ops:
+        operations[kind](b, *args)
+    return len(ops) / (time.perf_counter() - start)
+
+def run_latency(ops):
+    b = new_book()
+    operations = OPERATIONS
+    clock = time.perf_counter_ns
+    latencies = []
+    for kind, *args in ops:
+        start = clock()
+        operations[kind](b, *args)
+        latencies.append(clock() - start)
+    latencies.sort()
+    n = len(latencies)
+    return {
+        'p50' : latencies[n * 50 // 100],
+        'p99' : latencies[n * 99 // 100],
+        'p999' : latencies[n * 999 // 1000],
+        'max' : latencies[-1],
+    }
+
+def run_memory(ops):
+    tracemalloc.start()
+    b = new_book()
+    operations = OPERATIONS
+    for kind, *args in ops:
+        operations[kind](b, *args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmark(profiles, n, seed):
+    results = {
+        'commit' : get_commit(),
+        'python' : platform.python_version(),
+        'n' : n,
+        'seed' : seed,
+        'profiles' : {},
+    }
+    for name in profiles:
+        ops = PROFILES[name](random.Random(seed), n)
+        results['profiles'][name] = {
+            'ops' : len(ops),
+            'ops_per_sec' : round(run_throughput(ops)),
+            'latency_ns' : run_latency(ops),
+            'peak_memory_bytes' : run_memory(ops),
+        }
+        print(f'{name:<16}{results["profiles"][name]}', file=sys.stderr)
+    return results
+
+def main(argv):
+    help_string = '''python -m benchmarks.book
+        -n [--ops] <operations per profile (100000)>
+        -s [--seed] <random seed (1)>
+        -p [--profiles] <comma separated profiles (all)>
+        -o [--output] <file to write the JSON results to (stdout)>'''
+    try:
+        opts, _ = getopt.getopt(argv, 'hn:s:p:o:', ['ops=', 'seed=', 'profiles=', 'output='])
+    except getopt.GetoptError:
+        print(help_string)
+        return 1
+
+    n = 100000
+    seed = 1
+    profiles = list(PROFILES)
+    output = None
+    for opt, arg in opts:
+        if opt == '-h':
+            print(help_string)
+            return 0
+        elif opt in ('-n', '--ops'):
+            n = int(arg)
+        elif opt in ('-s', '--seed'):
+            seed = int(arg)
+        elif opt in ('-p', '--profiles'):
+            profiles = arg.split(',')
+        elif opt in ('-o', '--output'):
+            output = arg
+
+    unknown = [p for p in profiles if p not in PROFILES]
+    if unknown:
+        print(f'Unknown profiles: {unknown}, choose from {list(PROFILES)}')
+        return 1
+
+    # Cancels of orders that have already traded are logged at INFO
+    log.set_level(log.WARNING)
+    results = benchmark(profiles, n, seed)
+    if output is None:
+        print(json.dumps(results, indent=4))
+    else:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=4)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
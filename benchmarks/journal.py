@@ -0,0 +1,162 @@
+#!/usr/bin/env python3.8
+'''
+journal.py
+
+Cost of the write-ahead journal
+
+Plays a game of seeded NewOrders through a MatchingEngine without any
+websockets, once without a journal and once with one, and reports the
+time per order of each and the overhead of journaling. Then rebuilds
+the game from the journal in a new MatchingEngine and reports the time
+taken to recover.
+
+    python -m benchmarks.journal [-n 100000] [-p 8] [-s 1] [-o results.json]
+'''
+
+import asyncio
+import getopt
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+import backend.journal as journal
+import backend.server as server
+import util.log as log
+
+ROOM = 'benchmark'
+
+def make_messages(n_orders, n_players, seed):
+    rng = random.Random(seed)
+    players = [f'player{i}' for i in range(n_players)]
+    setup = [{'type' : 'NewRoom', 'data' : {'name' : ROOM}}]
+    for name in players:
+        setup.append({'type' : 'NewPlayer', 'data' : {'name' : name, 'password' : ''}})
+        setup.append({'type' : 'JoinRoom', 'data' : {'room' : ROOM, 'player' : name}})
+    setup.append({'type' : 'StartGame', 'data' : {'room' : ROOM}})
+
+    fair = n_players * 3 * 7
+    orders = []
+    for _ in range(n_orders):
+        direction = rng.choice(('bid', 'ask'))
+        offset = rng.randint(-3, 6)
+        orders.append({
+            'type' : 'NewOrder',
+            'data' : {
+                'room' : ROOM,
+                'player' : rng.choice(players),
+                'instrument' : rng.choice(('A', 'B')),
+                'price' : fair - offset if direction == 'bid' else fair + offset,
+                'size' : rng.randint(1, 5),
+                'direction' : direction
+            }
+        })
+    return setup, orders
+
+async def play(engine, setup, orders):
+    '''
+    Processes the messages as the consumers would and returns the
+    seconds spent on the orders
+    '''
+    ws = journal.ReplaySocket()     # Sends nothing, but unlike journal.REPLAY is journaled
+    for msg in setup:
+        if engine._journal is not None:
+            engine.write_journal(msg)
+        await engine.update_and_send_response(msg, ws)
+
+    start = time.perf_counter()
+    for msg in orders:
+        if engine._journal is not None:
+            engine.write_journal(msg)
+        await engine.update_and_send_response(msg, ws)
+    return time.perf_counter() - start
+
+async def benchmark(n_orders, n_players, seed):
+    setup, orders = make_messages(n_orders, n_players, seed)
+    random.seed(seed)
+    plain = await play(server.MatchingEngine(), setup, orders)
+
+    with tempfile.TemporaryDirectory() as directory:
+        random.seed(seed)
+        engine = server.MatchingEngine(journal_dir=directory)
+        journaled = await play(engine, setup, orders)
+        start = time.perf_counter()
+        engine._journal.flush()
+        flush = time.perf_counter() - start
+        size = sum(
+            os.path.getsize(os.path.join(root, f))
+            for root, _, files in os.walk(directory) for f in files
+        )
+
+        recovering = server.MatchingEngine(journal_dir=directory)
+        consumer = asyncio.ensure_future(recovering.consume(recovering._q))
+        start = time.perf_counter()
+        await recovering.recover()
+        recovery = time.perf_counter() - start
+        consumer.cancel()
+        room = engine._lobby.get_room(ROOM)
+        recovered_room = recovering._lobby.get_room(ROOM)
+        recovered = all(
+            room._ledger.positions(name) == recovered_room._ledger.positions(name)
+            for name in room._players
+        )
+
+    return {
+        'python' : platform.python_version(),
+        'orders' : n_orders,
+        'players' : n_players,
+        'seed' : seed,
+        'us_per_order' : round(plain / n_orders * 1e6, 3),
+        'us_per_order_journaled' : round(journaled / n_orders * 1e6, 3),
+        'journal_overhead_us_per_order' : round((journaled - plain) / n_orders * 1e6, 3),
+        'final_flush_sec' : round(flush, 4),
+        'journal_bytes' : size,
+        'journal_commits' : engine._journal.commits,
+        'recovery_sec' : round(recovery, 3),
+        'recovery_orders_per_sec' : round(n_orders / recovery),
+        'recovered_positions_match' : recovered,
+    }
+
+def main(argv):
+    help_string = '''python -m benchmarks.journal
+        -n [--orders] <number of orders (100000)>
+        -p [--players] <players in the room (8)>
+        -s [--seed] <random seed (1)>
+        -o [--output] <file to write the JSON results to (stdout)>'''
+    try:
+        opts, _ = getopt.getopt(argv, 'hn:p:s:o:', ['orders=', 'players=', 'seed=', 'output='])
+    except getopt.GetoptError:
+        print(help_string)
+        return 1
+
+    n_orders = 100000
+    n_players = 8
+    seed = 1
+    output = None
+    for opt, arg in opts:
+        if opt == '-h':
+            print(help_string)
+            return 0
+        elif opt in ('-n', '--orders'):
+            n_orders = int(arg)
+        elif opt in ('-p', '--players'):
+            n_players = int(arg)
+        elif opt in ('-s', '--seed'):
+            seed = int(arg)
+        elif opt in ('-o', '--output'):
+            output = arg
+
+    log.set_level(log.WARNING)
+    results = asyncio.run(benchmark(n_orders, n_players, seed))
+    if output is None:
+        print(json.dumps(results, indent=4))
+    else:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=4)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,395 @@
+#!/usr/bin/env python3.8
+'''
+load.py
+
+End to end load test of the websocket server
+
+Starts a server (a MatchingEngine, or a Gateway with room workers) in a
+child process on localhost and connects bot clients to it, a number of
+players in each of a number of rooms. The bots speak the JSON protocol
+of the frontend: each one logs in, joins its room, and once the game
+has started sends NewOrders around the expected value of the
+instruments at a Poisson rate, cancels some of its resting orders and
+reveals its cards.
+
+The round trip latency of a NewOrder is the time until the player is
+sent the OrderUpdate of the new order. Orders from one player are
+sequenced on the queue of its room, so the first OrderUpdate for an
+order the bot has not seen belongs to its oldest outstanding order.
+
+The server reports the depths of its queues (the lobby and room
+queues, and the outbound queues of the connections) while it runs.
+The report is printed as a latency histogram and can be written as JSON.
+
+    python -m benchmarks.load [-r 10] [-p 8] [-R 5] [-d 30] [-w 0] [-o load.json]
+
+The bots share one event loop, so with many of them check that the
+achieved order rate is the requested one.
+'''
+
+import asyncio
+import bisect
+import collections
+import getopt
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import time
+
+import websockets
+
+import backend.server as server
+import util.log as log
+
+# Upper edges of the histogram buckets of the round trip latency, in ms
+BUCKETS = [0.25, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+SAMPLE_INTERVAL = 0.25
+
+# Server
+
+async def sample_queues(engine, conn):
+    while True:
+        await asyncio.sleep(SAMPLE_INTERVAL)
+        depths = engine.get_queue_depths()
+        conn.send({
+            'queued' : sum(depths.values()),
+            'max_queue' : max(depths.values()),
+            'outbound' : sum(ws.qsize() for ws in engine._connected_users),
+        })
+
+async def serve(port, workers, conn):
+    if workers > 0:
+        from backend.workers import Gateway
+        engine = Gateway(workers)
+    else:
+        engine = server.MatchingEngine()
+    asyncio.ensure_future(sample_queues(engine, conn))
+    await engine.run(port=port, host='localhost')
+
+def run_server(port, workers, conn):
+    sys.stdout = open(os.devnull, 'w')
+    log.set_level(log.WARNING)
+    asyncio.run(serve(port, workers, conn))
+
+# Bots
+
+class Stats:
+    def __init__(self):
+        self.latencies = []     # Round trip of each NewOrder in ms
+        self.sent = 0           # Messages sent by the bots
+        self.received = 0       # Messages received by the bots
+
+class Bot:
+    def __init__(self, uri, room_name, player_name, n_players, rate, stats, rng):
+        self.uri = uri
+        self.room_name = room_name
+        self.player_name = player_name
+        self.n_players = n_players      # Players in the room
+        self.rate = rate                # NewOrders per second
+        self.stats = stats
+        self.rng = rng
+
+        self.ws = None
+        self.instruments = []
+        self.cards = None
+        self.players = []
+        self.pending = collections.deque()  # Send times of NewOrders without an OrderUpdate yet
+        self.seen = set()               # (instrument, order_id) of the orders that have had an OrderUpdate
+        self.live = set()               # (instrument, order_id) of the resting orders
+        self.started = asyncio.Event()
+        self.joined = asyncio.Event()
+
+    async def send(self, msg):
+        # The server reads a frame before each message
+        await self.ws.send('')
+        await self.ws.send(json.dumps(msg))
+        self.stats.sent += 1
+
+    async def read(self):
+        async for message in self.ws:
+            msg = json.loads(message)
+            for m in msg if isinstance(msg, list) else [msg]:
+                self.stats.received += 1
+                self.on_message(m)
+
+    def on_message(self, msg):
+        msg_type = msg.get('type')
+        if msg_type == 'OrderUpdate':
+            # Order ids are only unique within the book of an instrument
+            order = (msg['data']['instrument'], msg['data']['order_id'])
+            if order not in self.seen:
+                self.seen.add(order)
+                if self.pending:
+                    sent = self.pending.popleft()
+                    self.stats.latencies.append((time.perf_counter() - sent) * 1000)
+            if msg['data']['status'] == 'active':
+                self.live.add(order)
+            else:
+                self.live.discard(order)
+        elif msg_type == 'RoomPlayersUpdate':
+            self.players = msg['data']['players']
+            if len(self.players) >= self.n_players:
+                self.joined.set()
+        elif msg_type == 'GameStart':
+            self.cards = msg['data']['cards']
+        elif msg_type == 'InstrumentsUpdate':
+            self.instruments = [i for i in msg['data'] if i in ('A', 'B')]
+            if len(self.instruments) == 2:
+                self.started.set()
+
+    async def connect(self):
+        self.ws = await websockets.connect(self.uri, max_queue=None)
+        asyncio.ensure_future(self.read())
+        await self.send({
+            'type' : 'NewPlayer',
+            'data' : {'name' : self.player_name, 'password' : 'load'}
+        })
+
+    async def join(self):
+        await self.send({
+            'type' : 'JoinRoom',
+            'data' : {'room' : self.room_name, 'player' : self.player_name}
+        })
+
+    async def trade(self, until):
+        rng = self.rng
+        fair = self.n_players * 3 * 7      # Expected value of A and B
+        revealed = False
+        while time.perf_counter() < until:
+            await asyncio.sleep(rng.expovariate(self.rate))
+            r = rng.random()
+            if r < 0.8 or not self.live:
+                direction = rng.choice(('bid', 'ask'))
+                offset = rng.randint(-3, 6)
+                price = fair - offset if direction == 'bid' else fair + offset
+                self.pending.append(time.perf_counter())
+                await self.send({
+                    'type' : 'NewOrder',
+                    'data' : {
+                        'room' : self.room_name,
+                        'player' : self.player_name,
+                        'instrument' : rng.choice(self.instruments),
+                        'price' : price,
+                        'size' : rng.randint(1, 5),
+                        'direction' : direction
+                    }
+                })
+            elif r < 0.99 or revealed:
+                order = rng.choice(sorted(self.live))
+                self.live.discard(order)
+                await self.send({
+                    'type' : 'CancelOrder',
+                    'data' : {
+                        'room' : self.room_name,
+                        'player' : self.player_name,
+                        'instrument' : order[0],
+                        'order_id' : order[1]
+                    }
+                })
+            else:
+                revealed = True
+                await self.send({
+                    'type' : 'RevealCard',
+                    'data' : {
+                        'room' : self.room_name,
+                        'player' : self.player_name,
+                        'card' : self.cards['A'][0]
+                    }
+                })
+
+async def setup_room(uri, room_index, n_players, rate, stats, seed):
+    '''
+    Connects the bots of a room and starts its game
+    '''
+    room_name = f'load-{room_index}'
+    bots = [
+        Bot(
+            uri, room_name, f'{room_name}-{i}', n_players, rate, stats,
+            random.Random(seed * 1000003 + room_index * 1009 + i)
+        ) for i in range(n_players)
+    ]
+    for bot in bots:
+        await bot.connect()
+    await bots[0].send({'type' : 'NewRoom', 'data' : {'name' : room_name}})
+    for bot in bots:
+        await bot.join()
+    await bots[0].joined.wait()
+    await bots[0].send({'type' : 'StartGame', 'data' : {'room' : room_name}})
+    await asyncio.gather(*(bot.started.wait() for bot in bots))
+    return bots
+
+async def wait_for_server(uri, timeout=30):
+    start = time.perf_counter()
+    while True:
+        try:
+            ws = await websockets.connect(uri)
+            await ws.close()
+            return
+        except OSError:
+            if time.perf_counter() - start > timeout:
+                raise
+            await asyncio.sleep(0.1)
+
+async def drain_samples(conn, samples):
+    while True:
+        while conn.poll():
+            samples.append(conn.recv())
+        await asyncio.sleep(SAMPLE_INTERVAL)
+
+async def load(port, n_rooms, n_players, rate, duration, seed, conn):
+    uri = f'ws://localhost:{port}'
+    await wait_for_server(uri)
+    stats = Stats()
+    rooms = await asyncio.gather(*(
+        setup_room(uri, i, n_players, rate, stats, seed) for i in range(n_rooms)
+    ))
+    bots = [bot for room in rooms for bot in room]
+
+    sent, received = stats.sent, stats.received
+    while conn.poll():
+        conn.recv()
+    samples = []
+    drainer = asyncio.ensure_future(drain_samples(conn, samples))
+    start = time.perf_counter()
+    await asyncio.gather(*(bot.trade(start + duration) for bot in bots))
+    elapsed = time.perf_counter() - start
+    sent, received = stats.sent - sent, stats.received - received
+
+    # Give the last OrderUpdates time to arrive
+    await asyncio.sleep(1)
+    drainer.cancel()
+    await asyncio.gather(*(bot.ws.close() for bot in bots))
+    return {
+        'python' : platform.python_version(),
+        'rooms' : n_rooms,
+        'players_per_room' : n_players,
+        'rate_per_player' : rate,
+        'duration' : round(elapsed, 3),
+        'seed' : seed,
+        'orders' : len(stats.latencies),
+        'unanswered_orders' : sum(len(bot.pending) for bot in bots),
+        'sent_per_sec' : round(sent / elapsed, 1),
+        'received_per_sec' : round(received / elapsed, 1),
+        'latency_ms' : summarise(stats.latencies),
+        'histogram' : histogram(stats.latencies),
+        'server_queues' : {
+            'max_queued' : max((s['queued'] for s in samples), default=0),
+            'max_room_queue' : max((s['max_queue'] for s in samples), default=0),
+            'max_outbound' : max((s['outbound'] for s in samples), default=0),
+            'mean_queued' : round(sum(s['queued'] for s in samples) / max(1, len(samples)), 2),
+        },
+    }
+
+def summarise(latencies):
+    if not latencies:
+        return {}
+    latencies = sorted(latencies)
+    n = len(latencies)
+    return {
+        'p50' : round(latencies[n * 50 // 100], 3),
+        'p90' : round(latencies[n * 90 // 100], 3),
+        'p99' : round(latencies[n * 99 // 100], 3),
+        'p999' : round(latencies[n * 999 // 1000], 3),
+        'max' : round(latencies[-1], 3),
+    }
+
+def histogram(latencies):
+    '''
+    Counts of the latencies in each bucket, keyed by the upper edge of the bucket
+    '''
+    counts = [0] * (len(BUCKETS) + 1)
+    for l in latencies:
+        counts[bisect.bisect_left(BUCKETS, l)] += 1
+    edges = [str(b) for b in BUCKETS] + ['inf']
+    return dict(zip(edges, counts))
+
+def print_report(results, stream=sys.stdout):
+    print('-' * 60, file=stream)
+    print(
+        f'{results["rooms"]} rooms x {results["players_per_room"]} players '
+        f'at {results["rate_per_player"]} orders/s each for {results["duration"]}s',
+        file=stream
+    )
+    print(
+        f'Sent {results["sent_per_sec"]} msg/s, received {results["received_per_sec"]} msg/s, '
+        f'{results["orders"]} orders ({results["unanswered_orders"]} unanswered)',
+        file=stream
+    )
+    print(f'Latency (ms): {results["latency_ms"]}', file=stream)
+    print(f'Server queues: {results["server_queues"]}', file=stream)
+    total = max(1, results['orders'])
+    for edge, count in results['histogram'].items():
+        bar = '#' * round(50 * count / total)
+        print(f'<= {edge:>6} ms {count:>8} {bar}', file=stream)
+    print('-' * 60, file=stream)
+
+def main(argv):
+    help_string = '''python -m benchmarks.load
+        -r [--rooms] <number of rooms (10)>
+        -p [--players] <players per room (8)>
+        -R [--rate] <orders per second per player (5)>
+        -d [--duration] <seconds (30)>
+        -w [--workers] <room worker processes of the server (0)>
+        -P [--port] <port (8890)>
+        -s [--seed] <random seed (1)>
+        -o [--output] <file to write the JSON results to>'''
+    try:
+        opts, _ = getopt.getopt(
+            argv, 'hr:p:R:d:w:P:s:o:',
+            ['rooms=', 'players=', 'rate=', 'duration=', 'workers=', 'port=', 'seed=', 'output=']
+        )
+    except getopt.GetoptError:
+        print(help_string)
+        return 1
+
+    n_rooms = 10
+    n_players = 8
+    rate = 5
+    duration = 30
+    workers = 0
+    port = 8890
+    seed = 1
+    output = None
+    for opt, arg in opts:
+        if opt == '-h':
+            print(help_string)
+            return 0
+        elif opt in ('-r', '--rooms'):
+            n_rooms = int(arg)
+        elif opt in ('-p', '--players'):
+            n_players = int(arg)
+        elif opt in ('-R', '--rate'):
+            rate = float(arg)
+        elif opt in ('-d', '--duration'):
+            duration = float(arg)
+        elif opt in ('-w', '--workers'):
+            workers = int(arg)
+        elif opt in ('-P', '--port'):
+            port = int(arg)
+        elif opt in ('-s', '--seed'):
+            seed = int(arg)
+        elif opt in ('-o', '--output'):
+            output = arg
+
+    ctx = multiprocessing.get_context('spawn')
+    conn, server_conn = ctx.Pipe()
+    # Not a daemon, as it starts the room workers of a Gateway
+    process = ctx.Process(target=run_server, args=(port, workers, server_conn))
+    process.start()
+    try:
+        results = asyncio.run(load(port, n_rooms, n_players, rate, duration, seed, conn))
+    finally:
+        process.terminate()
+    results['server_workers'] = workers
+
+    print_report(results)
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=4)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
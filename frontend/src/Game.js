@@ -38,6 +38,7 @@ export class Game extends React.Component {
 			order_price: null,
 			order_size: null,
 			pnl: null,
+			live_pnl: null,
 		}
 	}
 
@@ -65,6 +66,11 @@ export class Game extends React.Component {
 
 		ws.onmessage = (event) => {
 			const message = JSON.parse(event.data);
+			const room = this.roomOf(message);
+			if (room !== null && room !== this.state.current_room) {
+				// For another room the player is in, e.g. open in another window
+				return;
+			}
 
 			switch (message.type) {
 				case "Info":
@@ -123,22 +129,63 @@ export class Game extends React.Component {
 						positions: message.data
 					});
 					break;
+				case "PositionDelta":
+					this.setState({
+						positions: {...this.state.positions, ...message.data}
+					});
+					break;
+				case "PnLUpdate":
+					this.setState({
+						live_pnl: message.data.pnl
+					});
+					break;
 				case "OrderbookUpdate":
 					console.log('Received new orderbok')
 					let books = this.state.books;
 					books.onUpdate(message)
 					this.setState({books : books});
 					break;
+				case "OrderbookDelta":
+					let delta_books = this.state.books;
+					if (delta_books.onDelta(message)) {
+						this.setState({books : delta_books});
+					} else {
+						console.log(`Missed a delta for ${message.symbol}, requesting the book`)
+						ws.send("")
+						ws.send(JSON.stringify({
+							type: "GetBook",
+							data: {
+								room: message.room,
+								player: this.state.player_name,
+								instrument: message.symbol
+							}
+						}));
+					}
+					break;
 				case "OrderUpdate":
 					console.log('Received new order')
 					let books_copy = this.state.books;
 					books_copy.onNewOrders(message)
 					this.setState({books : books_copy});
 					break;
-				case "Trade":
-					console.log('Received trades')
-					console.log(message.data)
-					this.setState({trades : message.data.reverse()});
+				case "TradeUpdate":
+					if (message.data.seq === this.lastTradeSeq() + 1) {
+						this.setState({trades : [message.data, ...this.state.trades]});
+					} else if (message.data.seq > this.lastTradeSeq() + 1) {
+						this.requestTrades(this.lastTradeSeq() + 1);
+					}
+					break;
+				case "Trades":
+					console.log('Received page of trades')
+					const last_seq = this.lastTradeSeq();
+					const page = message.data.trades.filter((t) => t.seq > last_seq);
+					if (page.length > 0 && page[0].seq === last_seq + 1) {
+						this.setState({trades : [...page.reverse(), ...this.state.trades]});
+					}
+					const received_seq = page.length > 0 ? page[0].seq : last_seq;
+					if (received_seq < message.data.last_seq) {
+						this.requestTrades(received_seq + 1);
+					}
 					break;
 				case "Settlement":
 					console.log('Settlement received')
@@ -153,6 +200,32 @@ export class Game extends React.Component {
 		};
 	};
 
+	// The room that a message is about, null for lobby messages
+	roomOf(message) {
+		if (message.room !== undefined) {
+			return message.room;
+		} else if (message.data && message.data.room !== undefined) {
+			return message.data.room;
+		}
+		return null;
+	}
+
+	lastTradeSeq() {
+		return this.state.trades.length > 0 ? this.state.trades[0].seq : 0;
+	}
+
+	requestTrades(from_seq) {
+		this.state.ws.send("")
+		this.state.ws.send(JSON.stringify({
+			type: "GetTrades",
+			data: {
+				room: this.state.current_room,
+				player: this.state.player_name,
+				from_seq: from_seq
+			}
+		}));
+	}
+
 	handleOrderValueChange(changedValues, allValues) {
 		this.setState({...changedValues});
 	}
@@ -182,9 +255,22 @@ export class Game extends React.Component {
 			console.log('Please enter name first...')
 		}
 		else {
-			this.setState({
-				current_room: r
-			});
+			if (r !== this.state.current_room) {
+				// Clear what was shown of the previous room, the new room sends its own
+				this.setState({
+					current_room: r,
+					current_players: [],
+					cards: {"A": [], "B": []},
+					revealed_cards: {"A": [], "B": []},
+					status: "none",
+					instruments: [],
+					positions: [],
+					orders: [],
+					trades: [],
+					pnl: null,
+					live_pnl: null,
+				});
+			}
 			this.state.ws.send("")
 			this.state.ws.send(JSON.stringify({
 				type: "JoinRoom", data: {room: r, player: this.state.player_name}
@@ -205,6 +291,7 @@ export class Game extends React.Component {
 			orders: [],
 			trades: [],
 			pnl: null,
+			live_pnl: null,
 		});
 		this.state.ws.send("")
 		this.state.ws.send(JSON.stringify({
@@ -291,17 +378,34 @@ export class Game extends React.Component {
 
 	handleCancelOrder(instrument, price, direction) {
 		console.log(`Cancelling order for ${instrument} ${price} ${direction}`)
-		this.state.ws.send("")
-		this.state.ws.send(JSON.stringify({
-			type: "CancelOrder", 
-			data: {
-				room: this.state.current_room,
-				player: this.state.player_name,
-				instrument: instrument,
-				price: price,
-				direction: direction
-			}
-		}));
+		const order_ids = this.state.books.getActiveOrderID(
+			this.state.current_room, instrument, price.toString()
+		);
+		if (order_ids.length === 0) {
+			this.state.ws.send("")
+			this.state.ws.send(JSON.stringify({
+				type: "CancelOrder", 
+				data: {
+					room: this.state.current_room,
+					player: this.state.player_name,
+					instrument: instrument,
+					price: price,
+					direction: direction
+				}
+			}));
+		}
+		order_ids.forEach((order_id) => {
+			this.state.ws.send("")
+			this.state.ws.send(JSON.stringify({
+				type: "CancelOrder", 
+				data: {
+					room: this.state.current_room,
+					player: this.state.player_name,
+					instrument: instrument,
+					order_id: order_id
+				}
+			}));
+		});
 	}
 
 	shouldComponentUpdate(nextProps, nextState) {
@@ -315,8 +419,8 @@ export class Game extends React.Component {
 	}
 
 	render() {
-		const books = this.state.books.getBook();
-		const orders = this.state.books.getAggregatedActiveOrders();
+		const books = this.state.books.getBook(this.state.current_room);
+		const orders = this.state.books.getAggregatedActiveOrders(this.state.current_room);
 		const trades = this.state.trades;
 		return (
 			<div className="game_wrapper">
@@ -378,6 +482,7 @@ export class Game extends React.Component {
 						<Positions
 							instruments={this.state.instruments}
 							positions={this.state.positions}
+							pnl={this.state.live_pnl}
 						/>
 						<Instruments
 							instruments={this.state.instruments}
@@ -425,7 +530,7 @@ class Trades extends React.Component {
 				<div className="trades_body">
 					{trades.map((t) => {
 						return (
-							<div className={`trades_row ${t['direction']}`} key={t['timestamp']}>
+							<div className={`trades_row ${t['direction']}`} key={t['seq']}>
 								<div className="trades_instrument">
 									{t['instrument']}
 								</div>
@@ -512,7 +617,7 @@ class Positions extends React.Component {
 		const n_instruments = this.props.instruments.length;
 		return (
 			<div className="positions_wrapper">
-				<h1>Positions</h1>
+				<h1>Positions {this.props.pnl !== null ? `(PnL: ${Math.round(this.props.pnl * 100) / 100})` : ""}</h1>
 				<div className="position_row heading" key="heading">
 								<div className="position_instrument">
 									Instrument
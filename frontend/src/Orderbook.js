@@ -1,24 +1,37 @@
 export class Orderbook {
   constructor() {
     console.log("Creating new book...");
-    this.book = {};
-    this.orders = {};
+    this.rooms = {};
   }
 
   copy() {
     return this;
   }
 
-  getBook() {
-    return JSON.parse(JSON.stringify(this.book));
+  // The books, sequence numbers and orders of a room, each keyed by
+  // symbol, as the same symbol is traded in every room
+  room(name) {
+    if (!this.rooms[name]) {
+      this.rooms[name] = {
+        book: {},
+        seq: {},
+        orders: {},
+      };
+    }
+    return this.rooms[name];
+  }
+
+  getBook(room) {
+    return JSON.parse(JSON.stringify(this.room(room).book));
   }
 
-  getAggregatedActiveOrders() {
+  getAggregatedActiveOrders(room) {
     let out = {};
-    const symbols = Object.keys(this.orders);
+    const orders = this.room(room).orders;
+    const symbols = Object.keys(orders);
     symbols.forEach((s) => {
       out[s] = {};
-      Object.values(this.orders[s]).forEach((o) => {
+      Object.values(orders[s]).forEach((o) => {
         if (o.active) {
           const price = o.price;
           if (Object.keys(out[s]).includes(price.toString())) {
@@ -35,9 +48,10 @@ export class Orderbook {
     return out;
   }
 
-  getActiveOrderID(symbol, price) {
+  getActiveOrderID(room, symbol, price) {
     let out = [];
-    const orders = this.orders[symbol];
+    const room_orders = this.room(room).orders;
+    const orders = room_orders[symbol] ? room_orders[symbol] : {};
     Object.values(orders).forEach((o) => {
       if (o.price.toString() === price && o.active) {
         out.push(o.order_id);
@@ -48,38 +62,57 @@ export class Orderbook {
 
   onUpdate(message) {
     const symbol = message.symbol;
-    if (!this.book[symbol]) {
-      console.log(`Initialising ${symbol}`);
-      this.book[symbol] = {
-        ask: {},
-        bid: {},
-      };
+    const room = this.room(message.room);
+    if (!room.book[symbol]) {
+      console.log(`Initialising ${symbol} in ${message.room}`);
     }
 
-    this.book[symbol] = {
+    room.book[symbol] = {
       ask: {},
       bid: {},
     };
     message.data.forEach((update) => {
-      this.updateBook(symbol, update);
+      this.updateBook(room.book, symbol, update);
+    });
+    room.seq[symbol] = message.seq;
+  }
+
+  // Applies an OrderbookDelta, returns false if a delta has been
+  // missed and a new snapshot is needed
+  onDelta(message) {
+    const symbol = message.symbol;
+    const room = this.room(message.room);
+    if (!room.book[symbol] || message.seq !== room.seq[symbol] + 1) {
+      return false;
+    }
+    message.data.forEach((update) => {
+      if (update.size === 0) {
+        this.deleteEntry(room.book, symbol, update);
+      } else {
+        this.updateBook(room.book, symbol, update);
+      }
     });
+    room.seq[symbol] = message.seq;
+    return true;
   }
 
   onDelete(message) {
     const symbol = message.symbol;
+    const book = this.room(message.room).book;
     message.data.forEach((pp) => {
-      this.deleteEntry(symbol, pp);
+      this.deleteEntry(book, symbol, pp);
     });
   }
 
   onNewOrders(message) {
     const data = message.data;
     const instrument = data.instrument;
-    if (!this.orders[instrument]) {
-      this.orders[instrument] = {};
+    const orders = this.room(message.room).orders;
+    if (!orders[instrument]) {
+      orders[instrument] = {};
     }
     const order_id = data.order_id;
-    this.orders[instrument][order_id] = {
+    orders[instrument][order_id] = {
       active: data.status === 'active' ? true : false,
       price: data.price,
       size: data.remaining_size,
@@ -90,23 +123,24 @@ export class Orderbook {
 
   onUpdateOrders(message) {
     const data = message.data;
+    const orders = this.room(message.room).orders;
     for (let i = 0; i < data.length; i++) {
       const order_id = data[i].order_id;
       const active = data[i].active;
       const size = data[i].size;
       const price = data[i].price;
 
-      const symbols = Object.keys(this.orders);
+      const symbols = Object.keys(orders);
       for (let j = 0; j < symbols.length; j++) {
         const s = symbols[j];
-        if (Object.keys(this.orders[s]).includes(order_id)) {
-          this.orders[s][order_id].active = active ? active : false;
-          this.orders[s][order_id].size = size
+        if (Object.keys(orders[s]).includes(order_id)) {
+          orders[s][order_id].active = active ? active : false;
+          orders[s][order_id].size = size
             ? size
-            : this.orders[s][order_id].size;
-          this.orders[s][order_id].price = price
+            : orders[s][order_id].size;
+          orders[s][order_id].price = price
             ? price
-            : this.orders[s][order_id].price;
+            : orders[s][order_id].price;
         }
       }
     }
@@ -114,26 +148,27 @@ export class Orderbook {
 
   onDeleteOrders(message) {
     const data = message.data;
-    const symbols = Object.keys(this.orders);
+    const orders = this.room(message.room).orders;
+    const symbols = Object.keys(orders);
     for (let i = 0; i < data.length; i++) {
       const order_id = data[i];
       for (let j = 0; j < symbols.length; j++) {
         const s = symbols[j];
-        delete this.orders[s][order_id];
+        delete orders[s][order_id];
       }
     }
   }
 
-  updateBook(symbol, update) {
+  updateBook(book, symbol, update) {
     const type = update.type; // 'ask' or 'bid'
     const price = update.price;
     const size = update.size;
-    this.book[symbol][type][price] = size;
+    book[symbol][type][price] = size;
   }
 
-  deleteEntry(symbol, pp) {
+  deleteEntry(book, symbol, pp) {
     const type = pp.type;
     const price = pp.price;
-    delete this.book[symbol][type][price];
+    delete book[symbol][type][price];
   }
 }
@@ -6,15 +6,30 @@ import os
 import sys
 
 import backend.server as server
+import util.log as log
 
 def main(argv):
+    if argv and argv[0] == 'replay':
+        from backend.replay import main as replay
+        return replay(argv[1:])
+
     help_string = '''manage.py 
         -H [--host] <host (localhost)>
         -p [--port] <port (8888)> 
-        -d [--debug]'''
+        -w [--workers] <number of room worker processes (0)>
+        -s [--slow-consumers] <drop|resync|disconnect (resync)>
+        -i [--publish-interval] <milliseconds between book deltas (20)>
+        -j [--journal] <directory to journal to and recover from (none)>
+        -m [--metrics-port] <port to serve Prometheus metrics on at localhost (none)>
+        -t [--stall-threshold] <milliseconds a callback may block the event loop for (none)>
+        -P [--profile-dir] <directory to write the profiles started and stopped by SIGUSR1 to (.)>
+        -d [--debug]
+    manage.py replay <file> to replay a recording of order flow offline'''
     try:
         opts, _ = getopt.getopt(
-            argv, 'p:d', ['port=', 'debug'])
+            argv, 'hH:p:w:s:i:j:m:t:P:d',
+            ['host=', 'port=', 'workers=', 'slow-consumers=', 'publish-interval=', 'journal=',
+             'metrics-port=', 'stall-threshold=', 'profile-dir=', 'debug'])
     except getopt.GetoptError:
         print(help_string)
         return 1
@@ -28,6 +43,13 @@ def main(argv):
         port = 8887
         host = 'localhost'
     debug = False
+    workers = 0
+    slow_consumers = 'resync'
+    publish_interval = 20
+    journal_dir = None
+    metrics_port = None
+    stall_threshold = None
+    profile_dir = '.'
 
     for opt, arg in opts:
         if opt == '-h':
@@ -37,15 +59,40 @@ def main(argv):
             port = str(arg)
         elif opt in ('-H', '--host'):
             host = str(arg)
+        elif opt in ('-w', '--workers'):
+            workers = int(arg)
+        elif opt in ('-s', '--slow-consumers'):
+            slow_consumers = str(arg)
+        elif opt in ('-i', '--publish-interval'):
+            publish_interval = float(arg)
+        elif opt in ('-j', '--journal'):
+            journal_dir = str(arg)
+        elif opt in ('-m', '--metrics-port'):
+            metrics_port = int(arg)
+        elif opt in ('-t', '--stall-threshold'):
+            stall_threshold = float(arg)
+        elif opt in ('-P', '--profile-dir'):
+            profile_dir = str(arg)
         elif opt in ('-d', '--debug'):
             debug = True
 
     print('-' * 60)
     print(f'Running on port {host}:{port}')
     print(f'Debug mode is {debug}')
+    print(f'Running rooms on {workers} worker processes' if workers else 'Running rooms in process')
+    print(f'Journaling to {journal_dir}' if journal_dir else 'Not journaling')
+    print(f'Serving metrics on port {metrics_port}' if metrics_port else 'Not serving metrics')
+    print(f'Reporting event loop stalls over {stall_threshold}ms' if stall_threshold else 'Not watching for stalls')
+    print(f'Send SIGUSR1 to pid {os.getpid()} to start or stop profiling into {profile_dir}')
     print('-' * 60)
 
-    asyncio.run(server.main(port=port, host=host))
+    log.set_level(log.DEBUG if debug else log.INFO)
+    asyncio.run(server.main(
+        port=port, host=host, workers=workers, slow_consumers=slow_consumers,
+        room_options={'publish_interval' : publish_interval / 1000},
+        journal_dir=journal_dir, metrics_port=metrics_port,
+        stall_threshold=stall_threshold / 1000 if stall_threshold else None, profile_dir=profile_dir
+    ))
 
     return 0
 
@@ -5,41 +5,73 @@ book.py
 22/03/2020 Colin Huang
 
 Basic OrderBook class
-The book is zero indexed at the top of the book for both 
-bids and asks. Bids and asks are lists of PricePoints
+Bids and asks are each held in a PriceLadder, an array of
+PricePoints addressed by absolute tick. An occupancy bitmap
+tracks which ticks hold a PricePoint so that the best price
+can be found without walking through empty levels.
 
-- Updating top of book:     O(n)
-- Updating end of book:     O(1)
+- Updating top of book:     O(1) amortised
+- Updating end of book:     O(1) amortised
 - Updating existing price:  O(1)
 - get_quote():              O(1)
 - as_string():              O(n)
-- top_n(n):                 O(1)
+- top_n(n):                 O(n)
 
 PricePoint is a simple container for a price and a size
 Important assignment and comparison operations on PricePoints
 are overloaded so that they can be used easily
+
+Orders, their queues and PricePoints use __slots__, and an Order refers
+to its player and instrument by interned integer ids rather than by
+holding other objects. Orders that are filled or cancelled leave the
+book for an OrderArchive that only keeps the last few as tuples.
 '''
 
 import abc
 import json
-from collections import deque
+from collections import deque, namedtuple
+from itertools import islice
+
+import util.log as log
+
+# Events produced by the OrderBook as it matches. The book does no I/O,
+# the Room applies these to positions and the tape and publishes them.
+Fill = namedtuple('Fill', ['order', 'price', 'size', 'aggressor'])
+OrderState = namedtuple('OrderState', ['order'])  # Order was added, reduced or cancelled
+LevelChange = namedtuple('LevelChange', ['symbol', 'direction', 'price', 'size'])
 
-import util.helpers as util
+_name_ids = {}      # Player or instrument name -> id
+_names = []         # Id -> name
+
+def get_name_id(name: str) -> int:
+    name_id = _name_ids.get(name)
+    if name_id is None:
+        name_id = _name_ids[name] = len(_names)
+        _names.append(name)
+    return name_id
+
+class Order:
+    __slots__ = (
+        '_direction', '_order_id', '_player_id', '_instrument_id', '_price', '_size',
+        '_remaining_size', '_status', '_prev', '_next'
+    )
 
-class Order(abc.ABC):
     def __init__(
-        self, player, room, order_id : str, price : float, size : int, direction : str, instrument: str
+        self, player_name : str, order_id : int, price : float, size : int, direction : str, instrument: str
     ):
         self._direction = direction
         self._order_id = order_id
-        self._player = player
-        self._room = room
+        self._player_id = get_name_id(player_name)
+        self._instrument_id = get_name_id(instrument)
         self._price = int(price)
         self._size = int(size)
-        self._remaining_size = size
-        self._instrument = instrument
+        self._remaining_size = self._size
         self._status = 'active'
 
+        # Neighbours in the queue of the PricePoint the order rests in
+        self._prev = None
+        self._next = None
+
     def get_size(self):
         return self._remaining_size
 
@@ -56,13 +88,16 @@ class Order(abc.ABC):
         return self._order_id
 
     def get_player_name(self):
-        return self._player._player_name
+        return _names[self._player_id]
 
-    async def send_update(self):
-        payload = {
+    def get_instrument(self):
+        return _names[self._instrument_id]
+
+    def as_update(self):
+        return {
             'type' : 'OrderUpdate',
             'data' : {
-                'instrument' : self._instrument,
+                'instrument' : _names[self._instrument_id],
                 'order_id' : self._order_id,
                 'size' : self._size,
                 'remaining_size' : self._remaining_size,
@@ -71,29 +106,8 @@ class Order(abc.ABC):
                 'status' : self._status,
             }
         }
-        await self._player.send_message(payload)
-
-    async def send_trade(self, size, price):
-        if self._direction == 'ask':
-            trade_direction = 'sell'
-        elif self._direction == 'bid':
-            trade_direction = 'buy'
-        if price is None:
-            price = self._price
-        else:
-            price = price
-
-        payload = {
-            'type' : 'TradeUpdate',
-            'data' : {
-                'price' : price,
-                'size' : self._size,
-                'direction' : trade_direction
-            }
-        }
-        await self._player.send_message(payload)
 
-    async def fill(self, size, price=None):
+    def fill(self, size):
         if size > self._remaining_size:
             raise Exception('Trying to fill more than existing size')
         else:
@@ -102,38 +116,28 @@ class Order(abc.ABC):
         if self._remaining_size == 0:
             self._status = 'filled'
 
-        await self.send_update()
-        await self.send_trade(size, price)
-
-        if price is None:
-            util.print_core(f'Filled {size} at a price {self._price} ({self._player._player_name}) (maker)')
-        else:
-            util.print_core(f'Filled {size} at a price {price} ({self._player._player_name}) (taker)')
-            await self._room.new_trade(self._instrument, self._price, size, self._direction)
-
-        if price is None:
-            await self._room.update_positions(
-                self._player._player_name, 
-                self._instrument, 
-                self._price, size,
-                self._direction
-            )
-        else:
-            await self._room.update_positions(
-                self._player._player_name, 
-                self._instrument, 
-                price, size,
-                self._direction
-            )
-
-    async def cancel_order(self):
+    def cancel_order(self):
         self._status = 'cancelled'
         self._remaining_size = 0
-        await self.send_update()
+
+    def reduce(self, size):
+        if size >= self._remaining_size:
+            raise Exception('Trying to reduce by more than existing size')
+        self._remaining_size -= size
+        self._size -= size
+
+    def amend(self, price, remaining_size):
+        '''
+        Changes the price and remaining size of the order, keeping
+        what has already been filled in its size
+        '''
+        self._size += remaining_size - self._remaining_size
+        self._remaining_size = remaining_size
+        self._price = int(price)
 
     def __eq___(self, other):
         if isinstance(other, Order):
-            if (self._order_id == other._order_id and self._instrument == other._instrument):
+            if (self._order_id == other._order_id and self._instrument_id == other._instrument_id):
                 return True
             else:
                 return False
@@ -146,52 +150,134 @@ class Order(abc.ABC):
         return {
             'direction': self._direction,
             'price': self._price,
-            'player': self._player._player_name,
-            'room' : self._room._name,
+            'player': _names[self._player_id],
+            'instrument' : _names[self._instrument_id],
             'size' : self._size,
             'remaining_size' : self._remaining_size,
             'status': self._status,
             'order_id' : self._order_id,
         }
 
-class PricePoint(abc.ABC):
+class OrderQueue:
+    '''
+    Doubly linked FIFO of Orders, the Orders themselves are the nodes.
+    Supports the parts of the deque interface used by PricePoint, with
+    remove() being O(1) since an Order knows its neighbours.
+    '''
+
+    __slots__ = ('_head', '_tail', '_len')
+
+    def __init__(self):
+        self._head = None
+        self._tail = None
+        self._len = 0
+
+    def append(self, order):
+        order._prev = self._tail
+        order._next = None
+        if self._tail is None:
+            self._head = order
+        else:
+            self._tail._next = order
+        self._tail = order
+        self._len += 1
+
+    def appendleft(self, order):
+        order._prev = None
+        order._next = self._head
+        if self._head is None:
+            self._tail = order
+        else:
+            self._head._prev = order
+        self._head = order
+        self._len += 1
+
+    def popleft(self):
+        order = self._head
+        if order is None:
+            raise IndexError('pop from an empty OrderQueue')
+        self.remove(order)
+        return order
+
+    def remove(self, order):
+        if order._prev is None:
+            self._head = order._next
+        else:
+            order._prev._next = order._next
+        if order._next is None:
+            self._tail = order._prev
+        else:
+            order._next._prev = order._prev
+        order._prev = None
+        order._next = None
+        self._len -= 1
+
+    def __iter__(self):
+        order = self._head
+        while order is not None:
+            nxt = order._next
+            yield order
+            order = nxt
+
+    def __len__(self):
+        return self._len
+
+class PricePoint:
     '''
     A PricePoint contains a price and a size at the price
     No information about bid / ask is given
     '''
 
+    __slots__ = ('price', 'size', 'type', 'queue')
+
     def __init__(self, price):
-        util.print_core('Initiallising new price point!')
+        if log.DEBUG_ON:
+            log.debug('Initiallising new price point!')
         self.price = price
         self.size = 0
         self.type = None # ask, bid
-        self.queue = deque([])
-
-    async def cancel_order(self, player_name):
-        removal = []
-        for o in self.queue:
-            if o.get_player_name() == player_name:
-                self.size -= o.get_size()
-                await o.cancel_order()
-                removal.append(o)
-        if len(removal) == 0:
-            util.print_core(f'Unable to find any orders for {player_name}')
-        else:
-            for o in removal:
-                self.queue.remove(o)
-                util.print_core(f'Removing {o.get_order_id()} from queue')
-            print(self)
+        self.queue = OrderQueue()
+
+    def cancel_order(self, order : Order):
+        self.remove_order(order)
+        order.cancel_order()
+
+    def remove_order(self, order : Order):
+        '''
+        Takes a resting order out of the queue, leaving it as it is
+        '''
+        self.size -= order.get_size()
+        self.queue.remove(order)
+        if log.DEBUG_ON:
+            log.debug(f'Removing {order.get_order_id()} from queue')
 
         if self.size == 0:
             self.type = None
 
-    async def new_order(self, order : Order):
-        util.print_core(f'Processing new order at price: {self.price}!')
+    def reduce_order(self, order : Order, size : int):
+        '''
+        Reduces the size of a resting order without losing queue priority
+        '''
+        order.reduce(size)
+        self.size -= size
+
+    def new_order(self, order : Order, events : list):
+        '''
+        Adds the order to the queue or, if it is on the opposite side,
+        matches it against the queue, appending a Fill to events for
+        each side of every match. Any remainder of a matching order
+        is left for the OrderBook to rest elsewhere.
+        Returns the resting orders that were completely filled.
+        '''
+        if log.DEBUG_ON:
+            log.debug(f'Processing new order at price: {self.price}!')
         size = order.get_size()
         ask_bid = order.get_direction()
+        filled = []
         
         if self.type is None:
-            util.print_core(f'No current orders at {self.price}!')
+            if log.DEBUG_ON:
+                log.debug(f'No current orders at {self.price}!')
             self.type = ask_bid
             self.size += size
             self.queue.append(order)
@@ -199,39 +285,27 @@ class PricePoint(abc.ABC):
             self.size += size
             self.queue.append(order)
         elif self.type != ask_bid: # There is overlap in the price points
-            util.print_core('Overlap found in PricePoint')
+            if log.DEBUG_ON:
+                log.debug('Overlap found in PricePoint')
             remaining_size = size
-            if size <= self.size:
-                while remaining_size != 0:
-                    top_order = self.queue.popleft()
-                    top_size = top_order.get_size()
-                    if top_size <= remaining_size:
-                        await top_order.fill(top_size)
-                        await order.fill(top_size, price=self.price)
-                        remaining_size -= top_size
-                        self.size -= top_size
-                    else:
-                        await top_order.fill(remaining_size)
-                        await order.fill(remaining_size, price=self.price)
-                        self.size -= remaining_size
-                        remaining_size -= remaining_size
-                        self.queue.appendleft(top_order)
-            else:
-                while self.size != 0:
-                    top_order = self.queue.popleft()
-                    top_size = top_order.get_size()
-                    await top_order.fill(top_size)
-                    await order.fill(top_size, price=self.price)
-                    self.size -= top_size
-                    remaining_size -= top_size
-
-                if order.get_price() == self.price:
-                    self.queue.append(order)
-                    self.type = ask_bid
-                    self.size = remaining_size
-                    util.print_core(f'Order was partially filled {remaining_size} remains')
+            while remaining_size != 0 and self.size != 0:
+                top_order = self.queue.popleft()
+                fill_size = min(top_order.get_size(), remaining_size)
+                top_order.fill(fill_size)
+                order.fill(fill_size)
+                events.append(Fill(top_order, self.price, fill_size, False))
+                events.append(Fill(order, self.price, fill_size, True))
+                remaining_size -= fill_size
+                self.size -= fill_size
+                if top_order.get_size() == 0:
+                    filled.append(top_order)
+                else:
+                    self.queue.appendleft(top_order)
+            if remaining_size != 0 and log.DEBUG_ON:
+                log.debug(f'Order was partially filled {remaining_size} remains')
         else:
-            util.print_core(f'Strange behavour: {self.type}, {ask_bid}')
+            log.warning(f'Strange behavour: {self.type}, {ask_bid}')
+        return filled
 
     def get_price(self):
         return self.price
@@ -299,41 +373,368 @@ class PricePoint(abc.ABC):
             'queue' : [o.as_dict() for o in self.queue]
         }, indent=4)
 
+class PriceLadder(abc.ABC):
+    '''
+    One side of an OrderBook
+
+    PricePoints are stored in a preallocated list indexed by absolute
+    tick (price / tick_size) relative to the lowest tick of the ladder.
+    A python int is used as an occupancy bitmap so that the next best
+    price is found with a couple of bit operations rather than walking
+    through the empty levels. The ladder only grows (by doubling) when
+    a price falls outside of the preallocated range.
+    '''
+
+    def __init__(self, side: str, tick_size: float, low: float = 0, high: float = 0):
+        if side not in ('bid', 'ask'):
+            raise TypeError('Must be bid or ask')
+        self.side = side
+        self.tick_size = tick_size
+
+        self._base = self.tick(low)   # Tick stored at index zero
+        self._levels = [None] * (self.tick(high) - self._base + 1)
+        self._bits = 0                # Bit i is set if _levels[i] is occupied
+        self._best = None             # Index of the best PricePoint
+        self._n_levels = 0
+
+    def tick(self, price):
+        return int(round(price / self.tick_size))
+
+    def _index(self, price):
+        return self.tick(price) - self._base
+
+    def _grow(self, i):
+        '''
+        Extends the ladder so that index i (relative to the current base)
+        is addressable. The range is at least doubled to keep growth
+        amortised O(1).
+        '''
+        capacity = len(self._levels)
+        if i < 0:
+            shift = max(-i, capacity)
+            self._levels[0:0] = [None] * shift
+            self._bits <<= shift
+            self._base -= shift
+            if self._best is not None:
+                self._best += shift
+        else:
+            self._levels += [None] * max(i - capacity + 1, capacity)
+
+    def _find_best(self):
+        bits = self._bits
+        if bits == 0:
+            return None
+        elif self.side == 'bid':
+            return bits.bit_length() - 1
+        else:
+            return (bits & -bits).bit_length() - 1
+
+    def get(self, price):
+        i = self._index(price)
+        if 0 <= i < len(self._levels):
+            return self._levels[i]
+        return None
+
+    def insert(self, pp):
+        i = self._index(pp.get_price())
+        if i < 0 or i >= len(self._levels):
+            self._grow(i)
+            i = self._index(pp.get_price())
+        if self._levels[i] is None:
+            self._n_levels += 1
+        self._levels[i] = pp
+        self._bits |= 1 << i
+
+        if (
+            self._best is None or
+            (self.side == 'bid' and i > self._best) or
+            (self.side == 'ask' and i < self._best)
+        ):
+            self._best = i
+
+    def remove(self, price) -> bool:
+        i = self._index(price)
+        if i < 0 or i >= len(self._levels) or self._levels[i] is None:
+            return False
+        self._levels[i] = None
+        self._bits &= ~(1 << i)
+        self._n_levels -= 1
+        if i == self._best:
+            self._best = self._find_best()
+        return True
+
+    def best(self):
+        if self._best is None:
+            return None
+        return self._levels[self._best]
+
+    def best_price(self):
+        if self._best is None:
+            return None
+        return self._levels[self._best].get_price()
+
+    def __iter__(self):
+        '''
+        Iterates over the occupied PricePoints from the best price outwards.
+        The bitmap is copied up front so levels may be removed while iterating.
+        '''
+        bits = self._bits
+        levels = self._levels
+        if self.side == 'bid':
+            while bits:
+                i = bits.bit_length() - 1
+                bits ^= 1 << i
+                yield levels[i]
+        else:
+            while bits:
+                low = bits & -bits
+                bits ^= low
+                yield levels[low.bit_length() - 1]
+
+    def __len__(self):
+        return self._n_levels
+
+ArchivedOrder = namedtuple(
+    'ArchivedOrder', ['order_id', 'player', 'price', 'size', 'direction', 'status']
+)
+
+class OrderArchive:
+    '''
+    The orders that have left a book, filled or cancelled. Only the
+    last `capacity` are kept, as ArchivedOrders, along with a count of
+    all of them.
+    '''
+
+    def __init__(self, capacity=10000):
+        self._orders = deque(maxlen=capacity)
+        self.total = 0
+
+    def append(self, order: Order):
+        self._orders.append(ArchivedOrder(
+            order._order_id, _names[order._player_id], order._price,
+            order._size, order._direction, order._status
+        ))
+        self.total += 1
+
+    def __iter__(self):
+        return iter(self._orders)
+
+    def __len__(self):
+        return len(self._orders)
+
 class OrderBook(abc.ABC):
-    def __init__(self, symbol: str, tick_size: float):
+    def __init__(
+        self, symbol: str, tick_size: float, low: float = 0, high: float = 0, archive_size: int = 10000
+    ):
+        '''
+        low and high are the expected bounds on prices for the instrument
+        and are used to preallocate the PriceLadders. The last archive_size
+        orders to leave the book are kept in its archive.
+        '''
         self.symbol = symbol
+        self.tick_size = tick_size  # The smallest increment
+        self.low = low
+        self.high = high
         self.clear()
 
-        self.tick_size = tick_size  # The smallest increment
         self.last_order_id = 0
-        self.orders = []
+        self.archive = OrderArchive(archive_size)  # Orders that have been filled or cancelled
+        self._live_orders = {}      # order_id -> Order for all resting orders
+        self._player_orders = {}    # player_name -> {order_id -> Order}
+
+        self.seq = 0                # Sequence number of the last published delta
+        self._changed = {}          # (direction, price) of levels changed since then
+
+    @property
+    def bb(self):
+        return self.bids.best_price()   # Best Bid
+
+    @property
+    def ba(self):
+        return self.asks.best_price()   # Best Ask
 
     def generate_id(self):
         self.last_order_id += 1
         return self.last_order_id
 
-    async def cancel_order(self, player_name, price, direction):
+    def get_ladder(self, direction):
         if direction == 'ask':
-            i = int((price - self.ba) / self.tick_size)
-            pp = self.asks[i]
+            return self.asks
         elif direction == 'bid':
-            i = int((self.bb - price) / self.tick_size)
-            pp = self.bids[i]
+            return self.bids
         else:
             raise ValueError('Unknown direction type')
-        
-        await pp.cancel_order(player_name)
+
+    def get_order(self, order_id):
+        return self._live_orders.get(order_id)
+
+    def get_player_orders(self, player_name):
+        return list(self._player_orders.get(player_name, {}).values())
+
+    def _register(self, order):
+        self._live_orders[order.get_order_id()] = order
+        self._player_orders.setdefault(order.get_player_name(), {})[order.get_order_id()] = order
+
+    def _unregister(self, order):
+        order_id = order.get_order_id()
+        if self._live_orders.pop(order_id, None) is not None:
+            player_orders = self._player_orders[order.get_player_name()]
+            del player_orders[order_id]
+            if not player_orders:
+                del self._player_orders[order.get_player_name()]
+            self.archive.append(order)
+
+    def cancel_order(self, player_name, price, direction):
+        '''
+        Cancels all of the orders of a player at a price
+        '''
+        orders = [
+            o for o in self.get_player_orders(player_name)
+            if o.get_price() == price and o.get_direction() == direction
+        ]
+        if len(orders) == 0:
+            log.info(f'Unable to find any orders for {player_name}')
+        events = []
+        for o in orders:
+            events += self.cancel_order_id(o.get_order_id(), player_name)
+        return events
+
+    def cancel_player_orders(self, player_name, direction=None):
+        '''
+        Cancels all of the orders of a player, or only their bids or
+        asks, in one pass. Each level touched is only reported once.
+        '''
+        events = []
+        for order in self.get_player_orders(player_name):
+            if direction is not None and order.get_direction() != direction:
+                continue
+            pp = self.get_ladder(order.get_direction()).get(order.get_price())
+            self._touch(order.get_direction(), order.get_price())
+            pp.cancel_order(order)
+            self._unregister(order)     # Archived once cancelled
+            if pp.get_size() == 0:
+                self.delete(order.get_price(), order.get_direction())
+            events.append(OrderState(order))
+        return events + self._level_changes()
+
+    def cancel_order_id(self, order_id, player_name=None):
+        '''
+        Returns the resulting events, which are empty if the order
+        is not live or does not belong to player_name
+        '''
+        order = self._live_orders.get(order_id)
+        if order is None:
+            log.info(f'Order {order_id} is not live')
+            return []
+        elif player_name is not None and order.get_player_name() != player_name:
+            log.info(f'Order {order_id} does not belong to {player_name}')
+            return []
+
+        pp = self.get_ladder(order.get_direction()).get(order.get_price())
+        self._touch(order.get_direction(), order.get_price())
+        pp.cancel_order(order)
+        self._unregister(order)     # Archived once cancelled
+        if pp.get_size() == 0:
+            self.delete(order.get_price(), order.get_direction())
+        return [OrderState(order)] + self._level_changes()
+
+    def reduce_order(self, order_id, size):
+        '''
+        Reduces the remaining size of a live order by size, keeping its
+        place in the queue. Reducing by the full size cancels the order.
+        '''
+        order = self._live_orders.get(order_id)
+        if order is None or size <= 0:
+            return []
+        elif size >= order.get_size():
+            return self.cancel_order_id(order_id)
+
+        pp = self.get_ladder(order.get_direction()).get(order.get_price())
+        self._touch(order.get_direction(), order.get_price())
+        pp.reduce_order(order, size)
+        return [OrderState(order)] + self._level_changes()
+
+    def amend_order(self, order_id, new_price=None, new_size=None, player_name=None):
+        '''
+        Changes the price and/or the remaining size of a live order,
+        keeping its id. Reducing the size keeps its place in the queue.
+        A new price or a larger size moves it to the back of the queue
+        at its price, where it may trade. A size of zero cancels it.
+        Returns the resulting events, which are empty if the order is not
+        live or does not belong to player_name.
+        '''
+        order = self._live_orders.get(order_id)
+        if order is None:
+            log.info(f'Order {order_id} is not live')
+            return []
+        elif player_name is not None and order.get_player_name() != player_name:
+            log.info(f'Order {order_id} does not belong to {player_name}')
+            return []
+
+        price = order.get_price() if new_price is None else int(new_price)
+        size = order.get_size() if new_size is None else int(new_size)
+        if size <= 0 or price <= 0:
+            return self.cancel_order_id(order_id)
+        elif price == order.get_price():
+            if size < order.get_size():
+                return self.reduce_order(order_id, order.get_size() - size)
+            elif size == order.get_size():
+                return []
+
+        direction = order.get_direction()
+        old_price = order.get_price()
+        pp = self.get_ladder(direction).get(old_price)
+        self._touch(direction, old_price)
+        pp.remove_order(order)
+        order.amend(price, size)
+        events = [OrderState(order)]
+        if price == old_price:
+            pp.new_order(order, events)     # Back of the queue, keeping the level
+            return events + self._level_changes()
         if pp.get_size() == 0:
-            self.delete(price, direction)
+            self.delete(old_price, direction)
+        self.match(order, events)
+        if order.get_status() != 'active':
+            self._unregister(order)
+        return events + self._level_changes()
+
+    def _touch(self, direction, price):
+        self._changed[(direction, price)] = None
+
+    def _level_changes(self):
+        '''
+        Turns the levels touched by the last operation into LevelChanges
+        carrying their new size (zero if the level is now empty)
+        '''
+        events = []
+        for direction, price in self._changed:
+            pp = self.get_ladder(direction).get(price)
+            events.append(LevelChange(
+                self.symbol, direction, price, 0 if pp is None else pp.get_size()
+            ))
+        self._changed = {}
+        return events
+
+    def delta(self, levels):
+        '''
+        Returns an OrderbookDelta for an iterable of LevelChanges with the
+        next sequence number so clients can detect a gap and ask for a snapshot
+        '''
+        self.seq += 1
+        return {
+            'type' : 'OrderbookDelta',
+            'symbol' : self.symbol,
+            'seq' : self.seq,
+            'data' : [
+                {'price' : l.price, 'size' : l.size, 'type' : l.direction} for l in levels
+            ]
+        }
 
     def as_dict(self):
-        a = [x for x in self.asks if x is not None]
-        b = [x for x in self.bids if x is not None]
-
         out = {
             'symbol': self.symbol,
-            'bids': b,
-            'asks': a,
+            'bids': list(self.bids),
+            'asks': list(self.asks),
             'bb': self.bb,
             'ba': self.ba
         }
@@ -343,280 +744,158 @@ class OrderBook(abc.ABC):
         return self.as_string(indent=4)
 
     def as_string(self, indent=None):
-        symbol = self.symbol
-        asks = [x.as_dict('ask') for x in self.asks if x is not None]
-        bids = [x.as_dict('bid') for x in self.bids if x is not None]
-
-        out = {}
-        out['type'] = 'OrderbookUpdate'
-        out['symbol'] = symbol
-        out['data'] = asks + bids
-        return json.dumps(out, indent=indent)
+        return json.dumps(self.as_update(), indent=indent)
 
     def as_update(self):
         symbol = self.symbol
-        asks = [x.as_dict('ask') for x in self.asks if x is not None]
-        bids = [x.as_dict('bid') for x in self.bids if x is not None]
+        asks = [x.as_dict('ask') for x in self.asks]
+        bids = [x.as_dict('bid') for x in self.bids]
 
         out = {}
         out['type'] = 'OrderbookUpdate'
         out['symbol'] = symbol
+        out['seq'] = self.seq
         out['data'] = asks + bids
         return out
 
     def top_n(self, n):
-        try:
-            asks = [x.as_dict('ask') for x in self.asks if x is not None][:n]
-            bids = [x.as_dict('bid') for x in self.bids if x is not None][:n]
-
-            out = {}
-            out['type'] = 'OrderbookTopN'
-            out['symbol'] = self.symbol
-            out['data'] = asks + bids
-            return out
-        except:
-            print('Error...\n')
+        asks = [x.as_dict('ask') for x in islice(self.asks, n)]
+        bids = [x.as_dict('bid') for x in islice(self.bids, n)]
+
+        out = {}
+        out['type'] = 'OrderbookTopN'
+        out['symbol'] = self.symbol
+        out['data'] = asks + bids
+        return out
 
     def get_quote(self):
         if len(self.bids) == 0 or len(self.asks) == 0:
             return (None, None)
-        return (self.bids[0], self.asks[0])
+        return (self.bids.best(), self.asks.best())
 
     def get_name(self):
         return self.symbol
 
     def clear(self):
-        self.bids = []
-        self.asks = []
-
-        self.bb = None  # Best Bid
-        self.ba = None  # Best Ask
-
-    async def send_orders(self, player_name):
-        for o in self.orders:
-            if o.get_player_name() == player_name:
-                await o.send_update()
-
-    async def new_order(self, order):
-        if isinstance(order, dict):
-            o = Order(
-                order['player'], 
-                order['room'], 
-                self.generate_id(), 
-                order['price'], 
-                order['size'], 
-                order['direction'],
-                order['instrument']
-            )
-            await o.send_update()
-            await self.new_order(o)
-        elif isinstance(order, Order):
-            self.orders.append(order)
-            price = order.get_price()
-            ask_bid = order.get_direction()
-            if price <= 0:
-                return
-            if ask_bid == 'ask':
-                if self.bb is not None and price <= self.bb: # Spread cross: Trade will happen for all prices >= price
-                    util.print_core(f'Matching trades')
-                    deletion = []
-                    for best_pp in self.bids:
-                        if best_pp is None:
-                            continue
-                        remaining_size = order.get_size()
-                        if remaining_size == 0:
-                            break
-                        trade_price = best_pp.get_price()
-                        if trade_price < price:
-                            break
-                        await best_pp.new_order(order)
-                        if best_pp.get_size() == 0 or best_pp.get_direction() == 'ask': # Dropped an entire pricepoint
-                            deletion.append(trade_price)
-                    for p in deletion:
-                        self.delete(p, 'bid') # Remove the zero sized ones
-                        # This should shift the best bid to leq than price
-
-                    if order.get_status() != 'filled':
-                        await self.new_order(order) # price should not be leq best bid
-                else: # No trades
-                    list_size = len(self.asks)
-                    if list_size == 0:
-                        pp = PricePoint(price)
-                        await pp.new_order(order)
-                        self.asks.append(pp)
-                        self.ba = price
-                    else:
-                        i = int((price - self.ba) / self.tick_size)
-                        if i > list_size - 1:
-                            self.asks += [None] * (i - list_size + 1)
-                            pp = PricePoint(price)
-                            await pp.new_order(order)
-                            self.asks[i] = pp
-                        elif i < 0:
-                            self.asks[0:0] = [None] * abs(i)
-                            pp = PricePoint(price)
-                            await pp.new_order(order)
-                            self.asks[0] = pp
-                            self.ba = price
-                        elif self.asks[i] is None:
-                            pp = PricePoint(price)
-                            await pp.new_order(order)
-                            self.asks[i] = pp
-                        elif self.asks[i] is not None:
-                            await self.asks[i].new_order(order)
-                        else:
-                            util.print_core('Something bad happened')
-
-            elif ask_bid == 'bid':
-                if self.ba is not None and price >= self.ba: # Spread cross: Trade will happen for all prices >= price
-                    util.print_core(f'Matching trades')
-                    deletion = []
-                    for best_pp in self.asks:
-                        if best_pp is None:
-                            continue
-                        remaining_size = order.get_size()
-                        if remaining_size == 0:
-                            break
-                        trade_price = best_pp.get_price()
-                        if trade_price > price:
-                            break
-                        await best_pp.new_order(order)
-                        if best_pp.get_size() == 0 or best_pp.get_direction() == 'bid': # Dropped an entire pricepoint
-                            deletion.append(trade_price)
-                    for p in deletion:
-                        self.delete(p, 'ask') # Remove the zero sized ones
-                        # This should shift the best ask to geq than price
-
-                    if order.get_status() != 'filled':
-                        await self.new_order(order) # price should not be leq best bid
-                else: # No trades
-                    list_size = len(self.bids)
-                    if list_size == 0:
-                        util.print_core('Currently no bids, adding first!')
-                        pp = PricePoint(price)
-                        await pp.new_order(order)
-                        self.bids.append(pp)
-                        self.bb = price
-                    else:
-                        i = int((self.bb - price) / self.tick_size)
-                        if i > list_size - 1:
-                            util.print_core('Bid is the new lowest, adding at end!')
-                            self.bids += [None] * (i - list_size + 1)
-                            pp = PricePoint(price)
-                            await pp.new_order(order)
-                            self.bids[i] = pp
-                        elif i < 0:
-                            util.print_core('Bid is the new best, adding at front!')
-                            self.bids[0:0] = [None] * abs(i)
-                            pp = PricePoint(price)
-                            await pp.new_order(order)
-                            self.bids[0] = pp
-                            self.bb = price
-                        elif self.bids[i] is None:
-                            util.print_core(f'Currently no bids at {price} - making new PricePoint')
-                            pp = PricePoint(price)
-                            await pp.new_order(order)
-                            self.bids[i] = pp
-                        elif self.bids[i] is not None:
-                            util.print_core(f'There are already bids at {price} - adding to PricePoint')
-                            await self.bids[i].new_order(order)
-                        else:
-                            util.print_core('Something bad happened')
-            else:
-                raise TypeError('Must be bid or ask')
-        else:
-            raise TypeError('Unknown type')
-
-    def delete(self, price: float, ask_bid: str) -> bool:
+        self.bids = PriceLadder('bid', self.tick_size, self.low, self.high)
+        self.asks = PriceLadder('ask', self.tick_size, self.low, self.high)
+
+    def new_order(self, order):
+        '''
+        Adds an order (given as a dict) to the book, matching it against
+        the other side if it crosses the spread.
+        Returns the resulting list of events.
+        '''
+        o = Order(
+            order['player'], 
+            self.generate_id(), 
+            order['price'], 
+            order['size'], 
+            order['direction'],
+            order['instrument']
+        )
+        events = [OrderState(o)]
+        if o.get_price() <= 0:
+            o.cancel_order() # Never rests on the book
+            self.archive.append(o)
+            return events
+        self._register(o)
+        self.match(o, events)
+        if o.get_status() != 'active':
+            self._unregister(o)
+        return events + self._level_changes()
+
+    def match(self, order, events):
+        price = order.get_price()
+        ask_bid = order.get_direction()
         if ask_bid == 'ask':
-            list_size = len(self.asks)
-            if list_size == 0:
-                return False
-            else:
-                i = int((price - self.ba) / self.tick_size)
-                if i > list_size - 1:
-                    return False
-                elif i < 0:
-                    return False
-                elif i == 0:
-                    if list_size == 1:
-                        self.asks = []
-                        self.ba = None
-                        return True
-                    n_pop = 1
-                    for i in range(1, list_size - 1):
-                        # Potentially O(n) at worst...
-                        if self.asks[i] == None:
-                            n_pop += 1
-                        else:
-                            break
-
-                    # We remove the first element and all
-                    # subsequent None elements to reset the
-                    # indexing to zero at the top of book
-                    self.asks = self.asks[n_pop:]
-                    self.ba = self.asks[0].get_price()
-                    return True
-                elif i == list_size - 1:
-                    n_pop = 1
-                    for j in range(1, list_size):
-                        if self.asks[i - j] == None:
-                            n_pop += 1
-                        else:
-                            break
-                    self.asks = self.asks[:list_size - n_pop]
-                    return True
-                else:
-                    self.asks[i] = None
-                    return True
+            if self.bb is not None and price <= self.bb: # Spread cross: Trade will happen for all prices >= price
+                if log.DEBUG_ON:
+                    log.debug(f'Matching trades')
+                deletion = []
+                for best_pp in self.bids:
+                    remaining_size = order.get_size()
+                    if remaining_size == 0:
+                        break
+                    trade_price = best_pp.get_price()
+                    if trade_price < price:
+                        break
+                    self._touch(best_pp.get_direction(), trade_price)
+                    for filled in best_pp.new_order(order, events):
+                        self._unregister(filled)
+                    if best_pp.get_size() == 0: # Dropped an entire pricepoint
+                        deletion.append(trade_price)
+                for p in deletion:
+                    self.delete(p, 'bid') # Remove the zero sized ones
+                    # This should shift the best bid to leq than price
+
+                if order.get_status() != 'filled':
+                    self.add_order(order, events) # price should not be leq best bid
+            else: # No trades
+                self.add_order(order, events)
+
         elif ask_bid == 'bid':
-            list_size = len(self.bids)
-            if list_size == 0:
-                return False
-            else:
-                i = int((self.bb - price) / self.tick_size)
-                if i > list_size - 1:
-                    return False
-                elif i < 0:
-                    return False
-                elif i == 0:
-                    util.print_core('Deleting the best bid PricePoint!')
-                    if list_size == 1:
-                        self.bids = []
-                        self.bb = None
-                        return True
-                    n_pop = 1
-                    for i in range(1, list_size):
-                        # Potentially O(n) at worst...
-                        if self.bids[i] == None:
-                            n_pop += 1
-                        else:
-                            # Update best bid
-                            break
-
-                    # We remove the first element and all
-                    # subsequent None elements to reset the
-                    # indexing to zero at the top of book
-                    self.bids = self.bids[n_pop:]
-                    self.bb = self.bids[0].get_price()
-                    return True
-                elif i == list_size - 1:
-                    util.print_core('Deleting the last bid PricePoint!')
-                    n_pop = 1
-                    for j in range(1, list_size):
-                        if self.bids[i - j] == None:
-                            n_pop += 1
-                        else:
-                            break
-                    self.bids = self.bids[:list_size - n_pop]
-                    return True
-                else:
-                    util.print_core(f'Deleting the {price} bid PricePoint!')
-                    self.bids[i] = None
-                    return True
+            if self.ba is not None and price >= self.ba: # Spread cross: Trade will happen for all prices >= price
+                if log.DEBUG_ON:
+                    log.debug(f'Matching trades')
+                deletion = []
+                for best_pp in self.asks:
+                    remaining_size = order.get_size()
+                    if remaining_size == 0:
+                        break
+                    trade_price = best_pp.get_price()
+                    if trade_price > price:
+                        break
+                    self._touch(best_pp.get_direction(), trade_price)
+                    for filled in best_pp.new_order(order, events):
+                        self._unregister(filled)
+                    if best_pp.get_size() == 0: # Dropped an entire pricepoint
+                        deletion.append(trade_price)
+                for p in deletion:
+                    self.delete(p, 'ask') # Remove the zero sized ones
+                    # This should shift the best ask to geq than price
+
+                if order.get_status() != 'filled':
+                    self.add_order(order, events) # price should not be geq best ask
+            else: # No trades
+                self.add_order(order, events)
         else:
             raise TypeError('Must be bid or ask')
 
+    def add_order(self, order, events):
+        '''
+        Rests an order that does not cross the spread on its side of the book
+        '''
+        price = order.get_price()
+        ladder = self.get_ladder(order.get_direction())
+        self._touch(order.get_direction(), price)
+        pp = ladder.get(price)
+        if pp is None:
+            if log.DEBUG_ON:
+                log.debug(f'Currently no {order.get_direction()}s at {price} - making new PricePoint')
+            pp = PricePoint(price)
+            pp.new_order(order, events)
+            ladder.insert(pp)
+        else:
+            if log.DEBUG_ON:
+                log.debug(f'There are already {order.get_direction()}s at {price} - adding to PricePoint')
+            pp.new_order(order, events)
+
+    def delete(self, price: float, ask_bid: str) -> bool:
+        '''
+        Removes a price level, cancelling any orders still resting in it
+        '''
+        if ask_bid not in ('ask', 'bid'):
+            raise TypeError('Must be bid or ask')
+        ladder = self.get_ladder(ask_bid)
+        pp = ladder.get(price)
+        if pp is not None and pp.get_size() != 0:
+            self._touch(ask_bid, price)
+            for order in list(pp.queue):
+                pp.cancel_order(order)
+                self._unregister(order)
+        return ladder.remove(price)
+
     def __eq__(self, other):
         if type(other) == str:
             return self.symbol == other
@@ -626,17 +905,15 @@ class OrderBook(abc.ABC):
             raise TypeError
 
     def __getitem__(self, key):
-        if type(key) == float: # If key is a price
-            if float >= self.ba:  # Ask
-                i = int((self.ba - key) / self.tick_size)
-                return self.asks[i]
-            elif float <= self.bb:  # Bid
-                i = int((key - self.bb) / self.tick_size)
-                return self.bids[i]
+        if isinstance(key, PricePoint):
+            return self.__getitem__(key.get_price())
+        elif isinstance(key, (int, float)): # If key is a price
+            if self.ba is not None and key >= self.ba:  # Ask
+                return self.asks.get(key)
+            elif self.bb is not None and key <= self.bb:  # Bid
+                return self.bids.get(key)
             else:
                 return None
-        elif type(key) == PricePoint:
-            return self.__getitem__(key.get_price())
 
     def __setitem__(self, key, value):
         pass
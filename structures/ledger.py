@@ -0,0 +1,168 @@
+#!/usr/bin/env python3.8
+'''
+ledger.py
+
+Positions and mark to market PnL of the players in a room
+
+Players and instruments are given ids in the order they are added, and
+each player has a row of sizes and average prices indexed by instrument
+id. CASH is instrument 0, with an average price of 1, so a fill is a
+couple of list updates whatever the number of instruments.
+
+Every instrument has a mark, the last mid price given to mark(), and a
+set of the players holding it, so that a change of mark only touches
+the PnL of those players. PnL is valued as in settlement, with the
+marks standing in for the settlement values. Instruments that have not
+been marked yet are valued at each player's average price.
+
+The (player, instrument) pairs changed since the last call to changes()
+and the players whose PnL may have moved are kept so they can be
+published in small batches.
+
+- fill():       O(1)
+- mark(i):      O(players holding i)
+- pnl(p):       O(instruments)
+'''
+
+CASH = 'CASH'
+
+class PositionLedger:
+    def __init__(self):
+        self._player_ids = {}       # Player name -> id
+        self._players = []          # Player id -> name
+        self._instrument_ids = {}   # Instrument name -> id
+        self._instruments = []      # Instrument id -> name
+        self._sizes = []            # Player id -> [size of each instrument]
+        self._averages = []         # Player id -> [average price of each instrument]
+        self._marks = []            # Instrument id -> mark, None until marked
+        self._holders = []          # Instrument id -> {player ids with a position}
+
+        self._changed = {}          # Player id -> {instrument ids changed}
+        self._moved = set()         # Player ids whose PnL may have moved
+        self.add_instrument(CASH)
+        self._marks[0] = 1
+
+    def add_player(self, player_name):
+        if player_name in self._player_ids:
+            return
+        self._player_ids[player_name] = len(self._players)
+        self._players.append(player_name)
+        n = len(self._instruments)
+        self._sizes.append([0] * n)
+        self._averages.append([1] + [0] * (n - 1))
+
+    def add_instrument(self, instrument_name):
+        if instrument_name in self._instrument_ids:
+            return
+        self._instrument_ids[instrument_name] = len(self._instruments)
+        self._instruments.append(instrument_name)
+        self._marks.append(None)
+        self._holders.append(set())
+        for sizes, averages in zip(self._sizes, self._averages):
+            sizes.append(0)
+            averages.append(0)
+
+    def fill(self, player_name, instrument_name, price, size, direction):
+        p = self._player_ids[player_name]
+        i = self._instrument_ids[instrument_name]
+        sizes = self._sizes[p]
+        averages = self._averages[p]
+        prev_size = sizes[i]
+        if direction == 'bid':
+            sizes[0] -= price * size
+            new_size = prev_size + size
+            if new_size == 0:
+                averages[i] = 0
+            else:
+                averages[i] = ((prev_size * averages[i]) + (size * price)) / new_size
+        elif direction == 'ask':
+            sizes[0] += price * size
+            new_size = prev_size - size
+            if new_size == 0:
+                averages[i] = 0
+            else:
+                averages[i] = ((prev_size * averages[i]) - (size * price)) / new_size
+        else:
+            raise ValueError(f'Unknown direction: {direction}')
+        sizes[i] = new_size
+        if new_size == 0:
+            self._holders[i].discard(p)
+        else:
+            self._holders[i].add(p)
+        changed = self._changed.get(p)
+        if changed is None:
+            changed = self._changed[p] = set()
+        changed.add(0)
+        changed.add(i)
+        self._moved.add(p)
+
+    def mark(self, instrument_name, price):
+        '''
+        Sets the mark of an instrument, e.g. to the mid of its book
+        '''
+        i = self._instrument_ids[instrument_name]
+        if price is None or price == self._marks[i]:
+            return
+        self._marks[i] = price
+        self._moved |= self._holders[i]
+
+    def get_mark(self, instrument_name):
+        return self._marks[self._instrument_ids[instrument_name]]
+
+    def pnl(self, player_name):
+        p = self._player_ids[player_name]
+        averages = self._averages[p]
+        value = 0
+        for i, size in enumerate(self._sizes[p]):
+            if size:
+                mark = self._marks[i]
+                value += size * (mark if mark is not None else averages[i])
+        return value
+
+    def position(self, player_name, instrument_name):
+        p = self._player_ids[player_name]
+        i = self._instrument_ids[instrument_name]
+        return {
+            'size' : self._sizes[p][i],
+            'average_price' : self._averages[p][i],
+        }
+
+    def positions(self, player_name):
+        '''
+        All the positions of a player, as sent in a PositionUpdate
+        '''
+        p = self._player_ids[player_name]
+        return {
+            name : {
+                'size' : size,
+                'average_price' : average,
+            } for name, size, average in zip(self._instruments, self._sizes[p], self._averages[p])
+        }
+
+    def has_changes(self):
+        return bool(self._changed or self._moved)
+
+    def changes(self):
+        '''
+        Returns the positions changed since the last call, as
+        {player name: {instrument name: position}}, and the names of the
+        players whose PnL may have moved, then forgets them
+        '''
+        changed, self._changed = self._changed, {}
+        moved, self._moved = self._moved, set()
+        players = self._players
+        instruments = self._instruments
+        positions = {}
+        for p, instrument_ids in changed.items():
+            sizes = self._sizes[p]
+            averages = self._averages[p]
+            positions[players[p]] = {
+                instruments[i] : {
+                    'size' : sizes[i],
+                    'average_price' : averages[i],
+                } for i in sorted(instrument_ids)
+            }
+        return positions, [players[p] for p in sorted(moved)]
+
+    def __contains__(self, player_name):
+        return player_name in self._player_ids
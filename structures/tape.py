@@ -0,0 +1,51 @@
+#!/usr/bin/env python3.8
+'''
+tape.py
+
+Append-only tape of the trades in a room
+
+Each trade is given a sequence number (starting at 1) when it is
+appended so it can be published on its own as a TradeUpdate, and
+clients that join late can page through the history by sequence
+number rather than being sent the whole tape.
+
+- append():     O(1)
+- page(n):      O(n)
+'''
+
+import time
+
+class TradeTape:
+    MAX_PAGE = 500   # Largest number of trades returned by a single page
+
+    def __init__(self):
+        self._trades = []
+
+    def append(self, instrument: str, price: float, size: int, direction: str):
+        trade = {
+            'seq' : len(self._trades) + 1,
+            'price' : price,
+            'size' : size,
+            'direction' : direction,
+            'instrument' : instrument,
+            'timestamp' : time.time()
+        }
+        self._trades.append(trade)
+        return trade
+
+    def page(self, from_seq: int = 1, limit: int = MAX_PAGE):
+        '''
+        Returns up to limit trades starting at sequence number from_seq
+        '''
+        start = max(int(from_seq), 1) - 1
+        limit = min(max(int(limit), 0), self.MAX_PAGE)
+        return self._trades[start:start + limit]
+
+    def last_seq(self):
+        return len(self._trades)
+
+    def __len__(self):
+        return len(self._trades)
+
+    def __iter__(self):
+        return iter(self._trades)
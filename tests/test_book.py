@@ -0,0 +1,263 @@
+#!/usr/bin/env python3.8
+'''
+test_book.py
+
+Tests of the matching in structures/book.py, run with
+
+    python -m unittest discover tests
+'''
+
+import unittest
+
+import structures.book as book
+
+def new_order(player, price, size, direction, instrument='A'):
+    return {
+        'player' : player,
+        'price' : price,
+        'size' : size,
+        'direction' : direction,
+        'instrument' : instrument,
+    }
+
+def resting_fills(events):
+    '''
+    (order_id, price, size) of the resting side of each match
+    '''
+    return [
+        (e.order.get_order_id(), e.price, e.size)
+        for e in events if isinstance(e, book.Fill) and not e.aggressor
+    ]
+
+def level_changes(events):
+    return [(e.direction, e.price, e.size) for e in events if isinstance(e, book.LevelChange)]
+
+class OrderBookTest(unittest.TestCase):
+    def setUp(self):
+        self.book = book.OrderBook('A', 1, 0, 100)
+
+    def add(self, player, price, size, direction):
+        '''
+        Adds an order, returning its id and the events
+        '''
+        events = self.book.new_order(new_order(player, price, size, direction))
+        return events[0].order.get_order_id(), events
+
+    def test_price_time_priority(self):
+        alice, _ = self.add('alice', 10, 2, 'bid')
+        bob, _ = self.add('bob', 10, 3, 'bid')
+        carol, _ = self.add('carol', 11, 1, 'bid')
+
+        _, events = self.add('dave', 10, 4, 'ask')
+        self.assertEqual(resting_fills(events), [(carol, 11, 1), (alice, 10, 2), (bob, 10, 1)])
+        self.assertEqual(self.book.bb, 10)
+        self.assertEqual(self.book.bids.best().get_size(), 2)
+        self.assertIsNone(self.book.get_order(alice))
+        self.assertEqual(self.book.get_order(bob).get_size(), 2)
+
+    def test_sweep_across_gaps(self):
+        ids = [self.add('alice', price, size, 'ask')[0] for price, size in ((20, 1), (25, 2), (40, 3))]
+
+        order_id, events = self.add('bob', 30, 5, 'bid')
+        self.assertEqual(resting_fills(events), [(ids[0], 20, 1), (ids[1], 25, 2)])
+        self.assertEqual(
+            level_changes(events), [('ask', 20, 0), ('ask', 25, 0), ('bid', 30, 2)]
+        )
+        self.assertEqual(self.book.ba, 40)
+        self.assertEqual(self.book.bb, 30)
+        self.assertEqual(len(self.book.asks), 1)
+        self.assertEqual(self.book.get_order(order_id).get_size(), 2)
+
+    def test_cancel_by_id(self):
+        alice, _ = self.add('alice', 10, 2, 'bid')
+        bob, _ = self.add('bob', 10, 3, 'bid')
+
+        self.assertEqual(self.book.cancel_order_id(alice, 'bob'), [])
+        events = self.book.cancel_order_id(alice, 'alice')
+        self.assertEqual(events[0].order.get_status(), 'cancelled')
+        self.assertEqual(level_changes(events), [('bid', 10, 3)])
+        self.assertEqual(self.book.cancel_order_id(alice), [])
+
+        events = self.book.cancel_order_id(bob)
+        self.assertEqual(level_changes(events), [('bid', 10, 0)])
+        self.assertIsNone(self.book.bb)
+        self.assertEqual(len(self.book.bids), 0)
+        self.assertEqual(self.book.get_player_orders('bob'), [])
+
+    def test_cancel_player_orders(self):
+        self.add('alice', 10, 2, 'bid')
+        self.add('alice', 12, 1, 'ask')
+        bob, _ = self.add('bob', 10, 3, 'bid')
+
+        events = self.book.cancel_player_orders('alice', 'bid')
+        self.assertEqual(level_changes(events), [('bid', 10, 3)])
+        self.assertEqual(self.book.ba, 12)
+
+        self.book.cancel_player_orders('alice')
+        self.assertIsNone(self.book.ba)
+        self.assertEqual(self.book.get_player_orders('alice'), [])
+        self.assertIsNotNone(self.book.get_order(bob))
+
+    def test_reduce_keeps_priority(self):
+        alice, _ = self.add('alice', 10, 5, 'bid')
+        bob, _ = self.add('bob', 10, 5, 'bid')
+
+        events = self.book.reduce_order(alice, 3)
+        self.assertEqual(events[0].order.get_size(), 2)
+        self.assertEqual(level_changes(events), [('bid', 10, 7)])
+
+        _, events = self.add('carol', 10, 3, 'ask')
+        self.assertEqual(resting_fills(events), [(alice, 10, 2), (bob, 10, 1)])
+
+    def test_reduce_by_full_size_cancels(self):
+        alice, _ = self.add('alice', 10, 5, 'bid')
+        events = self.book.reduce_order(alice, 5)
+        self.assertEqual(events[0].order.get_status(), 'cancelled')
+        self.assertIsNone(self.book.get_order(alice))
+        self.assertIsNone(self.book.bb)
+
+    def test_amend_smaller_keeps_priority(self):
+        alice, _ = self.add('alice', 10, 5, 'bid')
+        bob, _ = self.add('bob', 10, 5, 'bid')
+
+        self.book.amend_order(alice, new_size=2, player_name='alice')
+        _, events = self.add('carol', 10, 3, 'ask')
+        self.assertEqual(resting_fills(events), [(alice, 10, 2), (bob, 10, 1)])
+
+    def test_amend_larger_loses_priority(self):
+        alice, _ = self.add('alice', 10, 2, 'bid')
+        bob, _ = self.add('bob', 10, 5, 'bid')
+
+        events = self.book.amend_order(alice, new_size=4)
+        self.assertEqual(level_changes(events), [('bid', 10, 9)])
+        _, events = self.add('carol', 10, 6, 'ask')
+        self.assertEqual(resting_fills(events), [(bob, 10, 5), (alice, 10, 1)])
+
+    def test_amend_price_moves_and_trades(self):
+        alice, _ = self.add('alice', 10, 3, 'bid')
+        bob, _ = self.add('bob', 12, 2, 'ask')
+
+        events = self.book.amend_order(alice, new_price=12)
+        self.assertEqual(resting_fills(events), [(bob, 12, 2)])
+        self.assertEqual(
+            level_changes(events), [('bid', 10, 0), ('ask', 12, 0), ('bid', 12, 1)]
+        )
+        order = self.book.get_order(alice)
+        self.assertEqual((order.get_price(), order.get_size()), (12, 1))
+        self.assertEqual(self.book.bb, 12)
+        self.assertIsNone(self.book.ba)
+
+        self.assertEqual(self.book.amend_order(alice, new_price=11, player_name='bob'), [])
+        self.assertEqual(self.book.amend_order(alice, new_size=1), [])
+
+    def test_amend_to_zero_cancels(self):
+        alice, _ = self.add('alice', 10, 3, 'bid')
+        events = self.book.amend_order(alice, new_size=0)
+        self.assertEqual(events[0].order.get_status(), 'cancelled')
+        self.assertIsNone(self.book.get_order(alice))
+
+    def test_events(self):
+        alice, events = self.add('alice', 10, 2, 'ask')
+        self.assertEqual(len(events), 2)
+        self.assertIsInstance(events[0], book.OrderState)
+        self.assertEqual(events[0].order.get_status(), 'active')
+        self.assertEqual(events[1], book.LevelChange('A', 'ask', 10, 2))
+
+        bob, events = self.add('bob', 11, 3, 'bid')
+        self.assertIsInstance(events[0], book.OrderState)
+        self.assertIs(events[0].order, self.book.get_order(bob))
+        fills = [e for e in events if isinstance(e, book.Fill)]
+        self.assertEqual(
+            [(e.order.get_order_id(), e.price, e.size, e.aggressor) for e in fills],
+            [(alice, 10, 2, False), (bob, 10, 2, True)]
+        )
+        self.assertEqual(fills[0].order.get_status(), 'filled')
+        self.assertEqual(level_changes(events), [('ask', 10, 0), ('bid', 11, 1)])
+
+    def test_delta(self):
+        _, events = self.add('alice', 10, 2, 'ask')
+        delta = self.book.delta(e for e in events if isinstance(e, book.LevelChange))
+        self.assertEqual(delta['seq'], 1)
+        self.assertEqual(delta['data'], [{'price' : 10, 'size' : 2, 'type' : 'ask'}])
+        self.assertEqual(self.book.as_update()['seq'], 1)
+
+    def test_archive(self):
+        alice, _ = self.add('alice', 10, 2, 'bid')
+        bob, _ = self.add('bob', 10, 3, 'bid')
+        self.add('carol', 10, 2, 'ask')
+        self.book.cancel_order_id(bob)
+        self.add('dave', 20, 1, 'ask')
+        self.book.cancel_player_orders('dave')
+        self.add('erin', 0, 1, 'bid')
+
+        archived = [(o.player, o.status) for o in self.book.archive]
+        self.assertEqual(archived, [
+            ('alice', 'filled'),
+            ('carol', 'filled'),
+            ('bob', 'cancelled'),
+            ('dave', 'cancelled'),
+            ('erin', 'cancelled'),
+        ])
+        self.assertEqual(self.book.archive.total, 5)
+        self.assertEqual(self.book._live_orders, {})
+
+    def test_archive_capacity(self):
+        b = book.OrderBook('A', 1, 0, 100, archive_size=2)
+        for i in range(3):
+            b.new_order(new_order('alice', 0, 1, 'bid'))
+        self.assertEqual(len(b.archive), 2)
+        self.assertEqual(b.archive.total, 3)
+
+    def test_delete_cancels_resting_orders(self):
+        alice, _ = self.add('alice', 10, 2, 'bid')
+        bob, _ = self.add('bob', 10, 3, 'bid')
+        carol, _ = self.add('carol', 9, 1, 'bid')
+
+        self.assertTrue(self.book.delete(10, 'bid'))
+        self.assertEqual(self.book.bb, 9)
+        self.assertIsNone(self.book.get_order(alice))
+        self.assertEqual(self.book.get_player_orders('bob'), [])
+        self.assertEqual(self.book.cancel_order_id(bob), [])
+        self.assertEqual(self.book.amend_order(alice, new_size=1), [])
+        self.assertEqual(self.book._level_changes(), [book.LevelChange('A', 'bid', 10, 0)])
+        self.assertEqual([o.status for o in self.book.archive], ['cancelled', 'cancelled'])
+        self.assertFalse(self.book.delete(10, 'bid'))
+
+class PriceLadderTest(unittest.TestCase):
+    def test_growth_outside_range(self):
+        b = book.OrderBook('A', 1, 50, 60)
+        for price in (55, 10, 200, 1000):
+            b.new_order(new_order('alice', price, 1, 'bid'))
+        self.assertEqual(b.bb, 1000)
+        self.assertEqual([pp.get_price() for pp in b.bids], [1000, 200, 55, 10])
+
+        for price, size in ((5, 2), (2000, 1)):
+            b.new_order(new_order('bob', price, size, 'ask'))
+        self.assertEqual(b.ba, 2000)
+        self.assertEqual([pp.get_price() for pp in b.asks], [2000])
+        self.assertEqual(b.bb, 55)
+        self.assertEqual([pp.get_price() for pp in b.bids], [55, 10])
+
+    def test_growth_below_keeps_best(self):
+        ladder = book.PriceLadder('ask', 1, 50, 60)
+        for price in (55, 58):
+            ladder.insert(book.PricePoint(price))
+        ladder.insert(book.PricePoint(3))
+        self.assertEqual(ladder.best_price(), 3)
+        self.assertTrue(ladder.remove(3))
+        self.assertEqual(ladder.best_price(), 55)
+        self.assertIs(ladder.get(58), list(ladder)[1])
+        self.assertFalse(ladder.remove(3))
+        self.assertFalse(ladder.remove(10000))
+        self.assertEqual(len(ladder), 2)
+
+    def test_bid_iterates_from_best(self):
+        ladder = book.PriceLadder('bid', 1, 0, 10)
+        for price in (4, 9, 1, 7):
+            ladder.insert(book.PricePoint(price))
+        self.assertEqual([pp.get_price() for pp in ladder], [9, 7, 4, 1])
+        ladder.remove(9)
+        self.assertEqual(ladder.best_price(), 7)
+
+if __name__ == '__main__':
+    unittest.main()
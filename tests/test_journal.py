@@ -0,0 +1,120 @@
+#!/usr/bin/env python3.8
+'''
+test_journal.py
+
+Tests of rebuilding the lobby and the rooms of a MatchingEngine from
+the journal in backend/journal.py
+'''
+
+import asyncio
+import os
+import tempfile
+import unittest
+
+import backend.client as client
+import backend.journal as journal
+import backend.server as server
+import util.helpers as util
+
+def room_state(room):
+    '''
+    Everything the commands of a room change
+    '''
+    return {
+        'status' : room._status,
+        'players' : list(room._players),
+        'cards' : room._player_cards,
+        'instruments' : room._instruments,
+        'books' : {name : b.as_update() for name, b in room._books.items()},
+        'orders' : {
+            name : sorted((o.get_order_id(), o.get_player_name(), o.get_size()) for o in b._live_orders.values())
+            for name, b in room._books.items()
+        },
+        'trades' : [
+            {k : v for k, v in t.items() if k != 'timestamp'} for t in room._trades.page(1, 1000)
+        ],
+        'positions' : {name : room._ledger.positions(name) for name in room._players},
+    }
+
+class JournalTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.directory = self._dir.name
+        self.engines = []
+
+    async def asyncTearDown(self):
+        for engine, consumer in self.engines:
+            consumer.cancel()
+            for room in engine._lobby._rooms.values():
+                room._publisher.cancel()
+                room._position_publisher.cancel()
+                room._risk.cancel()
+        self._dir.cleanup()
+
+    def new_engine(self):
+        engine = server.MatchingEngine(
+            journal_dir=self.directory, room_options={'risk_scenarios' : 16}
+        )
+        consumer = asyncio.create_task(engine.consume(engine._q))
+        self.engines.append((engine, consumer))
+        return engine
+
+    async def settle(self, engine):
+        '''
+        Waits for the engine to process everything on its queues
+        '''
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if not any(engine.get_queue_depths().values()):
+                break
+        engine._journal.flush()
+
+    async def test_recover(self):
+        engine = self.new_engine()
+        alice = client.Client(engine, 'alice', 'R', password='secret')
+        bob = client.Client(engine, 'bob', 'R', password='hunter2')
+        engine.route({'type' : 'NewRoom', 'data' : {'name' : 'R'}}, alice)
+        alice.connect()
+        bob.connect()
+        await self.settle(engine)
+        alice.start_game()
+        await self.settle(engine)
+
+        for i in range(20):
+            alice.new_order('A', 40 + i % 5, 2, 'bid')
+            bob.new_order('A', 42 + i % 3, 1, 'ask')
+        bob.new_order('B', 50, 3, 'ask')
+        bob.amend_order('B', 1, size=1)
+        alice.cancel_order('A', 1)
+        engine.route({
+            'type' : 'NewOrder',
+            'data' : {
+                'room' : 'nope', 'player' : 'alice', 'instrument' : 'A',
+                'price' : 40, 'size' : 1, 'direction' : 'bid'
+            }
+        }, alice)
+        await self.settle(engine)
+        before = room_state(engine._lobby.get_room('R'))
+        self.assertTrue(before['trades'])
+        self.assertEqual(before['orders']['B'], [(1, 'bob', 1)])
+
+        # Commands for rooms that do not exist are not journaled
+        self.assertEqual(os.listdir(os.path.join(self.directory, 'rooms')), ['R.jsonl'])
+        # Nor are the passwords
+        with open(engine._journal.get_path(journal.LOBBY)) as f:
+            lobby = f.read()
+        self.assertNotIn('secret', lobby)
+        self.assertNotIn('hunter2', lobby)
+
+        recovered = self.new_engine()
+        await recovered.recover()
+        await self.settle(recovered)
+        self.assertEqual(recovered._lobby.get_rooms(), ['R'])
+        self.assertEqual(room_state(recovered._lobby.get_room('R')), before)
+
+        lobby = recovered._lobby
+        self.assertTrue(await lobby.new_player('alice', util.hash_password('alice', 'secret'), journal.REPLAY))
+        self.assertFalse(await lobby.new_player('alice', util.hash_password('alice', 'hunter2'), journal.REPLAY))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3.8
+'''
+test_outbox.py
+
+Tests of the conflation and the slow consumer policies of
+backend/outbox.py
+'''
+
+import asyncio
+import json
+import unittest
+
+import backend.outbox as outbox
+
+class FakeSocket:
+    subprotocol = None
+
+    def __init__(self):
+        self.sent = []
+        self.closed = None
+
+    async def send(self, payload):
+        self.sent.append(json.loads(payload))
+
+    async def close(self, code=1000, reason=''):
+        self.closed = (code, reason)
+
+def event(n):
+    return {'type' : 'Info', 'status' : str(n)}
+
+def book(room, symbol, seq):
+    return {'type' : 'OrderbookUpdate', 'room' : room, 'symbol' : symbol, 'seq' : seq, 'data' : []}
+
+class OutboxTest(unittest.IsolatedAsyncioTestCase):
+    async def drain(self):
+        for _ in range(10):
+            await asyncio.sleep(0)
+
+    async def test_conflation(self):
+        ws = FakeSocket()
+        box = outbox.Outbox(ws)
+        box.put(book('R', 'A', 1))
+        box.put(event(1))
+        box.put(book('R', 'B', 1))
+        box.put(book('R', 'A', 2))
+        box.put(book('S', 'A', 1))
+        self.assertEqual(box.qsize(), 4)
+        await self.drain()
+
+        self.assertEqual(
+            [(m['type'], m.get('room'), m.get('symbol'), m.get('seq')) for m in ws.sent],
+            [
+                ('Info', None, None, None),
+                ('OrderbookUpdate', 'R', 'B', 1),
+                ('OrderbookUpdate', 'R', 'A', 2),
+                ('OrderbookUpdate', 'S', 'A', 1),
+            ]
+        )
+        self.assertEqual(box.qsize(), 0)
+        box.close()
+
+    async def test_drop(self):
+        ws = FakeSocket()
+        box = outbox.Outbox(ws, capacity=2, policy='drop')
+        for n in range(3):
+            box.put(event(n))
+        self.assertEqual(box.dropped, 1)
+        await self.drain()
+        self.assertEqual([m['status'] for m in ws.sent], ['0', '1'])
+        box.close()
+
+    async def test_resync(self):
+        ws = FakeSocket()
+        resynced = []
+        box = outbox.Outbox(ws, capacity=2, policy='resync', on_resync=resynced.append)
+        box.put(event(0))
+        box.put(book('R', 'A', 1))
+        box.put(event(1))       # Overflows, dropping the waiting event
+        box.put(event(2))       # Dropped while resyncing
+        box.put(book('R', 'A', 2))
+        self.assertEqual(box.dropped, 3)
+        await self.drain()
+
+        self.assertEqual([(m['type'], m.get('seq')) for m in ws.sent], [('OrderbookUpdate', 2)])
+        self.assertEqual(resynced, [box])
+
+        box.put(event(3))
+        await self.drain()
+        self.assertEqual(ws.sent[-1]['status'], '3')
+        box.close()
+
+    async def test_disconnect(self):
+        ws = FakeSocket()
+        box = outbox.Outbox(ws, capacity=1, policy='disconnect')
+        box.put(event(0))
+        box.put(event(1))
+        await self.drain()
+
+        self.assertEqual(ws.closed, (1008, 'Slow consumer'))
+        self.assertEqual(ws.sent, [])
+        self.assertEqual(box.dropped, 2)
+        with self.assertRaises(outbox.SlowConsumer):
+            box.put(event(2))
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            outbox.Outbox(FakeSocket(), policy='block')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3.8
+'''
+test_wire.py
+
+Tests of the binary records in backend/wire.py and of the Frames in
+backend/frame.py that carry them
+'''
+
+import pickle
+import unittest
+
+import backend.frame as frame
+import backend.wire as wire
+
+class DecodeTest(unittest.TestCase):
+    def test_new_order(self):
+        msg = wire.decode(wire.NEW_ORDER_RECORD.pack(wire.NEW_ORDER, 1, 2, 3, 40, 5), 'R')
+        self.assertEqual(msg, {
+            'type' : 'NewOrder',
+            'data' : {
+                'room' : 'R',
+                'player_id' : 3,
+                'instrument_id' : 2,
+                'price' : 40,
+                'size' : 5,
+                'direction' : 'ask',
+            }
+        })
+
+    def test_cancel_order(self):
+        msg = wire.decode(wire.CANCEL_ORDER_RECORD.pack(wire.CANCEL_ORDER, 0, 1, 7), 'R')
+        self.assertEqual(msg['type'], 'CancelOrder')
+        self.assertEqual(
+            msg['data'], {'room' : 'R', 'player_id' : 1, 'instrument_id' : 0, 'order_id' : 7}
+        )
+
+    def test_amend_zero_leaves_unchanged(self):
+        msg = wire.decode(wire.AMEND_ORDER_RECORD.pack(wire.AMEND_ORDER, 0, 1, 7, 0, 3), 'R')
+        self.assertEqual(msg['type'], 'AmendOrder')
+        self.assertIsNone(msg['data']['price'])
+        self.assertEqual(msg['data']['size'], 3)
+
+    def test_bad_records(self):
+        record = wire.NEW_ORDER_RECORD.pack(wire.NEW_ORDER, 0, 0, 0, 40, 5)
+        self.assertIsNone(wire.decode(record[:-1], 'R'))
+        self.assertIsNone(wire.decode(b'\xff' + record[1:], 'R'))
+        self.assertIsNone(wire.decode(wire.NEW_ORDER_RECORD.pack(wire.NEW_ORDER, 2, 0, 0, 40, 5), 'R'))
+
+class EncodeTest(unittest.TestCase):
+    def test_order_update(self):
+        msg = {
+            'type' : 'OrderUpdate',
+            'room' : 'R',
+            'data' : {
+                'instrument' : 'A',
+                'order_id' : 4,
+                'size' : 5,
+                'remaining_size' : 2,
+                'price' : 40,
+                'direction' : 'bid',
+                'status' : 'active',
+            }
+        }
+        record = wire.encode(msg, 1)
+        self.assertEqual(
+            wire.ORDER_UPDATE_RECORD.unpack(record), (wire.ORDER_UPDATE, 0, 0, 1, 4, 40, 5, 2)
+        )
+
+    def test_fill_and_trade(self):
+        fill = {
+            'type' : 'Fill',
+            'data' : {'instrument' : 'A', 'order_id' : 4, 'price' : 40, 'size' : 2, 'direction' : 'sell'}
+        }
+        self.assertEqual(wire.FILL_RECORD.unpack(wire.encode(fill, 0)), (wire.FILL, 1, 0, 4, 40, 2))
+        trade = {
+            'type' : 'TradeUpdate',
+            'data' : {'seq' : 9, 'price' : 40, 'size' : 2, 'direction' : 'bid', 'instrument' : 'A'}
+        }
+        self.assertEqual(
+            wire.TRADE_UPDATE_RECORD.unpack(wire.encode(trade, 2)), (wire.TRADE_UPDATE, 0, 2, 9, 40, 2)
+        )
+
+    def test_orderbook_delta(self):
+        msg = {
+            'type' : 'OrderbookDelta',
+            'symbol' : 'A',
+            'seq' : 12,
+            'data' : [
+                {'price' : 40, 'size' : 3, 'type' : 'bid'},
+                {'price' : 41, 'size' : 0, 'type' : 'ask'},
+            ]
+        }
+        record = wire.encode(msg, 1)
+        header = wire.ORDERBOOK_DELTA_RECORD.unpack_from(record)
+        self.assertEqual(header, (wire.ORDERBOOK_DELTA, 1, 12, 2))
+        levels = [
+            wire.LEVEL_RECORD.unpack_from(record, wire.ORDERBOOK_DELTA_RECORD.size + i * wire.LEVEL_RECORD.size)
+            for i in range(header[3])
+        ]
+        self.assertEqual(levels, [(0, 40, 3), (1, 41, 0)])
+        self.assertEqual(
+            len(record), wire.ORDERBOOK_DELTA_RECORD.size + 2 * wire.LEVEL_RECORD.size
+        )
+
+    def test_no_binary_layout(self):
+        self.assertIsNone(wire.encode({'type' : 'Info', 'status' : 'hi'}, 0))
+        self.assertIsNone(wire.encode({'type' : 'Fill', 'data' : {}}, None))
+
+class FrameTest(unittest.TestCase):
+    def test_out_of_range_falls_back_to_text(self):
+        f = frame.Frame({
+            'type' : 'OrderbookDelta',
+            'symbol' : 'A',
+            'seq' : 1,
+            'data' : [{'price' : 40, 'size' : -2, 'type' : 'bid'}]
+        }, 0)
+        self.assertIsNone(f.binary)
+        self.assertIn('"size": -2', f.text)
+
+    def test_pickled_frame_keeps_encodings(self):
+        msg = {
+            'type' : 'TradeUpdate',
+            'room' : 'R',
+            'data' : {'seq' : 1, 'price' : 40, 'size' : 2, 'direction' : 'bid', 'instrument' : 'A'}
+        }
+        f = frame.Frame(msg, 3)
+        copy = pickle.loads(pickle.dumps(f))
+        self.assertEqual(copy.binary, f.binary)
+        self.assertEqual(copy.text, f.text)
+        self.assertEqual(copy.get_header()['room'], 'R')
+        self.assertEqual(copy.msg, msg)
+
+if __name__ == '__main__':
+    unittest.main()
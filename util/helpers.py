@@ -4,11 +4,44 @@ util.py
 21/01/2020 Colin Huang
 '''
 
-import inspect
+import bisect
 import hashlib
 
+import util.log as log
+
 def print_core(message: str):
-    print(f'({inspect.stack()[1][3]})\t{message}')
+    '''
+    Logs the message at INFO level, tagged with the calling function
+    '''
+    log.log(log.INFO, message, depth=2)
 
 def hash_string(s):
-    return int(hashlib.sha1(s.encode("utf-8")).hexdigest(), 16)
\ No newline at end of file
+    return int(hashlib.sha1(s.encode("utf-8")).hexdigest(), 16)
+
+def hash_password(name, password):
+    '''
+    Salted hash of a player's password, which is what is kept in memory
+    and in the journal rather than the password itself
+    '''
+    return hashlib.pbkdf2_hmac(
+        'sha256', str(password).encode('utf-8'), f'mocktrading:{name}'.encode('utf-8'), 20000
+    ).hex()
+
+class HashRing:
+    '''
+    Consistent hash ring mapping keys (e.g. room names) onto nodes.
+    Each node is given a number of points on the ring so that keys
+    are spread evenly and only move when their node is added or removed.
+    '''
+
+    def __init__(self, nodes, replicas=64):
+        self._ring = []
+        for node in nodes:
+            for i in range(replicas):
+                self._ring.append((hash_string(f'{node}:{i}'), node))
+        self._ring.sort()
+        self._points = [point for point, _ in self._ring]
+
+    def get(self, key):
+        i = bisect.bisect(self._points, hash_string(key)) % len(self._ring)
+        return self._ring[i][1]
@@ -0,0 +1,136 @@
+'''
+log.py
+
+Level gated logging with a background writer
+
+Records are (timestamp, level, caller, message) tuples pushed onto a
+bounded ring buffer and written out by a daemon thread, so logging on
+the matching path never blocks on stdout. Records are dropped (and
+counted) if the buffer is full.
+
+The caller is found with sys._getframe rather than inspect.stack(),
+and its formatted name is cached per code object.
+
+Hot paths should check the module level flags before formatting:
+
+    if log.DEBUG_ON:
+        log.debug(f'Expensive {message}')
+
+which costs a single attribute lookup when the level is disabled.
+'''
+
+import atexit
+import collections
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {
+    DEBUG : 'DEBUG',
+    INFO : 'INFO',
+    WARNING : 'WARNING',
+    ERROR : 'ERROR',
+}
+
+# Updated by set_level() so that call sites can gate on a plain bool
+DEBUG_ON = False
+INFO_ON = True
+
+class LogWriter:
+    def __init__(self, capacity=65536, interval=0.05, stream=None):
+        self.capacity = capacity        # Size of the ring buffer
+        self.interval = interval        # Seconds between flushes
+        self.stream = stream
+        self.dropped = 0
+
+        self._records = collections.deque()
+        self._wake = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def push(self, record):
+        if len(self._records) >= self.capacity:
+            self.dropped += 1
+            return
+        self._records.append(record)
+        if self._thread is None:
+            self.start()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        stream = self.stream or sys.stdout
+        records = self._records
+        lines = []
+        while records:
+            _, level, caller, message = records.popleft()
+            if level >= WARNING:
+                lines.append(f'{caller}\t{LEVEL_NAMES[level]}: {message}\n')
+            else:
+                lines.append(f'{caller}\t{message}\n')
+        if self.dropped:
+            lines.append(f'(log)\tDropped {self.dropped} records\n')
+            self.dropped = 0
+        if lines:
+            stream.write(''.join(lines))
+            stream.flush()
+
+_writer = LogWriter()
+_level = INFO
+_callers = {}   # code object -> '(function name)'
+
+atexit.register(_writer.flush)
+
+def set_level(level):
+    global _level, DEBUG_ON, INFO_ON
+    _level = level
+    DEBUG_ON = level <= DEBUG
+    INFO_ON = level <= INFO
+
+def get_level():
+    return _level
+
+def get_writer():
+    return _writer
+
+def _caller(depth):
+    code = sys._getframe(depth + 1).f_code
+    try:
+        return _callers[code]
+    except KeyError:
+        name = _callers[code] = f'({code.co_name})'
+        return name
+
+def log(level, message, depth=1):
+    if level < _level:
+        return
+    _writer.push((time.time(), level, _caller(depth), message))
+
+def debug(message):
+    if DEBUG_ON:
+        _writer.push((time.time(), DEBUG, _caller(1), message))
+
+def info(message):
+    if INFO_ON:
+        _writer.push((time.time(), INFO, _caller(1), message))
+
+def warning(message):
+    log(WARNING, message, depth=2)
+
+def error(message):
+    log(ERROR, message, depth=2)